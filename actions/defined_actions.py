@@ -101,7 +101,7 @@ class RestartAction(BaseActionClass):
         event = set_slot_event
         event.append(text_event)
 
-        print(event.__dict__)
+        print(event.as_dict())
 
         return event
 
@@ -1,15 +1,17 @@
+import asyncio
 import logging
 import os
 import sys
 from datetime import datetime
-from typing import Optional, Tuple
+from functools import partial
+from typing import List, Optional, Tuple
 
 logging.basicConfig(level=logging.ERROR)
 
-from fastapi import FastAPI, Body
+from fastapi import FastAPI, Body, WebSocket, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.encoders import jsonable_encoder
-from fastapi.responses import JSONResponse, FileResponse
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from pydantic.main import BaseModel
 
 app = FastAPI(host="0.0.0.0")
@@ -28,32 +30,63 @@ app.add_middleware(
 
 sys.path.append(os.getcwd())
 
-from app.modules.chatbot import Message, send_rest_func, send_bot_framework_func
-from app.modules.ARM import SendData, send_message_func, get_user_func
+from app.modules.chatbot import Message, BroadcastData, check_trace_level, send_rest_func, send_rest_batch_func, \
+    send_bot_framework_func, broadcast_func, websocket_func
+from app.modules.ARM import SendData, FloorImages, send_message_func, get_user_func
 from app.modules.CMS import HIGH_LEVEL_CONFIG, NLU_CONFIG, DATASET, MODEL_LIST, change_dataset, add_qna, remove_qna, save_qna, get_model_list, set_model
-from app.modules.DB import get_conversation, get_messages
+from app.modules.DB import get_conversation, get_messages, get_history, get_stats, search_history
 
 from controller.server_controller import Controller, UserConversations
+from database.export import export
+from database.retention import RetentionJob
+from controller.scheduler import TurnScheduler
+from controller.u2u import U2USessions
+from controller.trace import Tracer
 from parsers.flow_map import FlowMap
 from nlu_pipelines.DIETClassifier.src.models.wrapper import DIETClassifierWrapper as Wrapper
 from channels.botframework import BotFramework
+from channels.outbound import OutboundQueue
+from channels.ingestion import IngestionQueue
+from channels.dedup import SeenCache
+from channels.websocket import WebSocketChannel
 from actions.defined_actions import *
 
 from app.setting.setting import Setting
 
 nlu: Wrapper = Wrapper(Setting.model_config)
 flow_map: FlowMap = FlowMap(Setting.flow_config, Setting.domain_config)
+tracer: Tracer = Tracer(level=Setting.trace_level, sample_rate=Setting.trace_sample_rate)
 controller: Controller = Controller(nlu=nlu, flow_map=flow_map, version=Setting.version,
                                     base_action_class=Setting.base_action_class,
-                                    debug=Setting.debug)
+                                    debug=Setting.debug, tracer=tracer)
 
 user_conversations: UserConversations = UserConversations(db=Setting.user_db,
                                                           entities_list=flow_map.entities_list,
                                                           intents_list=flow_map.intents_list,
                                                           slots_list=flow_map.slots_list,
-                                                          user_limit=10)
+                                                          user_limit=10,
+                                                          persistence=Setting.persistence_mode,
+                                                          batch_size=Setting.persistence_batch_size,
+                                                          flush_interval=Setting.persistence_flush_interval,
+                                                          storage=Setting.storage_mode,
+                                                          snapshot_interval=Setting.snapshot_interval,
+                                                          db_options=Setting.db_options,
+                                                          fingerprint=flow_map.fingerprint)
 
-bot_framework = BotFramework(Setting.app_id, Setting.app_password, Setting.bot)
+bot_framework = BotFramework(Setting.app_id, Setting.app_password, Setting.bot, **Setting.bot_framework_options)
+
+outbound = OutboundQueue(bot_framework.deliver, **Setting.outbound_options)
+if Setting.outbound_on:
+    bot_framework.outbound = outbound
+
+scheduler = TurnScheduler(max_workers=Setting.inference_workers)
+
+retention = RetentionJob(user_conversations.db, archive_path=Setting.archive_path,
+                         max_age_days=Setting.retention_days, interval=Setting.retention_interval)
+
+arm_images = FloorImages(Setting.images_path, max_size=Setting.image_cache_size)
+
+u2u_sessions = U2USessions(user_conversations.async_db, ttl=Setting.u2u_ttl)
 
 
 # ARM required socketio setup
@@ -66,15 +99,61 @@ else:
     sio = None
 
 
+async def process_activity(user_input: Dict[str, Any]):
+    # the returned instances are not assigned back, a reload during the turn may have replaced them
+    await send_bot_framework_func(user_input=user_input, user_conversations=user_conversations, controller=controller,
+                                  bot_framework=bot_framework, sio=sio, scheduler=scheduler, sessions=u2u_sessions)
+
+
+ingestion = IngestionQueue(process_activity, workers=Setting.ingestion_workers, max_size=Setting.ingestion_queue_size)
+
+seen_activities = SeenCache(**Setting.dedup_options)
+
+websocket_channel = WebSocketChannel()
+
+
+@app.on_event("startup")
+async def startup():
+    global user_conversations
+
+    await user_conversations.start()
+    await u2u_sessions.start()
+    await bot_framework.start()
+
+    if Setting.ingestion_mode == "background":
+        await ingestion.start()
+
+    if Setting.retention_on:
+        await retention.start()
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    global user_conversations
+
+    await ingestion.close()
+    await websocket_channel.close()
+    await retention.close()
+    # let the running turns finish, so their states are saved before close
+    await scheduler.pause()
+    await u2u_sessions.close()
+    await user_conversations.close()
+    scheduler.shutdown()
+    await outbound.close()
+    await bot_framework.close()
+    seen_activities.close()
+
+
 @app.post("/webhooks/rest/webhook")
 async def send_rest(message: Message):
-    global user_conversations
-    global controller
+    error = check_trace_level([message])
+    if error is not None:
+        return JSONResponse(jsonable_encoder({"error": error}), status_code=400)
 
     try:
-        output, user_conversations, controller = await send_rest_func(message=message,
-                                                                      user_conversations=user_conversations,
-                                                                      controller=controller)
+        # the returned instances are not assigned back, a reload during the turn may have replaced them
+        output, _, _ = await send_rest_func(message=message, user_conversations=user_conversations,
+                                            controller=controller, scheduler=scheduler)
 
     except Exception as ex:
         logging.error(f"Error: Chatbot's rest channel error {ex}")
@@ -83,15 +162,51 @@ async def send_rest(message: Message):
     return JSONResponse(jsonable_encoder(output), status_code=200)
 
 
-@app.post("/webhook/blueprint/")
-async def send_from_blueprint(message: Message):
+@app.post("/webhooks/rest/batch")
+async def send_rest_batch(messages: List[Message]):
     global user_conversations
     global controller
 
+    if len(messages) > Setting.rest_batch_limit:
+        return JSONResponse(jsonable_encoder({"error": f"A batch has at most {Setting.rest_batch_limit} messages, "
+                                                       f"not {len(messages)}"}), status_code=400)
+
+    error = check_trace_level(messages)
+    if error is not None:
+        return JSONResponse(jsonable_encoder({"error": error}), status_code=400)
+
+    try:
+        # the globals are looked up on every turn, a reload may replace them while the batch is processed
+        results, user_conversations, controller = await send_rest_batch_func(messages=messages,
+                                                                             current=lambda: (user_conversations,
+                                                                                              controller),
+                                                                             scheduler=scheduler,
+                                                                             batch_size=Setting.nlu_batch_size)
+
+    except Exception as ex:
+        logging.error(f"Error: Chatbot's rest batch channel error {ex}")
+        return JSONResponse(jsonable_encoder({"error": str(ex)}), status_code=500)
+
+    return JSONResponse(jsonable_encoder(results), status_code=200)
+
+
+@app.websocket("/webhooks/websocket/{user_id}")
+async def send_websocket(websocket: WebSocket, user_id: str):
+    # the globals are looked up on every turn, the connection outlives a reload
+    await websocket_func(websocket=websocket, user_id=user_id, current=lambda: (user_conversations, controller),
+                         scheduler=scheduler, channel=websocket_channel, max_pending=Setting.websocket_max_pending)
+
+
+@app.post("/webhook/blueprint/")
+async def send_from_blueprint(message: Message):
+    error = check_trace_level([message])
+    if error is not None:
+        return JSONResponse(jsonable_encoder({"error": error}), status_code=400)
+
     try:
-        output, user_conversations, controller = await send_rest_func(message=message,
-                                                                      user_conversations=user_conversations,
-                                                                      controller=controller)
+        # the returned instances are not assigned back, a reload during the turn may have replaced them
+        output, _, _ = await send_rest_func(message=message, user_conversations=user_conversations,
+                                            controller=controller, scheduler=scheduler)
 
     except Exception as ex:
         logging.error(f"Error: Chatbot's rest channel error {ex}")
@@ -111,24 +226,67 @@ async def send_from_blueprint(message: Message):
 
 @app.post("/chatbot/botframework/")
 async def send_bot_framework(user_input: Dict[str, Any] = Body(...)):
-    global user_conversations
-    global controller
-    global bot_framework
+    try:
+        activity_id = bot_framework.translate_botframework_input(user_input)["activity_id"]
+
+    except Exception as ex:
+        return JSONResponse(jsonable_encoder({"error": f"Invalid activity {ex!r}"}), status_code=400)
+
+    # a retried webhook is answered without reaching the NLU and the conversation state again
+    dedup = Setting.dedup_on and activity_id is not None
+    if dedup and await seen_activities.seen_async(activity_id):
+        return JSONResponse(jsonable_encoder({"status": "duplicate"}), status_code=200)
+
+    if Setting.ingestion_mode == "background":
+        if not ingestion.put(user_input):
+            if dedup:
+                await seen_activities.forget_async(activity_id)
+
+            return JSONResponse(jsonable_encoder({"error": "Ingestion queue is full"}), status_code=503)
+
+        return JSONResponse(jsonable_encoder({"status": "success"}), status_code=200)
 
     try:
-        user_conversations, controller, bot_framework = await send_bot_framework_func(user_input=user_input,
-                                                                                      user_conversations=user_conversations,
-                                                                                      controller=controller,
-                                                                                      bot_framework=bot_framework,
-                                                                                      sio=sio)
+        await process_activity(user_input)
 
     except Exception as ex:
+        if dedup:
+            await seen_activities.forget_async(activity_id)
+
         logging.error(f"Error: Chatbot's botframework channel error {ex}")
         return JSONResponse(jsonable_encoder({"error": str(ex)}), status_code=500)
 
     return JSONResponse(jsonable_encoder({"status": "success"}), status_code=200)
 
 
+@app.post("/broadcast")
+async def broadcast(request: BroadcastData):
+    try:
+        result = await broadcast_func(request=request, bot_framework=bot_framework, db=user_conversations.async_db,
+                                      concurrency=Setting.broadcast_concurrency)
+
+    except Exception as ex:
+        logging.error(f"Error: broadcast failed {ex}")
+        return JSONResponse(jsonable_encoder({"error": str(ex)}), status_code=500)
+
+    return JSONResponse(jsonable_encoder(result), status_code=200)
+
+
+@app.get("/chatbot/mailbox")
+async def get_mailbox():
+    return JSONResponse(jsonable_encoder(scheduler.stats()), status_code=200)
+
+
+@app.get("/chatbot/ingestion")
+async def get_ingestion():
+    return JSONResponse(jsonable_encoder(dict(ingestion.stats(), dedup=seen_activities.stats())), status_code=200)
+
+
+@app.get("/chatbot/outbound")
+async def get_outbound():
+    return JSONResponse(jsonable_encoder(dict(outbound.stats(), token=bot_framework.tokens.stats())), status_code=200)
+
+
 @app.post("/ARM/send/")
 async def send_arm(request: SendData):
     global bot_framework
@@ -136,7 +294,7 @@ async def send_arm(request: SendData):
 
     try:
         output, bot_framework = await send_message_func(request=request, bot_framework=bot_framework,
-                                                        db=user_conversations.db)
+                                                        sessions=u2u_sessions, images=arm_images)
 
     except Exception as ex:
         logging.error(f"Error: ARM send message failed {ex}")
@@ -153,7 +311,7 @@ async def get_user():
     global user_conversations
 
     try:
-        result = await get_user_func(user_conversations.db)
+        result = await get_user_func(user_conversations.async_db, u2u_sessions)
 
     except Exception as ex:
         logging.error(f"Error: ARM get users error {ex}")
@@ -163,15 +321,26 @@ async def get_user():
 
 
 @app.get("/ARM/img/")
-async def get_img(floor: str, timestamp: str):
+async def get_img(request: Request, floor: str, timestamp: str):
     """
-    Get image from IMAGES_PATH folder
+    Get image from IMAGES_PATH folder, answered from memory and with 304 when the client already has it
 
+    :param request: Request - the request, for If-None-Match
     :param floor: str - should be {floor}.png
     :param timestamp: str - timestamp to make the link difference every time it called
     :return: Image file
     """
-    return FileResponse(f"{Setting.images_path}/{floor}")
+    image = await arm_images.get(floor)
+    if image is None:
+        return JSONResponse(jsonable_encoder({"error": f"Image {floor} not found"}), status_code=404)
+
+    # the image of a floor is replaced under the same name, so the clients revalidate it every time
+    headers = {"ETag": image["etag"], "Last-Modified": image["last_modified"], "Cache-Control": "no-cache"}
+
+    if image["etag"] in [tag.strip() for tag in request.headers.get("if-none-match", "").split(",")]:
+        return Response(status_code=304, headers=headers)
+
+    return Response(content=image["content"], media_type="image/png", headers=headers)
 
 
 @app.get("/CMS/qna")
@@ -310,7 +479,7 @@ async def change_dataset(dataset: DatasetExamples):
 async def get_user(user_id: str):
     try:
         global user_conversations
-        return JSONResponse(jsonable_encoder(await get_conversation(user_conversations.db, user_id=user_id)),
+        return JSONResponse(jsonable_encoder(await get_conversation(user_conversations.async_db, user_id=user_id)),
                             status_code=200)
 
     except Exception as ex:
@@ -322,13 +491,104 @@ async def get_user(user_id: str):
 async def fetch_user_messages():
     try:
         global user_conversations
-        return JSONResponse(jsonable_encoder(await get_messages(user_conversations.db)), status_code=200)
+        return JSONResponse(jsonable_encoder(await get_messages(user_conversations.async_db)), status_code=200)
 
     except Exception as ex:
         logging.error(f"get user conversation error {ex}")
         return JSONResponse(jsonable_encoder({"error": str(ex)}), status_code=500)
 
 
+@app.get("/DB/history")
+async def fetch_history(user_id: Optional[str] = None, before: Optional[int] = None, since: Optional[float] = None,
+                        limit: int = 100, fields: Optional[str] = None):
+    try:
+        global user_conversations
+        return JSONResponse(jsonable_encoder(await get_history(user_conversations.async_db, user_id=user_id,
+                                                               before=before, since=since, limit=limit,
+                                                               fields=fields)),
+                            status_code=200)
+
+    except ValueError as ex:
+        return JSONResponse(jsonable_encoder({"error": str(ex)}), status_code=400)
+
+    except Exception as ex:
+        logging.error(f"get history error {ex}")
+        return JSONResponse(jsonable_encoder({"error": str(ex)}), status_code=500)
+
+
+@app.get("/DB/search")
+async def search(q: str, user_id: Optional[str] = None, field: Optional[str] = None, start: Optional[float] = None,
+                 end: Optional[float] = None, limit: int = 20, offset: int = 0):
+    try:
+        global user_conversations
+        return JSONResponse(jsonable_encoder(await search_history(user_conversations.async_db, query=q,
+                                                                  user_id=user_id, field=field, start=start,
+                                                                  end=end, limit=limit, offset=offset)),
+                            status_code=200)
+
+    except ValueError as ex:
+        return JSONResponse(jsonable_encoder({"error": str(ex)}), status_code=400)
+
+    except Exception as ex:
+        logging.error(f"search history error {ex}")
+        return JSONResponse(jsonable_encoder({"error": str(ex)}), status_code=500)
+
+
+@app.get("/DB/stats")
+async def fetch_stats(start: Optional[str] = None, end: Optional[str] = None, intent: Optional[str] = None):
+    try:
+        global user_conversations
+        return JSONResponse(jsonable_encoder(await get_stats(user_conversations.async_db, start=start, end=end,
+                                                             intent=intent)),
+                            status_code=200)
+
+    except Exception as ex:
+        logging.error(f"get stats error {ex}")
+        return JSONResponse(jsonable_encoder({"error": str(ex)}), status_code=500)
+
+
+@app.get("/DB/retention")
+async def report_retention():
+    try:
+        result = await asyncio.get_running_loop().run_in_executor(None, partial(retention.run, dry_run=True))
+        return JSONResponse(jsonable_encoder(result), status_code=200)
+
+    except Exception as ex:
+        logging.error(f"retention report error {ex}")
+        return JSONResponse(jsonable_encoder({"error": str(ex)}), status_code=500)
+
+
+@app.post("/DB/retention")
+async def run_retention():
+    try:
+        result = await asyncio.get_running_loop().run_in_executor(None, partial(retention.run, dry_run=False))
+        return JSONResponse(jsonable_encoder(result), status_code=200)
+
+    except Exception as ex:
+        logging.error(f"retention error {ex}")
+        return JSONResponse(jsonable_encoder({"error": str(ex)}), status_code=500)
+
+
+@app.get("/DB/export")
+async def export_table(table: str = "chat_state", format: str = "ndjson", gzip: bool = False,
+                       start: Optional[float] = None, end: Optional[float] = None, user_id: Optional[str] = None,
+                       intent: Optional[str] = None):
+    try:
+        global user_conversations
+        chunks = export(user_conversations.db, table=table, export_format=format, compress=gzip, start=start,
+                        end=end, user_id=user_id, intent=intent)
+
+    except ValueError as ex:
+        return JSONResponse(jsonable_encoder({"error": str(ex)}), status_code=400)
+
+    filename = f"{table}.{format}" + (".gz" if gzip else "")
+    media_type = "application/gzip" if gzip else ("application/x-ndjson" if format == "ndjson" else "text/csv")
+
+    # the chunks are produced in a worker thread, each one reads a bounded number of rows
+    return StreamingResponse(chunks, media_type=media_type,
+                             headers={"Content-Disposition": f"attachment; filename={filename}"})
+
+
 @app.get("/Model/train")
 async def train_model(save_folder: str = None):
     if not save_folder:
@@ -359,17 +619,42 @@ async def reload():
         new_flow_map: FlowMap = FlowMap(Setting.flow_config, Setting.domain_config)
         new_controller: Controller = Controller(nlu=new_nlu, flow_map=new_flow_map, version=Setting.version,
                                                 base_action_class=Setting.base_action_class,
-                                                debug=Setting.debug)
-        new_user_conversations: UserConversations = UserConversations(db=Setting.user_db,
-                                                                      entities_list=new_flow_map.entities_list,
-                                                                      intents_list=new_flow_map.intents_list,
-                                                                      slots_list=new_flow_map.slots_list, user_limit=10)
+                                                debug=Setting.debug, tracer=tracer)
 
     except Exception as ex:
         logging.error(f"ERROR: Cannot reload chatbot {ex}")
         return JSONResponse(jsonable_encoder({"error": str(ex)}), status_code=500)
 
+    # a running retention job finishes on the old database first, the turns go on meanwhile
+    await asyncio.get_running_loop().run_in_executor(None, retention.lock.acquire)
+
     try:
+        # no turn runs while the instances are swapped, the turns that arrive meanwhile wait for the new ones
+        await scheduler.pause()
+
+        # write the pending states, so the new UserConversations loads the latest ones
+        await user_conversations.flush_async()
+
+        new_user_conversations: UserConversations = UserConversations(db=Setting.user_db,
+                                                                      entities_list=new_flow_map.entities_list,
+                                                                      intents_list=new_flow_map.intents_list,
+                                                                      slots_list=new_flow_map.slots_list, user_limit=10,
+                                                                      persistence=Setting.persistence_mode,
+                                                                      batch_size=Setting.persistence_batch_size,
+                                                                      flush_interval=Setting.persistence_flush_interval,
+                                                                      storage=Setting.storage_mode,
+                                                                      snapshot_interval=Setting.snapshot_interval,
+                                                                      db_options=Setting.db_options,
+                                                                      fingerprint=new_flow_map.fingerprint)
+        await new_user_conversations.start()
+
+        # the ARM sessions write through the new database from now on
+        await u2u_sessions.flush()
+        u2u_sessions.db = new_user_conversations.async_db
+
+        # the requests that already hold the old instance are handed over to the new one
+        await user_conversations.close(successor=new_user_conversations)
+
         nlu = None
         flow_map = None
         user_conversations = None
@@ -380,10 +665,16 @@ async def reload():
         user_conversations = new_user_conversations
         controller = new_controller
 
+        retention.db = new_user_conversations.db
+
     except Exception as ex:
         logging.error(f"ERROR: Cannot reload chatbot {ex}")
         return JSONResponse(jsonable_encoder({"error": str(ex)}), status_code=500)
 
+    finally:
+        scheduler.resume()
+        retention.lock.release()
+
     return JSONResponse(jsonable_encoder({"status": "success"}), status_code=200)
 
 
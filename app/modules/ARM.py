@@ -1,8 +1,12 @@
+import asyncio
 import os
 import sys
 import io
 import base64
+import hashlib
+from collections import OrderedDict
 from datetime import datetime
+from email.utils import formatdate
 from PIL import Image
 from typing import Tuple, Dict, Any, Optional
 
@@ -10,14 +14,133 @@ from pydantic.main import BaseModel
 
 sys.path.append(os.getcwd())
 
-from database.database import ChatStateDB
+from database.async_database import AsyncChatStateDB
 from channels.botframework import BotFramework
+from controller.u2u import U2USessions
 from app.setting.setting import Setting
 
 
 HOST_LINK = Setting.host_link
 IMAGES_PATH = Setting.images_path
 
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+
+class FloorImages:
+    """
+    Latest image of every ARM floor, written to images_path as {floor}.png and kept in memory (least recently used
+    are dropped) with the ETag and Last-Modified of the file, so the fetches of /ARM/img/ need no disk read
+    """
+    def __init__(self, path: str = IMAGES_PATH, max_size: int = 16):
+        """
+        Create image store
+        :param path: str - folder of the images
+        :param max_size: int - number of images kept in memory
+        """
+        if max_size < 1:
+            raise ValueError(f"max_size must be a positive number, not {max_size}")
+
+        self.path = path
+        self.max_size = max_size
+
+        # file name: dict(content, etag, last_modified, mtime)
+        self.images: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self.counters = dict(hits=0, misses=0, written=0, transcoded=0)
+
+    @staticmethod
+    def to_png(content: bytes) -> bytes:
+        """
+        Convert an image of any format PIL can open to PNG
+        :param content: bytes - encoded image
+        :return: bytes - PNG image
+        """
+        with Image.open(io.BytesIO(content)) as pil_img:
+            output = io.BytesIO()
+            pil_img.save(output, format="PNG")
+
+        return output.getvalue()
+
+    def _write(self, name: str, content: bytes) -> float:
+        file_path = os.path.join(self.path, name)
+
+        # replace the file at once, a fetch reading the previous image never sees a half written one
+        with open(f"{file_path}.tmp", "wb") as f:
+            f.write(content)
+
+        os.replace(f"{file_path}.tmp", file_path)
+
+        return os.stat(file_path).st_mtime
+
+    def _read(self, name: str) -> Optional[Tuple[bytes, float]]:
+        file_path = os.path.join(self.path, name)
+
+        try:
+            with open(file_path, "rb") as f:
+                return f.read(), os.fstat(f.fileno()).st_mtime
+
+        except FileNotFoundError:
+            return None
+
+    def _remember(self, name: str, content: bytes, mtime: float) -> Dict[str, Any]:
+        image = dict(
+            content=content,
+            etag=f'"{hashlib.sha1(content).hexdigest()}"',
+            last_modified=formatdate(mtime, usegmt=True),
+            mtime=mtime
+        )
+
+        self.images[name] = image
+        self.images.move_to_end(name)
+
+        if len(self.images) > self.max_size:
+            self.images.popitem(last=False)
+
+        return image
+
+    async def save(self, floor: str, content: bytes) -> Dict[str, Any]:
+        """
+        Save the image of floor, PNG images are written as they are, the other formats are converted in a worker thread
+        :param floor: str - name of the ARM floor
+        :param content: bytes - encoded image
+        :return: dict(content, etag, last_modified, mtime) - the saved image
+        """
+        loop = asyncio.get_running_loop()
+
+        if not content.startswith(PNG_SIGNATURE):
+            content = await loop.run_in_executor(None, self.to_png, content)
+            self.counters["transcoded"] += 1
+
+        name = f"{floor}.png"
+        mtime = await loop.run_in_executor(None, self._write, name, content)
+        self.counters["written"] += 1
+
+        return self._remember(name, content, mtime)
+
+    async def get(self, name: str) -> Optional[Dict[str, Any]]:
+        """
+        Get image by file name, from memory or else from images_path
+        :param name: str - file name of the image, {floor}.png
+        :return: optional(dict(content, etag, last_modified, mtime)) - None if there is no such image
+        """
+        name = os.path.basename(name)
+
+        image = self.images.get(name, None)
+        if image is not None:
+            self.images.move_to_end(name)
+            self.counters["hits"] += 1
+            return image
+
+        self.counters["misses"] += 1
+
+        result = await asyncio.get_running_loop().run_in_executor(None, self._read, name)
+        if result is None:
+            return None
+
+        return self._remember(name, *result)
+
+    def stats(self) -> Dict[str, Any]:
+        return dict(size=len(self.images), max_size=self.max_size, **self.counters)
+
 
 class SendData(BaseModel):
     """
@@ -30,7 +153,8 @@ class SendData(BaseModel):
     type: int
 
 
-async def send_message_func(request: SendData, bot_framework: BotFramework, db: ChatStateDB) -> Tuple[Optional[Dict[str, Any]], BotFramework]:
+async def send_message_func(request: SendData, bot_framework: BotFramework, sessions: U2USessions,
+                            images: FloorImages) -> Tuple[Optional[Dict[str, Any]], BotFramework]:
     """
     Handle request from ARM and send message to Skype user
      - message: str - text message to user
@@ -44,7 +168,8 @@ async def send_message_func(request: SendData, bot_framework: BotFramework, db:
 
     :param request: dict(message, id, img, type, floor) - explained in the doc
     :param bot_framework: BotFramework - bot_framework channel
-    :param db: ChatStateDB - user status database
+    :param sessions: U2USessions - u2u status of users
+    :param images: FloorImages - images of the ARM floors
     :return: bot_framework
     """
     message = request.message
@@ -56,45 +181,25 @@ async def send_message_func(request: SendData, bot_framework: BotFramework, db:
     if not 0 < type < 4:
         return {"status": False}, bot_framework
 
-    # Get the requested user status
-    arm_status = db.get_user_status(user_id=id)
-    if not arm_status:
-        return {"status": False}, bot_framework
+    # Get the requested user status, the sessions idle for 3 minutes are ended on the way
+    arm_status = await sessions.get(id)
+
+    refused = not arm_status
+    if arm_status:
+        if type == 1:
+            refused = not sessions.open_session(id)
 
-    # Get all user status
-    arm_statuses = db.fetch_arm_status()
-
-    # This block reset u2u for all user that offline from ARM for 3 minute
-    for user in arm_statuses:
-        if datetime.today().timestamp() - float(user["timestamp"]) > 60.0*3:
-            user["u2u"] = False
-            if user["user_id"] == id:
-                arm_status["u2u"] = False
-
-    if type == 1:
-        if arm_status["u2u"]:
-            return {"status": False}, bot_framework
-        else:
-            arm_status["u2u"] = True
-            arm_status["timestamp"] = datetime.today().timestamp()
-
-    elif type == 2:
-        arm_status["u2u"] = False
-
-    elif type == 3:
-        for user in arm_statuses:
-            if user["user_id"] == id:
-                user["u2u"] = True
-                user["floor"] = floor
-                user["timestamp"] = datetime.today().timestamp()
-
-                arm_status["u2u"] = True
-                arm_status["floor"] = floor
-                arm_status["timestamp"] = datetime.today().timestamp()
-
-            else:
-                if user["floor"] == floor:
-                    user["u2u"] = False
+        elif type == 2:
+            sessions.end_session(id)
+
+        elif type == 3:
+            sessions.take_floor(id, floor)
+
+    # only the users changed by this event (or expired since the last one) are written, also when it is refused
+    await sessions.flush()
+
+    if refused:
+        return {"status": False}, bot_framework
 
     if not len(message):
         return {"status": True}, bot_framework
@@ -102,7 +207,7 @@ async def send_message_func(request: SendData, bot_framework: BotFramework, db:
     img_url = None
     if img:
         try:
-            await create_image(img, arm_status["floor"])
+            await create_image(img, arm_status["floor"], images)
         except Exception as ex:
             print(f"Cannot convert string image {ex}")
 
@@ -110,35 +215,20 @@ async def send_message_func(request: SendData, bot_framework: BotFramework, db:
 
     bot_framework.prepare_message(recipient_id=id, user_name=arm_status["user_name"], message_data={"text": message})
 
-    if img:
-        await bot_framework.send_image_url(recipient_id=id, user_name=arm_status["user_name"], conversation={"id": id}, image=img_url)
-
-    await bot_framework.send_text_message(recipient_id=id, user_name=arm_status["user_name"], conversation={"id": id}, text=message)
-
-    for user in arm_statuses:
-        if user["user_id"] == id:
-            user_id = arm_status["user_id"]
-            user_name = arm_status["user_name"]
-            u2u = arm_status["u2u"]
-            floor = arm_status["floor"]
-
-        else:
-            user_id = user["user_id"]
-            user_name = user["user_name"]
-            u2u = user["u2u"]
-            floor = user["floor"]
-
-        db.change_user_status(user_id=user_id, user_name=user_name, u2u=u2u, floor=floor)
+    # the image goes with the first paragraph of the message, in one request
+    await bot_framework.send_text_message(recipient_id=id, user_name=arm_status["user_name"], conversation={"id": id},
+                                          text=message, image=img_url)
 
     return None, bot_framework
 
 
-async def create_image(img: str, floor: str):
+async def create_image(img: str, floor: str, images: FloorImages):
     """
     Create image and save to IMAGES_PATH by the base64 image
 
     :param img: str - base64 image
     :param floor: str - name of the ARM floor (used for setting name of image)
+    :param images: FloorImages - images of the ARM floors
     :return: None
     """
     if "data:image" in img:
@@ -146,18 +236,21 @@ async def create_image(img: str, floor: str):
         if len(string_split) > 1:
             img = string_split[1]
 
-    pil_img = Image.open(io.BytesIO(base64.b64decode(img)))
-    pil_img.save(f"{IMAGES_PATH}/{floor}.png")
-    del pil_img
+    await images.save(floor, base64.b64decode(img))
 
 
-async def get_user_func(db: ChatStateDB) -> Dict[str, Any]:
+async def get_user_func(db: AsyncChatStateDB, sessions: U2USessions) -> Dict[str, Any]:
     """
     Get all user status
 
+    :param db: AsyncChatStateDB - user status database
+    :param sessions: U2USessions - u2u status of users, written to db before reading
     :return: dict(user_id) - dictionary of user status, map by user_id
     """
-    arm_status = db.fetch_arm_status()
+    sessions.expire()
+    await sessions.flush()
+
+    arm_status = await db.fetch_arm_status()
 
     result_dict = dict()
 
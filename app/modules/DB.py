@@ -3,16 +3,16 @@ import os
 import sys
 import warnings
 
-from typing import Dict, List, Any
+from typing import Dict, List, Any, Optional
 
 sys.path.append(os.getcwd())
 
 
-from database.database import ChatStateDB
+from database.async_database import AsyncChatStateDB
 
 
-async def get_conversation(db: ChatStateDB, user_id: str, limit: int = 100) -> List[Dict[str, Any]]:
-    user_stats = db.fetch_user_messages(user_id=user_id, limit=limit)
+async def get_conversation(db: AsyncChatStateDB, user_id: str, limit: int = 100) -> List[Dict[str, Any]]:
+    user_stats = await db.fetch_user_messages(user_id=user_id, limit=limit)
 
     if not user_stats:
         return []
@@ -20,8 +20,8 @@ async def get_conversation(db: ChatStateDB, user_id: str, limit: int = 100) -> L
     return user_stats
 
 
-async def get_messages(db: ChatStateDB, limit: int = 300) -> List[Dict[str, Any]]:
-    messages = db.fetch_all_messages(limit=limit)
+async def get_messages(db: AsyncChatStateDB, limit: int = 300) -> List[Dict[str, Any]]:
+    messages = await db.fetch_all_messages(limit=limit)
 
     if not messages:
         return []
@@ -29,10 +29,97 @@ async def get_messages(db: ChatStateDB, limit: int = 300) -> List[Dict[str, Any]
     return messages
 
 
-async def get_users(db: ChatStateDB, limit: int = 100) -> List[Dict[str, Any]]:
-    users = db.fetch_users(limit=limit)
+async def get_users(db: AsyncChatStateDB, limit: int = 100) -> List[Dict[str, Any]]:
+    users = await db.fetch_users(limit=limit)
 
     if not users:
         return []
 
     return users
+
+
+async def get_history(db: AsyncChatStateDB, user_id: Optional[str] = None, before: Optional[int] = None,
+                      since: Optional[float] = None, limit: int = 100, fields: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Get one page of conversation history, newest first
+
+    :param db: AsyncChatStateDB - chat state database
+    :param user_id: optional(str) - only the messages of this user
+    :param before: optional(int) - cursor returned as next by the previous page
+    :param since: optional(float) - only the messages at or after this timestamp
+    :param limit: int - number of messages of the page
+    :param fields: optional(str) - comma separated fields of the messages, e.g. "text,intent,timestamp"
+    :return: dict(messages, next) - next is the cursor of the next page, None on the last page
+    """
+    if fields is not None:
+        fields = [field.strip() for field in fields.split(",") if field.strip()]
+
+    messages, next_cursor = await db.fetch_history(user_id=user_id, before=before, since=since, limit=limit,
+                                                   fields=fields)
+
+    return dict(messages=messages, next=next_cursor)
+
+
+async def search_history(db: AsyncChatStateDB, query: str, user_id: Optional[str] = None, field: Optional[str] = None,
+                         start: Optional[float] = None, end: Optional[float] = None, limit: int = 20,
+                         offset: int = 0) -> Dict[str, Any]:
+    """
+    Full-text search of the conversation history, best match first
+
+    :param db: AsyncChatStateDB - chat state database
+    :param query: str - words that must all match, "quoted words" match as a phrase and word* as prefix
+    :param user_id: optional(str) - only the messages of this user
+    :param field: optional(str) - only search text (user message) or response, default is both
+    :param start: optional(float) - only the messages at or after this timestamp
+    :param end: optional(float) - only the messages before this timestamp
+    :param limit: int - number of messages of the page
+    :param offset: int - offset returned as next by the previous page
+    :return: dict(messages, next) - next is the offset of the next page, None on the last page
+    """
+    messages, next_offset = await db.search_messages(query=query, user_id=user_id, field=field, start=start, end=end,
+                                                     limit=limit, offset=offset)
+
+    return dict(messages=messages, next=next_offset)
+
+
+async def get_stats(db: AsyncChatStateDB, start: Optional[str] = None, end: Optional[str] = None,
+                    intent: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Intent and usage statistics from the rollup tables, the cost depends on days x intents, not on messages
+
+    :param db: AsyncChatStateDB - chat state database
+    :param start: optional(str) - first day, YYYY-MM-DD
+    :param end: optional(str) - last day, YYYY-MM-DD
+    :param intent: optional(str) - only this intent
+    :return: dict(total, days, intents, rows) - totals per day and per intent, and the rows per day and intent
+    """
+    rows = await db.fetch_intent_stats(start=start, end=end, intent=intent)
+
+    days: Dict[str, Dict[str, Any]] = dict()
+    intents: Dict[str, Dict[str, Any]] = dict()
+    for row in rows:
+        for group, key in [(days, row["day"]), (intents, row["intent"])]:
+            values = group.setdefault(key, dict(count=0, fallback_count=0, confidence_sum=0.0))
+            values["count"] += row["count"]
+            values["fallback_count"] += row["fallback_count"]
+            values["confidence_sum"] += row["mean_confidence"] * row["count"]
+
+    def summary(values: Dict[str, Any]) -> Dict[str, Any]:
+        return dict(
+            count=values["count"],
+            fallback_count=values["fallback_count"],
+            fallback_rate=values["fallback_count"] / values["count"] if values["count"] else 0.0,
+            mean_confidence=values["confidence_sum"] / values["count"] if values["count"] else 0.0
+        )
+
+    count = sum(row["count"] for row in rows)
+    fallback_count = sum(row["fallback_count"] for row in rows)
+
+    return dict(
+        total=dict(count=count, fallback_count=fallback_count,
+                   fallback_rate=fallback_count / count if count else 0.0),
+        days=[dict(day=day, **summary(values)) for day, values in days.items()],
+        intents=sorted([dict(intent=name, **summary(values)) for name, values in intents.items()],
+                       key=lambda value: -value["count"]),
+        rows=rows
+    )
@@ -1,14 +1,23 @@
+import asyncio
+import json
 import os
 import sys
-from typing import Dict, Tuple, Any
+from functools import partial
+from typing import Dict, List, Set, Tuple, Any, Optional, Callable
 import socketio
 
+from fastapi import WebSocket, WebSocketDisconnect
 from pydantic.main import BaseModel
 
 sys.path.append(os.getcwd())
 
 from controller.server_controller import Controller, UserConversations
+from controller.scheduler import TurnScheduler
+from controller.trace import TRACE_LEVELS
+from controller.u2u import U2USessions
 from channels.botframework import BotFramework
+from channels.websocket import WebSocketChannel
+from database.async_database import AsyncChatStateDB
 
 
 class Message(BaseModel):
@@ -17,33 +26,223 @@ class Message(BaseModel):
     """
     message: str
     user_id: str
+    trace_level: Optional[str] = None
 
 
-async def send_rest_func(message: Message, user_conversations: UserConversations, controller: Controller) -> Tuple[Dict[str, Any], UserConversations, Controller]:
+class BroadcastData(BaseModel):
+    """
+    Input scheme for broadcasting a message to Skype users
+    """
+    message: str
+    user_ids: Optional[List[str]] = None
+    img_url: Optional[str] = None
+
+
+def check_trace_level(messages: List[Message]) -> Optional[str]:
+    """
+    Check the trace_level of the messages before they are processed
+    :param messages: list(Message) - user input requests
+    :return: optional(str) - the error, None if all trace levels are valid
+    """
+    for message in messages:
+        if message.trace_level is not None and message.trace_level not in TRACE_LEVELS:
+            return f"trace_level must be one of {list(TRACE_LEVELS.keys())}, not {message.trace_level}"
+
+    return None
+
+
+async def send_rest_func(message: Message, user_conversations: UserConversations, controller: Controller,
+                         scheduler: TurnScheduler) -> Tuple[Dict[str, Any], UserConversations, Controller]:
     """
     Receive message and give response
 
     :param message: Message class - user input request as Message type
     :param user_conversations: UserConversations - user_conversation manager
     :param controller: Controller - main controller for server
+    :param scheduler: TurnScheduler - per user scheduler for conversation turns
     :return: tuple(output, user_conversation, controller)
     """
 
     user_id = message.user_id
     user_input = message.message
 
-    # Query user stats from database
-    user_state = user_conversations(user_id)
+    async def turn() -> Dict[str, Any]:
+        # Query user stats from database
+        user_state = await user_conversations.get(user_id)
+
+        # Handle current conversation
+        try:
+            output = (await scheduler.run_inference(controller, user_state, user_input,
+                                                    trace_level=message.trace_level)).export()
+
+        except Exception:
+            user_conversations.release(user_id)
+            raise
+
+        await user_conversations.save(user_id=user_id, user_state=user_state)
 
-    # Handle current conversation
-    output = controller(user_state, user_input).__dict__
+        return output
 
-    user_conversations.save_to_db(user_id=user_id)
+    output = await scheduler.submit(user_id, turn)
 
     return output, user_conversations, controller
 
 
-async def send_bot_framework_func(user_input: Dict[str, Any], user_conversations: UserConversations, controller: Controller, bot_framework: BotFramework, sio: socketio.Client) -> Tuple[UserConversations, Controller, BotFramework]:
+async def send_rest_batch_func(messages: List[Message],
+                               current: Callable[[], Tuple[UserConversations, Controller]], scheduler: TurnScheduler,
+                               batch_size: int = 32) -> Tuple[List[Dict[str, Any]], UserConversations, Controller]:
+    """
+    Receive many messages and give the response of each one, the messages are predicted by nlu pipeline in batches
+    of batch_size, then the turns of every user are processed in the order of the messages
+
+    :param messages: list(Message) - user input requests as Message type
+    :param current: function - returns the current (user_conversations, controller), looked up on every turn since
+    a reload may replace them while the batch is processed
+    :param scheduler: TurnScheduler - per user scheduler for conversation turns
+    :param batch_size: int - maximum number of messages in one pass of nlu pipeline
+    :return: tuple(results, user_conversation, controller) - results has dict(user_id, output) or dict(user_id, error)
+    of every message, in the same order
+    """
+    if batch_size < 1:
+        raise ValueError(f"batch_size must be a positive number, not {batch_size}")
+
+    # nlu prediction does not depend on the state of conversation, so the messages of all users share the batches
+    _, predictor = current()
+    sentences = [message.message for message in messages]
+    predictions = []
+    for start in range(0, len(sentences), batch_size):
+        predictions += await scheduler.run_inference(predictor.predict, sentences[start:start + batch_size])
+
+    user_messages: Dict[str, List[int]] = dict()
+    for index, message in enumerate(messages):
+        user_messages.setdefault(message.user_id, []).append(index)
+
+    results: List[Optional[Dict[str, Any]]] = [None] * len(messages)
+
+    async def turn(index: int) -> Dict[str, Any]:
+        message = messages[index]
+        user_conversations, controller = current()
+        user_state = await user_conversations.get(message.user_id)
+
+        # the model was reloaded since the batch was predicted, the message is predicted again by the new one
+        prediction = predictions[index] if controller is predictor else None
+
+        try:
+            output = (await scheduler.run_inference(controller, user_state, message.message,
+                                                    trace_level=message.trace_level,
+                                                    prediction=prediction)).export()
+
+        except Exception:
+            user_conversations.release(message.user_id)
+            raise
+
+        await user_conversations.save(user_id=message.user_id, user_state=user_state)
+
+        return output
+
+    async def process_user(user_id: str, indexes: List[int]):
+        for index in indexes:
+            try:
+                results[index] = dict(user_id=user_id, output=await scheduler.submit(user_id, partial(turn, index)))
+
+            except Exception as ex:
+                results[index] = dict(user_id=user_id, error=str(ex))
+
+    await asyncio.gather(*(process_user(user_id, indexes) for user_id, indexes in user_messages.items()))
+
+    return (results,) + current()
+
+
+async def websocket_func(websocket: WebSocket, user_id: str,
+                         current: Callable[[], Tuple[UserConversations, Controller]], scheduler: TurnScheduler,
+                         channel: WebSocketChannel, max_pending: int = 16):
+    """
+    Serve the WebSocket connection of user until it is closed, every message {"message": str, "id": any,
+    "trace_level": str} is a turn, the output is pushed by the channel as soon as the turn is done
+
+    :param websocket: WebSocket - connection of user
+    :param user_id: str - id of user
+    :param current: function - returns the current (user_conversations, controller), looked up on every turn since
+    the connection outlives a reload
+    :param scheduler: TurnScheduler - per user scheduler for conversation turns
+    :param channel: WebSocketChannel - the connections of users
+    :param max_pending: int - maximum number of messages of the connection waiting or in process, the next ones are
+    answered with an error frame
+    :return: None
+    """
+    if max_pending < 1:
+        raise ValueError(f"max_pending must be a positive number, not {max_pending}")
+
+    await channel.connect(user_id, websocket)
+
+    # turns of this connection waiting or in process, cancelled when it is closed
+    pending: Set[asyncio.Future] = set()
+
+    async def turn(user_message: str, reply_to: Any, trace_level: Optional[str]):
+        user_conversations, controller = current()
+        user_state = await user_conversations.get(user_id)
+
+        try:
+            output = (await scheduler.run_inference(controller, user_state, user_message,
+                                                    trace_level=trace_level)).export()
+
+        except Exception:
+            user_conversations.release(user_id)
+            raise
+
+        await user_conversations.save(user_id=user_id, user_state=user_state)
+
+        # sent inside the mailbox of user, so the replies keep the order of the messages
+        await channel.send_output(user_id, output, reply_to)
+
+    async def handle(data: Dict[str, Any]):
+        reply_to = data.get("id", None)
+
+        try:
+            await scheduler.submit(user_id, partial(turn, str(data["message"]), reply_to, data.get("trace_level", None)))
+
+        except Exception as ex:
+            await channel.send(user_id, dict(type="error", error=str(ex), reply_to=reply_to))
+
+    try:
+        while True:
+            try:
+                data = json.loads(await websocket.receive_text())
+
+            except ValueError:
+                data = None
+
+            if not isinstance(data, dict) or "message" not in data:
+                await channel.send(user_id, dict(type="error", error="Frame must be {\"message\": str}",
+                                                 reply_to=None))
+                continue
+
+            if len(pending) >= max_pending:
+                await channel.send(user_id, dict(type="error",
+                                                 error=f"Too many pending messages, at most {max_pending}",
+                                                 reply_to=data.get("id", None)))
+                continue
+
+            await channel.send(user_id, dict(type="typing", reply_to=data.get("id", None)))
+
+            # the next messages are received while this one is processed
+            task = asyncio.ensure_future(handle(data))
+            pending.add(task)
+            task.add_done_callback(pending.discard)
+
+    except WebSocketDisconnect:
+        pass
+
+    finally:
+        channel.disconnect(user_id, websocket)
+
+        # the turns not started yet are dropped, the running ones still finish and save the state
+        for task in pending:
+            task.cancel()
+
+
+async def send_bot_framework_func(user_input: Dict[str, Any], user_conversations: UserConversations, controller: Controller, bot_framework: BotFramework, sio: socketio.Client,
+                                  scheduler: TurnScheduler, sessions: U2USessions = None) -> Tuple[UserConversations, Controller, BotFramework]:
     """
     Receive message from Skype and send back to user on Skype
 
@@ -52,6 +251,8 @@ async def send_bot_framework_func(user_input: Dict[str, Any], user_conversations
     :param controller: Controller - main controller for server
     :param bot_framework: BotFramework - bot_framework channel
     :param sio - socketio.Client - the socketio for ARM system
+    :param scheduler: TurnScheduler - per user scheduler for conversation turns
+    :param sessions: optional(U2USessions) - u2u status of users, required when sio is given
     :return: tuple(user_conversations, controller, botframework)
     """
     user_input = bot_framework.translate_botframework_input(user_input)
@@ -60,52 +261,60 @@ async def send_bot_framework_func(user_input: Dict[str, Any], user_conversations
     user_message = user_input["text"]
     user_name = user_input["user_name"]
 
-    # If Arm is on, this path check the 'u2u' status of user and send message to ARM system instead of Skype
-    if sio is not None:
-        u2u_result = await handle_u2u_message(user_input=user_input, user_conversations=user_conversations, sio=sio)
-        if u2u_result is True:
-            return user_conversations, controller, bot_framework
+    async def turn():
+        # If Arm is on, this path check the 'u2u' status of user and send message to ARM system instead of Skype
+        if sio is not None:
+            u2u_result = await handle_u2u_message(user_input=user_input, sessions=sessions, sio=sio)
+            if u2u_result is True:
+                return
+
+        # Query user stats from database
+        user_state = await user_conversations.get(user_id, user_name)
 
-    # Query user stats from database
-    user_state = user_conversations(user_id, user_name)
+        # Handle current conversation
+        try:
+            output = (await scheduler.run_inference(controller, user_state, user_message)).export()
 
-    # Handle current conversation
-    output = controller(user_state, user_message).__dict__
+        except Exception:
+            user_conversations.release(user_id)
+            raise
 
-    user_conversations.save_to_db(user_id=user_id)
+        await user_conversations.save(user_id=user_id, user_state=user_state)
 
-    text = output.get("text", None)
-    button = output.get("button", None)
+        text = output.get("text", None)
+        button = output.get("button", None)
 
-    bot_framework.prepare_message(recipient_id=user_input["recipient_id"], user_name=user_input["user_name"],
-                                  message_data={"text": text})
+        bot_framework.prepare_message(recipient_id=user_input["recipient_id"], user_name=user_input["user_name"],
+                                      message_data={"text": text})
 
-    if button is not None:
-        await bot_framework.send_text_with_buttons(recipient_id=user_input["recipient_id"],
-                                                   user_name=user_input["user_name"],
-                                                   conversation=user_input["conversation"], text=text, buttons=button)
+        if button is not None:
+            await bot_framework.send_text_with_buttons(recipient_id=user_input["recipient_id"],
+                                                       user_name=user_input["user_name"],
+                                                       conversation=user_input["conversation"], text=text, buttons=button)
 
-    else:
-        await bot_framework.send_text_message(recipient_id=user_input["recipient_id"],
-                                              user_name=user_input["user_name"],
-                                              conversation=user_input["conversation"], text=text)
+        else:
+            await bot_framework.send_text_message(recipient_id=user_input["recipient_id"],
+                                                  user_name=user_input["user_name"],
+                                                  conversation=user_input["conversation"], text=text)
+
+    await scheduler.submit(user_id, turn)
 
     return user_conversations, controller, bot_framework
 
 
-async def handle_u2u_message(user_input: Dict[str, Any], user_conversations: UserConversations, sio: socketio.Client) -> bool:
+async def handle_u2u_message(user_input: Dict[str, Any], sessions: U2USessions, sio: socketio.Client) -> bool:
     """
     If ARM system is on, this function check the 'u2u' status of user and send to ARM instead of Skype
 
     :param user_input: Standard format from Skype
-    :param user_conversations: UserConversations - user_conversations manager
+    :param sessions: U2USessions - u2u status of users
     :param sio: socketio.Client - the socketio for the ARM system
     :return: bool - Redirect to ARM or not
     """
     user_id = user_input["id"]
     user_message = user_input["text"]
 
-    arm_status = user_conversations.db.get_user_status(user_id=user_id)
+    arm_status = await sessions.get(user_id)
 
     if arm_status:
         u2u = arm_status["u2u"]
@@ -130,3 +339,38 @@ async def handle_u2u_message(user_input: Dict[str, Any], user_conversations: Use
             return False
 
     return False
+
+
+async def broadcast_func(request: BroadcastData, bot_framework: BotFramework, db: AsyncChatStateDB,
+                         concurrency: int = 16) -> Dict[str, Any]:
+    """
+    Send a message to many Skype users at once, __user__ in the message is replaced by the name of each user
+
+    :param request: BroadcastData - message, user_ids (default is every user who talked to the chatbot) and img_url
+    :param bot_framework: BotFramework - bot_framework channel
+    :param db: AsyncChatStateDB - user status database
+    :param concurrency: int - number of users sent at the same time
+    :return: dict(total, sent, failed, results) - results has the status of every user
+    """
+    users = {user["user_id"]: user for user in await db.fetch_arm_status()}
+    user_ids = list(users.keys()) if request.user_ids is None else request.user_ids
+
+    messages = [dict(
+        conversation={"id": user_id},
+        user_name=users[user_id]["user_name"],
+        text=request.message,
+        image=request.img_url
+    ) for user_id in user_ids if user_id in users]
+
+    results = await bot_framework.send_bulk(messages, concurrency=concurrency)
+    results += [dict(conversation_id=user_id, status="failed", sent=0, error="Unknown user")
+                for user_id in user_ids if user_id not in users]
+
+    sent = sum(result["status"] == "sent" for result in results)
+
+    return dict(
+        total=len(results),
+        sent=sent,
+        failed=len(results) - sent,
+        results=results
+    )
@@ -2,6 +2,8 @@ from actions.actions import BaseActionClass
 
 class Setting:
     debug = False
+    trace_level = "off"
+    trace_sample_rate = 0.0
 
     model_config = "config/config.yml"
     flow_config = "config/final_config.yml"
@@ -13,17 +15,46 @@ class Setting:
         "id": "28:c072edf3-5800-4c7b-939a-107508981bf0",
         "name": "CLeVer"
     }
+    bot_framework_options = dict(service_url="https://smba.trafficmanager.net/apis/", timeout=10.0, connect_timeout=5.0,
+                                 max_connections=100, max_keepalive_connections=20, http2=True,
+                                 token_refresh_margin=300.0, tenant_rate=30.0, tenant_burst=30)
+    broadcast_concurrency = 16
+    ingestion_mode = "sync"
+    dedup_on = True
+    dedup_options = dict(max_size=10000, ttl=600.0, db=None)
+    ingestion_workers = 8
+    ingestion_queue_size = 10000
+    outbound_on = False
+    outbound_options = dict(concurrency=16, max_attempts=5, base_delay=0.5, max_delay=30.0,
+                            dead_letter_path="database/dead_letter.ndjson")
 
     user_db = "database/test_db.db"
+    persistence_mode = "sync"
+    persistence_batch_size = 32
+    persistence_flush_interval = 1.0
+    storage_mode = "full"
+    snapshot_interval = 20
+    db_options = dict(journal_mode="wal", synchronous="normal", cache_size=-16000, mmap_size=268435456, readers=4)
+    retention_on = False
+    retention_days = 180
+    retention_interval = 86400
+    archive_path = "database/archive/"
 
     version = "v0.0"
 
+    inference_workers = 4
+    nlu_batch_size = 32
+    rest_batch_limit = 256
+    websocket_max_pending = 16
+
     base_action_class = BaseActionClass
 
     arm_on = False
     arm_socket = "http://10.0.0.100:8088"
     host_link = "http://bf34aef733a4.ap.ngrok.io"
     images_path = "WeiBot/app/images"
+    image_cache_size = 16
+    u2u_ttl = 180.0
 
     default_config_path = "config/default_config.yml"
     high_level_config_path = "config/high_level_config.yml"
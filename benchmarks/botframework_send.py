@@ -0,0 +1,62 @@
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+sys.path.append(os.getcwd())
+
+from benchmarks.botframework_stand_in import StandInServer
+from channels.botframework import BotFramework
+
+BOT = {"id": "28:stand-in-bot", "name": "Stand-in"}
+
+
+async def run(messages: int, concurrency: int, latency: float):
+    """
+    Send messages to the stand-in connector with bounded concurrency and report throughput and latency
+
+    :param messages: int - number of messages
+    :param concurrency: int - number of messages in flight
+    :param latency: float - response delay of the stand-in, in seconds
+    :return: None
+    """
+    server = StandInServer(latency=latency)
+    await server.start()
+
+    bot_framework = BotFramework("app-id", "app-password", BOT, service_url=server.url, oauth2_url=server.url[:-1])
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def send_one(index: int):
+        async with semaphore:
+            start = time.perf_counter()
+            await bot_framework.send_text_message(recipient_id=BOT["id"], user_name="User",
+                                                  conversation={"id": f"29:user-{index % 100}"},
+                                                  text="Your annual leave balance is 12 days")
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[send_one(index) for index in range(messages)])
+    elapsed = time.perf_counter() - start
+
+    await bot_framework.close()
+    await server.close()
+
+    latencies.sort()
+    print(f"messages: {messages}, concurrency: {concurrency}, stand-in latency: {latency * 1000:.1f} ms")
+    print(f"throughput: {messages / elapsed:.0f} messages/s")
+    print(f"latency p50: {statistics.median(latencies) * 1000:.2f} ms, "
+          f"p95: {latencies[int(len(latencies) * 0.95) - 1] * 1000:.2f} ms")
+    print(f"stand-in: {server.stats()}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Outbound throughput of the BotFramework channel")
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--latency", type=float, default=0.005, help="response delay of the stand-in, in seconds")
+    args = parser.parse_args()
+
+    asyncio.run(run(args.messages, args.concurrency, args.latency))
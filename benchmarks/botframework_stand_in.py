@@ -0,0 +1,178 @@
+import argparse
+import asyncio
+import json
+import random
+import re
+from typing import Dict, List, Any, Optional, Tuple
+
+ACTIVITY_PATH = re.compile(r"^/v3/conversations/(?P<conversation>[^/]+)/activities$")
+
+TOKEN_PATH = "/botframework.com/oauth2/v2.0/token"
+
+STATUS_TEXT = {200: "OK", 201: "Created", 404: "Not Found", 429: "Too Many Requests", 500: "Internal Server Error",
+               503: "Service Unavailable"}
+
+
+class StandInServer:
+    """
+    Local stand-in for the BotFramework connector and token service, an HTTP/1.1 keep-alive server on asyncio,
+    so the outbound path of the Skype channel can be load-tested offline:
+    + POST /botframework.com/oauth2/v2.0/token - returns a token that expires in token_lifetime seconds
+    + POST /v3/conversations/{id}/activities - records the activity and returns its id
+    point BotFramework(service_url=server.url, oauth2_url=server.url[:-1]) to it
+    """
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, latency: float = 0.0, error_rate: float = 0.0,
+                 error_status: int = 503, token_lifetime: int = 3600, token_latency: float = 0.0):
+        """
+        Create stand-in server
+        :param host: str - address to listen on
+        :param port: int - port to listen on, 0 picks a free port
+        :param latency: float - seconds before every response
+        :param error_rate: float - fraction of the activities answered with error_status
+        :param error_status: int - status of the failed activities, 429 also sends Retry-After
+        :param token_lifetime: int - expires_in of the tokens, in seconds
+        :param token_latency: float - extra seconds before the token responses
+        """
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.token_lifetime = token_lifetime
+        self.token_latency = token_latency
+
+        self.server: Optional[asyncio.AbstractServer] = None
+
+        self.connections = 0
+        self.token_requests = 0
+        self.requests = 0
+        self.errors = 0
+        # accepted activities of every conversation in arrival order
+        self.activities: Dict[str, List[Dict[str, Any]]] = dict()
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.host}:{self.port}/"
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._serve, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def close(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+
+    def stats(self) -> Dict[str, Any]:
+        return dict(
+            connections=self.connections,
+            token_requests=self.token_requests,
+            requests=self.requests,
+            errors=self.errors,
+            activities=sum(len(activities) for activities in self.activities.values())
+        )
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.connections += 1
+
+        try:
+            while True:
+                try:
+                    head = await reader.readuntil(b"\r\n\r\n")
+
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    return
+
+                lines = head.decode("latin-1").split("\r\n")
+                method, path, _ = lines[0].split(" ", 2)
+                headers = {name.strip().lower(): value.strip() for name, value in
+                           (line.split(":", 1) for line in lines[1:] if ":" in line)}
+
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+
+                if self.latency:
+                    await asyncio.sleep(self.latency)
+
+                if self.token_latency and path == TOKEN_PATH:
+                    await asyncio.sleep(self.token_latency)
+
+                status, response_headers, payload = self._handle(method, path, body)
+                keep_alive = headers.get("connection", "keep-alive").lower() != "close"
+
+                data = json.dumps(payload).encode("utf-8")
+                response_headers = dict(response_headers, **{
+                    "Content-Type": "application/json",
+                    "Content-Length": str(len(data)),
+                    "Connection": "keep-alive" if keep_alive else "close"
+                })
+
+                writer.write(f"HTTP/1.1 {status} {STATUS_TEXT.get(status, 'Unknown')}\r\n".encode("latin-1") +
+                             "".join(f"{name}: {value}\r\n" for name, value in response_headers.items())
+                             .encode("latin-1") + b"\r\n" + data)
+                await writer.drain()
+
+                if not keep_alive:
+                    return
+
+        finally:
+            writer.close()
+
+    def _handle(self, method: str, path: str, body: bytes) -> Tuple[int, Dict[str, str], Dict[str, Any]]:
+        """
+        Answer one request
+        :return: tuple(status, headers, payload)
+        """
+        self.requests += 1
+
+        if method == "POST" and path == TOKEN_PATH:
+            self.token_requests += 1
+            return 200, dict(), dict(token_type="Bearer", expires_in=self.token_lifetime,
+                                     access_token=f"stand-in-token-{self.token_requests}")
+
+        match = ACTIVITY_PATH.match(path)
+        if method != "POST" or match is None:
+            return 404, dict(), dict(error=f"{method} {path} is not served by the stand-in")
+
+        if self.error_rate and random.random() < self.error_rate:
+            self.errors += 1
+            return self.error_status, {"Retry-After": "1"} if self.error_status == 429 else dict(), dict(
+                error=dict(code="ServiceError", message="stand-in failure"))
+
+        activities = self.activities.setdefault(match.group("conversation"), [])
+        activities.append(json.loads(body or b"{}"))
+
+        return 200, dict(), dict(id=f"{match.group('conversation')}|{len(activities)}")
+
+
+async def main(args):
+    server = StandInServer(args.host, args.port, latency=args.latency, error_rate=args.error_rate,
+                           error_status=args.error_status, token_lifetime=args.token_lifetime,
+                           token_latency=args.token_latency)
+    await server.start()
+    print(f"BotFramework stand-in on {server.url}, set service_url={server.url!r} and oauth2_url={server.url[:-1]!r}")
+
+    try:
+        while True:
+            await asyncio.sleep(10)
+            print(server.stats())
+
+    finally:
+        await server.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local stand-in for the BotFramework connector and token service")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=3980)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds before every response")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of the activities that fail")
+    parser.add_argument("--error-status", type=int, default=503, help="status of the failed activities")
+    parser.add_argument("--token-lifetime", type=int, default=3600, help="expires_in of the tokens")
+    parser.add_argument("--token-latency", type=float, default=0.0, help="extra seconds before the token responses")
+
+    try:
+        asyncio.run(main(parser.parse_args()))
+
+    except KeyboardInterrupt:
+        pass
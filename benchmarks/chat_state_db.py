@@ -0,0 +1,118 @@
+import json
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import datetime
+from typing import Dict, Any, List
+
+sys.path.append(os.getcwd())
+
+from database.database import ChatStateDB
+
+ROWS = 5000
+USERS = 100
+
+
+class LegacyChatStateDB(ChatStateDB):
+    """
+    The previous data access: SQL built with f-strings and single quotes escaped in the JSON columns
+    """
+    REPLACE = {"'": "__single_quote__"}
+    REVERT = {"__single_quote__": "'"}
+
+    def __init__(self, db: str):
+        self.conn = sqlite3.connect(db)
+        self.create_table()
+
+    @staticmethod
+    def convert(text: str, dictionary: Dict[str, str]) -> str:
+        for key, value in dictionary.items():
+            text = text.replace(key, value)
+
+        return text
+
+    def insert_table(self, user_id: str, user_name: str, version: str, intent: Dict[str, Any], slots: Dict[str, Any],
+                     entities: List[Dict[str, Any]], events: Dict[str, Any], button: Dict[str, Any],
+                     loop_stack: int = 0, response: Dict[str, Any] = None, synonym_dict: Dict[str, Any] = None,
+                     **kwargs):
+        intent, entities, slots, events, button, response, synonym_dict = [
+            None if value is None else self.convert(value, self.REPLACE)
+            for value in self.dump_data(intent, entities, slots, events, button, response, synonym_dict)]
+
+        sql_statement = f"""INSERT INTO chat_state (user_id, user_name, version, intent, slots, entities, timestamp, events, button, loop_stack, response, synonym_dict) 
+                            VALUES ('{user_id}', '{user_name}', '{version}', '{intent}', '{slots}', '{entities}', {datetime.today().timestamp()}, '{events}', {("'" + button + "'") if button else "NULL"}, {loop_stack}, {"'" + response + "'" if response else "NULL"}, {"'" + synonym_dict + "'" if synonym_dict else "NULL"})"""
+
+        self.conn.cursor().execute(sql_statement)
+        self.conn.commit()
+
+        result = self.conn.cursor().execute(f"""SELECT * FROM user_status 
+                                    WHERE user_id = '{user_id}'
+                                    ORDER BY id DESC LIMIT 1""").fetchone()
+        if result is None:
+            self.conn.cursor().execute(f"""INSERT INTO user_status (user_id, user_name, u2u, timestamp, floor) VALUES ('{user_id}', '{user_name}', FALSE, {datetime.today().timestamp()}, 'not set')""")
+            self.conn.commit()
+
+    def fetch_chat_state(self, user_id: str) -> Dict[str, Any]:
+        row = self.conn.cursor().execute(f"""SELECT * FROM chat_state 
+                            WHERE user_id = '{user_id}'
+                            ORDER BY id DESC LIMIT 1""").fetchone()
+
+        row = list(row)
+        for index in [4, 5, 6, 8, 9, 11, 12]:
+            if row[index] is not None:
+                row[index] = self.convert(row[index], self.REVERT)
+
+        return self._to_chat_state(row)
+
+
+def make_state(index: int) -> Dict[str, Any]:
+    return dict(
+        user_id=f"29:user-{index % USERS}",
+        user_name=f"User {index % USERS}",
+        version="v0.0",
+        intent=dict(text=f"what's my annual leave? ({index})", name="AnnualLeaveApplicationProcess", priority=0,
+                    intent_ranking={f"intent_{i}": i / 10 for i in range(10)}),
+        slots=dict(working_type="office hours", start_session="start"),
+        entities=[],
+        events=dict(set_slot=dict(start_session="start")),
+        button={option: dict(set_slot=dict(working_type=option), action="ask_annual_leave")
+                for option in ["office hours", "shift", "part time"]},
+        loop_stack=0,
+        response=dict(text="What's your working type?", button=["office hours", "shift", "part time"]),
+        synonym_dict={synonym: option for option in ["office hours", "shift", "part time"]
+                      for synonym in [option, option.upper(), f"{option} work", f"i work {option}"]}
+    )
+
+
+def run(db: ChatStateDB, states: List[Dict[str, Any]]) -> Dict[str, float]:
+    start = time.perf_counter()
+    for state in states:
+        db.insert_table(**state)
+    insert_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for index in range(len(states)):
+        db.fetch_chat_state(user_id=f"29:user-{index % USERS}")
+    fetch_time = time.perf_counter() - start
+
+    return dict(insert=len(states) / insert_time, fetch=len(states) / fetch_time)
+
+
+if __name__ == "__main__":
+    states = [make_state(index) for index in range(ROWS)]
+
+    with tempfile.TemporaryDirectory() as folder:
+        legacy = run(LegacyChatStateDB(os.path.join(folder, "legacy.db")), states)
+        current = run(ChatStateDB(os.path.join(folder, "current.db")), states)
+        events = run(ChatStateDB(os.path.join(folder, "events.db"), storage="events"), states)
+
+        sizes = {name: os.path.getsize(os.path.join(folder, f"{name}.db")) for name in ["current", "events"]}
+
+    print(f"{ROWS} turns of {USERS} users")
+    for name in ["insert", "fetch"]:
+        print(f"    {name}: legacy {legacy[name]:8.0f} rows/s, current {current[name]:8.0f} rows/s "
+              f"({current[name] / legacy[name]:.2f}x), events storage {events[name]:8.0f} rows/s")
+
+    print(f"    size: full storage {sizes['current'] / 1024:.0f} kB, events storage {sizes['events'] / 1024:.0f} kB")
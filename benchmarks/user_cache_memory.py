@@ -0,0 +1,114 @@
+import gc
+import json
+import os
+import sys
+import tracemalloc
+from typing import Dict, Any, List
+
+sys.path.append(os.getcwd())
+
+from controller.server_controller import UserConversations
+from parsers.event import ButtonTrigger
+from parsers.flow_map import FlowMap
+from app.setting.setting import Setting
+
+USERS = 10000
+
+
+def make_rows(flow_map: FlowMap, users: int) -> List[str]:
+    """
+    Create the JSON rows of cached users, like they are stored in chat_state
+
+    :param flow_map: FlowMap - flow map of chatbot
+    :param users: int - number of users
+    :return: list(str) - one JSON row per user
+    """
+    button_events = [trigger for action_map in flow_map.actions_map.values()
+                     for trigger in action_map.export()["triggers"] if "button" in trigger]
+
+    rows = []
+    for index in range(users):
+        intent_name = flow_map.intents_list[index % len(flow_map.intents_list)]
+        ranking = {name: (index + position) % 97 / 97 for position, name in enumerate(flow_map.intents_list)}
+
+        row = dict(
+            user_id=f"29:user-{index}",
+            user_name=f"User {index}",
+            version=Setting.version,
+            intent=dict(text="how many days of annual leave do I have", name=intent_name, intent_ranking=ranking,
+                        priority=0),
+            entities=[],
+            slots={slot: None for slot in flow_map.slots_list[:4]},
+            events=dict(set_slot={flow_map.slots_list[0]: "start"}),
+            button=None,
+            loop_stack=0,
+            response=dict(text="What is your working type?", button=["office hours", "shift"]),
+            synonym_dict=None,
+            fingerprint=flow_map.fingerprint
+        )
+
+        if button_events:
+            button = button_events[index % len(button_events)]["button"]
+            row["button"] = {b["title"]: {k: v for k, v in b.items() if k not in ["title", "synonym"]}
+                             for b in button["button"]}
+            row["synonym_dict"] = {s: b["title"] for b in button["button"] for s in b.get("synonym", [])}
+
+        rows.append(json.dumps(row))
+
+    return rows
+
+
+def measure(build) -> int:
+    """
+    Measure the memory that is still allocated by the result of build
+
+    :param build: function - create the cached users
+    :return: int - allocated bytes
+    """
+    gc.collect()
+    tracemalloc.start()
+    result = build()
+    gc.collect()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+
+    return size
+
+
+def decoded_rows(rows: List[str], flow_map: FlowMap) -> List[Dict[str, Any]]:
+    """
+    Plain dictionaries and one ButtonTrigger map per user, the representation before the compact state
+    """
+    users = []
+    for row in rows:
+        data = json.loads(row)
+        if data["button"] is not None:
+            data["button"] = {k: ButtonTrigger(v, flow_map.entities_list, flow_map.intents_list, flow_map.slots_list)
+                              for k, v in data["button"].items()}
+        users.append(data)
+
+    return users
+
+
+def cached_states(rows: List[str], user_conversations: UserConversations):
+    """
+    ConversationState objects, like they are stored in UserConversations.user_queue
+    """
+    return [user_conversations._create_state(json.loads(row)) for row in rows]
+
+
+if __name__ == "__main__":
+    flow_map = FlowMap(Setting.flow_config, Setting.domain_config)
+    user_conversations = UserConversations(db=":memory:", entities_list=flow_map.entities_list,
+                                           intents_list=flow_map.intents_list, slots_list=flow_map.slots_list,
+                                           fingerprint=flow_map.fingerprint)
+
+    rows = make_rows(flow_map, USERS)
+
+    plain = measure(lambda: decoded_rows(rows, flow_map))
+    compact = measure(lambda: cached_states(rows, user_conversations))
+
+    print(f"{USERS} cached users")
+    print(f"    plain dictionaries: {plain / USERS:10.0f} bytes per user")
+    print(f"    ConversationState:  {compact / USERS:10.0f} bytes per user ({compact / plain:.0%})")
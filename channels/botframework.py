@@ -1,72 +1,159 @@
+import asyncio
+import importlib.util
 import json
-from datetime import datetime, timedelta
-import requests
+import random
+import httpx
 
-from typing import Dict, List, Any, Optional
+from typing import Dict, List, Any, Tuple, Optional
+
+from channels.oauth import TokenManager
+from channels.ratelimit import TokenBucket
 
 MICROSOFT_OAUTH2_URL = "https://login.microsoftonline.com"
 
 MICROSOFT_OAUTH2_PATH = "botframework.com/oauth2/v2.0/token"
 
+BOTFRAMEWORK_SERVICE_URL = "https://smba.trafficmanager.net/apis/"
+
+# httpx only speaks HTTP/2 with the optional h2 package (pip install httpx[http2])
+HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
+
+# responses that are worth sending again later, the other errors would fail the same way again
+RETRY_STATUSES = {408, 429, 500, 502, 503, 504}
+
+
+class DeliveryError(RuntimeError):
+    """Error of an outbound request, with what is needed to decide on a retry"""
+    def __init__(self, message: str, status: int = None, retry_after: float = None):
+        """
+        Create delivery error
+
+        :param message: str - error message
+        :param status: optional(int) - HTTP status, None when the server was not reached
+        :param retry_after: optional(float) - seconds asked by the Retry-After header
+        """
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+    @property
+    def retryable(self) -> bool:
+        return self.status is None or self.status in RETRY_STATUSES
+
+    @classmethod
+    def from_response(cls, message: str, response: httpx.Response) -> "DeliveryError":
+        retry_after = response.headers.get("Retry-After", None)
+
+        return cls(f"{message}. response {response.status_code} {response.text}", status=response.status_code,
+                   retry_after=float(retry_after) if retry_after and retry_after.isdigit() else None)
+
 
 class BotFramework:
     """BotFramework that handle input and output from Azure service"""
-    def __init__(self, app_id: str, app_password: str, bot: Dict[str, Any]):
+    def __init__(self, app_id: str, app_password: str, bot: Dict[str, Any],
+                 service_url: str = BOTFRAMEWORK_SERVICE_URL, oauth2_url: str = MICROSOFT_OAUTH2_URL,
+                 timeout: float = 10.0, connect_timeout: float = 5.0, max_connections: int = 100,
+                 max_keepalive_connections: int = 20, keepalive_expiry: float = 30.0, http2: bool = True,
+                 token_refresh_margin: float = 300.0, tenant_rate: float = 30.0, tenant_burst: int = 30):
         """
         Create botframework
 
         :param app_id: str - app id
         :param app_password: str - app password
         :param bot: dict() - bot information
+        :param service_url: str - url of the BotFramework connector, e.g. a local stand-in server for load tests
+        :param oauth2_url: str - url of the token service
+        :param timeout: float - seconds to wait for a response (read, write and pool)
+        :param connect_timeout: float - seconds to wait for a new connection
+        :param max_connections: int - maximum number of open connections
+        :param max_keepalive_connections: int - number of idle connections kept open for the next messages
+        :param keepalive_expiry: float - seconds an idle connection is kept open
+        :param http2: bool - use HTTP/2 when the h2 package is installed and the server supports it
+        :param token_refresh_margin: float - seconds before its expiry the token is refreshed
+        :param tenant_rate: float - requests per second of send_bulk to the conversations of one tenant
+        :param tenant_burst: int - requests of send_bulk sent at once before tenant_rate applies
         """
-        self.token_expiration_date = datetime.now()
-        self.headers = None
-        self.service_url = "https://smba.trafficmanager.net/apis/"
-        self.oauth2_url = "https://login.microsoftonline.com"
-        self.oauth2_path = "botframework.com/oauth2/v2.0/token"
+        self.service_url = service_url
+        self.oauth2_url = oauth2_url
+        self.oauth2_path = MICROSOFT_OAUTH2_PATH
         self.app_id = app_id
         self.app_password = app_password
         self.global_uri = f"{self.service_url}v3/"
         self.bot = bot
 
-    async def _get_headers(self) -> Optional[Dict[str, Any]]:
+        self.tokens = TokenManager(self._request_token, refresh_margin=token_refresh_margin)
+
+        self.tenant_rate = tenant_rate
+        self.tenant_burst = tenant_burst
+        self.rate_limiters: Dict[str, TokenBucket] = dict()
+
+        # OutboundQueue of the messages, None sends them directly
+        self.outbound = None
+
+        # one client for all the requests, so the TLS connections are kept alive between messages
+        self.client = httpx.AsyncClient(
+            timeout=httpx.Timeout(timeout, connect=connect_timeout),
+            limits=httpx.Limits(max_connections=max_connections,
+                                max_keepalive_connections=max_keepalive_connections,
+                                keepalive_expiry=keepalive_expiry),
+            http2=http2 and HTTP2_AVAILABLE
+        )
+
+    async def _post(self, uri: str, **kwargs) -> httpx.Response:
+        """
+        POST with the pooled client, connection errors and timeouts are raised as DeliveryError
         """
-        Get the authorization headers if not available
+        try:
+            return await self.client.post(uri, **kwargs)
 
-        :return: dict() - the headers
+        except httpx.HTTPError as ex:
+            raise DeliveryError(f"Cannot reach {uri} by error {ex!r}")
+
+    async def _request_token(self) -> Tuple[str, float]:
         """
-        if self.token_expiration_date < datetime.now():
-            uri = f"{self.oauth2_url}/{self.oauth2_path}"
-            grant_type = "client_credentials"
-            scope = "https://api.botframework.com/.default"
-            payload = {
-                "client_id": self.app_id,
-                "client_secret": self.app_password,
-                "grant_type": grant_type,
-                "scope": scope,
-            }
+        Request a new token from the token service
 
-            token_response = requests.post(uri, data=payload)
+        :return: tuple(access token, seconds until expiry)
+        """
+        uri = f"{self.oauth2_url}/{self.oauth2_path}"
+        grant_type = "client_credentials"
+        scope = "https://api.botframework.com/.default"
+        payload = {
+            "client_id": self.app_id,
+            "client_secret": self.app_password,
+            "grant_type": grant_type,
+            "scope": scope,
+        }
 
-            if token_response.ok:
-                token_data = token_response.json()
-                access_token = token_data["access_token"]
-                token_expiration = token_data["expires_in"]
+        token_response = await self._post(uri, data=payload)
 
-                delta = timedelta(seconds=int(token_expiration))
-                self.token_expiration_date = datetime.now() + delta
+        if not token_response.is_success:
+            raise DeliveryError.from_response("Cannot get BotFramework token", token_response)
 
-                self.headers = {
-                    "content-type": "application/json",
-                    "Authorization": "Bearer %s" % access_token,
-                }
+        token_data = token_response.json()
 
-                return self.headers
-            else:
-                raise RuntimeError(f"Cannot get BotFramework token")
+        return token_data["access_token"], float(token_data["expires_in"])
 
-        else:
-            return self.headers
+    async def _get_headers(self) -> Optional[Dict[str, Any]]:
+        """
+        Get the authorization headers, the token is refreshed ahead of its expiry by the token manager
+
+        :return: dict() - the headers
+        """
+        access_token = await self.tokens.get_token()
+
+        return {
+            "content-type": "application/json",
+            "Authorization": "Bearer %s" % access_token,
+        }
+
+    async def start(self):
+        """
+        Get the first token and start refreshing it in the background
+
+        :return: None
+        """
+        await self.tokens.start()
 
     def prepare_message(self, recipient_id: str, user_name: str, message_data: Dict[str, Any]) -> Dict[str, Any]:
         """
@@ -93,7 +180,21 @@ class BotFramework:
 
     async def send(self, message_data: Dict[str, Any], conversation) -> None:
         """
-        send message to Azure
+        send message to Azure, through the outbound queue when there is one
+
+        :param message_data: dict() - message data
+        :param conversation: dict() - the conversation to send
+        :return: None
+        """
+        if self.outbound is not None:
+            self.outbound.enqueue(message_data, conversation)
+            return
+
+        await self.deliver(message_data, conversation)
+
+    async def deliver(self, message_data: Dict[str, Any], conversation) -> None:
+        """
+        POST message to Azure now
 
         :param message_data: dict() - message data
         :param conversation: dict() - the conversation to send
@@ -104,14 +205,48 @@ class BotFramework:
         )
         headers = await self._get_headers()
 
-        send_response = requests.post(
-            post_message_uri, headers=headers, data=json.dumps(message_data)
-        )
+        send_response = await self._post(post_message_uri, headers=headers, content=json.dumps(message_data))
+
+        if not send_response.is_success:
+            raise DeliveryError.from_response("Error truing to send BotFramework message", send_response)
+
+    def build_activities(self, user_name: str, conversation: Dict[str, Any], text: str, image: str = None,
+                         buttons: List[str] = None) -> List[Dict[str, Any]]:
+        """
+        Activities of one reply: a hero card when there are buttons, otherwise one activity per paragraph of text,
+        the image is attached to the first one instead of being sent on its own
+
+        :param user_name: str - user name
+        :param conversation: dict(id) - conversation of the reply
+        :param text: str - text message
+        :param image: optional(str) - url of image
+        :param buttons: optional(list(str)) - list of selection
+        :return: list(dict) - activities in sending order
+        """
+        image_card = None if not image else {
+            "contentType": "application/vnd.microsoft.card.hero",
+            "content": {"images": [{"url": image}]},
+        }
+
+        if buttons is not None:
+            hero_content = {
+                "contentType": "application/vnd.microsoft.card.hero",
+                "content": {"title": text.replace("__user__", user_name),
+                            "buttons": [{"type": "imBack", "value": button, "title": button} for button in buttons]},
+            }
+
+            activities = [{"attachments": [hero_content]}]
+
+        else:
+            activities = [{"text": message_part} for message_part in text.strip().split("\n\n")]
 
-        if not send_response.ok:
-            raise RuntimeError(f"Error truing to send BotFramework message. response {send_response.text}")
+        if image_card is not None:
+            activities[0]["attachments"] = [image_card] + activities[0].get("attachments", [])
 
-    async def send_text_message(self, recipient_id: str, user_name: str, conversation: Dict[str, Any], text: str) -> None:
+        return [self.prepare_message(conversation["id"], user_name, activity) for activity in activities]
+
+    async def send_text_message(self, recipient_id: str, user_name: str, conversation: Dict[str, Any], text: str,
+                                image: str = None) -> None:
         """
         Send normal text message
 
@@ -119,11 +254,10 @@ class BotFramework:
         :param user_name: str - user name
         :param conversation: dict(id) - conversation from skype request
         :param text: str - text message
+        :param image: optional(str) - url of image sent with the first paragraph
         :return: None
         """
-        for message_part in text.strip().split("\n\n"):
-            text_message = {"text": message_part}
-            message = self.prepare_message(conversation["id"], user_name, text_message)
+        for message in self.build_activities(user_name, conversation, text, image=image):
             await self.send(message, conversation)
 
     async def send_image_url(self, recipient_id: str, user_name: str, conversation: Dict[str, Any], image: str) -> None:
@@ -156,24 +290,79 @@ class BotFramework:
         :param buttons: list(str) - list of selection
         :return: None
         """
-        buttons = [{
-            "type": "imBack",
-            "value": button,
-            "title": button
-            }
-            for button in buttons
-        ]
+        for message in self.build_activities(user_name, conversation, text, buttons=buttons):
+            await self.send(message, conversation)
 
-        text = text.replace("__user__", user_name)
+    async def send_bulk(self, messages: List[Dict[str, Any]], concurrency: int = 16,
+                        max_attempts: int = 3) -> List[Dict[str, Any]]:
+        """
+        Send many messages now, recipients in parallel with bounded concurrency and the rate limit of their tenant,
+        the activities of one recipient in order. Throttled and failed requests are retried with backoff
+
+        :param messages: list(dict(conversation, user_name, text, image, buttons)) - one message per recipient,
+                         conversation is dict(id, tenantId)
+        :param concurrency: int - number of recipients sent at the same time
+        :param max_attempts: int - attempts of each request
+        :return: list(dict(conversation_id, status, sent, error)) - result of every message in the input order,
+                 status is sent or failed and sent is the number of activities delivered
+        """
+        if concurrency < 1:
+            raise ValueError(f"concurrency must be a positive number, not {concurrency}")
 
-        hero_content = {
-            "contentType": "application/vnd.microsoft.card.hero",
-            "content": {"title": text, "buttons": buttons},
-        }
+        semaphore = asyncio.Semaphore(concurrency)
 
-        buttons_message = {"attachments": [hero_content]}
-        message = self.prepare_message(conversation["id"], user_name, buttons_message)
-        await self.send(message, conversation)
+        async def send_one(message: Dict[str, Any]) -> Dict[str, Any]:
+            conversation = message["conversation"]
+            result = dict(conversation_id=conversation["id"], status="sent", sent=0, error=None)
+
+            async with semaphore:
+                try:
+                    activities = self.build_activities(message.get("user_name", ""), conversation,
+                                                       message.get("text", ""), image=message.get("image", None),
+                                                       buttons=message.get("buttons", None))
+
+                    for activity in activities:
+                        await self._deliver_limited(activity, conversation, max_attempts)
+                        result["sent"] += 1
+
+                except Exception as ex:
+                    result.update(status="failed", error=str(ex))
+
+            return result
+
+        return await asyncio.gather(*[send_one(message) for message in messages])
+
+    async def _deliver_limited(self, message_data: Dict[str, Any], conversation: Dict[str, Any], max_attempts: int):
+        """
+        Deliver under the rate limit of the tenant of conversation, retry the retryable errors
+        """
+        tenant = conversation.get("tenantId", None) or "default"
+        limiter = self.rate_limiters.get(tenant, None)
+        if limiter is None:
+            limiter = TokenBucket(self.tenant_rate, self.tenant_burst)
+            self.rate_limiters[tenant] = limiter
+
+        for attempt in range(1, max_attempts + 1):
+            await limiter.acquire()
+
+            try:
+                return await self.deliver(message_data, conversation)
+
+            except DeliveryError as ex:
+                if not ex.retryable or attempt == max_attempts:
+                    raise
+
+                delay = random.uniform(0, 0.5 * 2 ** (attempt - 1))
+                await asyncio.sleep(max(delay, ex.retry_after or 0.0))
+
+    async def close(self):
+        """
+        Stop the token refresh and close the pooled connections
+
+        :return: None
+        """
+        await self.tokens.close()
+        await self.client.aclose()
 
     @staticmethod
     def translate_botframework_input(user_input: Dict[str, Any]):
@@ -181,19 +370,22 @@ class BotFramework:
         Translate the request from skype to minimize form
 
         :param user_input: dict() - request from skupe
-        :return: dict() - data to process
+        :return: dict(text, id, user_name, conversation, recipient_id, activity_id) - data to process, activity_id is
+                 the same for the retries of an activity
         """
         text = user_input["text"]
         id = user_input["from"]["id"]
         user_name = user_input["from"]["name"]
         conversation = user_input["conversation"]
         recipient_id = user_input["recipient"]["id"]
+        activity_id = user_input.get("id", None)
 
         return dict(
             text=text,
             id=id,
             user_name=user_name,
             conversation=conversation,
-            recipient_id=recipient_id
+            recipient_id=recipient_id,
+            activity_id=None if activity_id is None else f"{conversation['id']}|{activity_id}"
         )
 
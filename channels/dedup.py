@@ -0,0 +1,189 @@
+import asyncio
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, Optional
+
+from database.pool import connect
+
+CREATE_SEEN_ACTIVITY = """CREATE TABLE IF NOT EXISTS seen_activity (
+                          id text PRIMARY KEY,
+                          expires float NOT NULL
+                          ) WITHOUT ROWID"""
+
+# changes one row when the id is new or its previous record expired, no row when it is a duplicate
+RECORD_SEEN_ACTIVITY = """INSERT INTO seen_activity (id, expires) VALUES (?, ?)
+                          ON CONFLICT (id) DO UPDATE SET expires = excluded.expires WHERE seen_activity.expires < ?"""
+
+DELETE_SEEN_ACTIVITY = """DELETE FROM seen_activity WHERE id = ?"""
+
+PURGE_SEEN_ACTIVITY = """DELETE FROM seen_activity WHERE expires < ?"""
+
+# number of recorded ids between two purges of the expired rows
+PURGE_INTERVAL = 1000
+
+
+class SeenCache:
+    """
+    Bounded, time-windowed set of the inbound activity ids, so a webhook retried by the channel is only processed
+    once. The ids are kept in memory in insertion order (LRU eviction and TTL expiry from the oldest end), and
+    optionally in an SQLite table that survives restarts and is shared by the server processes
+    """
+    def __init__(self, max_size: int = 10000, ttl: float = 600.0, db: str = None):
+        """
+        Create cache
+        :param max_size: int - maximum number of ids kept in memory
+        :param ttl: float - seconds an id is remembered
+        :param db: optional(str) - path to SQLite database file of the persisted ids, default is memory only
+        """
+        if max_size < 1:
+            raise ValueError(f"max_size must be a positive number, not {max_size}")
+
+        if ttl <= 0:
+            raise ValueError(f"ttl must be a positive number, not {ttl}")
+
+        self.max_size = max_size
+        self.ttl = ttl
+
+        # id: expiry time
+        self.ids: "OrderedDict[str, float]" = OrderedDict()
+        self.counters = dict(new=0, duplicates=0, evicted=0)
+
+        self.conn = None
+        self._recorded = 0
+        # the writes of seen_async and forget_async run in order on this thread, off the event loop
+        self.writer: Optional[ThreadPoolExecutor] = None
+        if db is not None:
+            self.conn = connect(db)
+            self.conn.execute(CREATE_SEEN_ACTIVITY)
+            self.conn.commit()
+            self.writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="dedup-writer")
+
+    def _expire(self, now: float):
+        # the ids are in insertion order, so the expired ones are at the front (up to the ids moved by a hit)
+        while self.ids:
+            activity_id, expires = next(iter(self.ids.items()))
+            if expires >= now:
+                return
+
+            del self.ids[activity_id]
+
+    def _hit(self, activity_id: str, now: float) -> bool:
+        self._expire(now)
+
+        expires = self.ids.get(activity_id, None)
+        if expires is not None and expires >= now:
+            # a retried id is likely retried again, keep it away from the eviction end
+            self.ids.move_to_end(activity_id)
+            self.counters["duplicates"] += 1
+            return True
+
+        return False
+
+    def _record(self, activity_id: str, now: float) -> bool:
+        """
+        Record the id in the database
+        :return: bool - the id is new, False if another process or the previous run recorded it within ttl
+        """
+        c = self.conn.execute(RECORD_SEEN_ACTIVITY, (activity_id, now + self.ttl, now))
+
+        self._recorded += 1
+        if self._recorded % PURGE_INTERVAL == 0:
+            self.conn.execute(PURGE_SEEN_ACTIVITY, (now,))
+
+        self.conn.commit()
+
+        return c.rowcount > 0
+
+    def _accept(self, activity_id: str, now: float, new: bool) -> bool:
+        # a duplicate found in the database is kept in memory too, for the next retries
+        self._remember(activity_id, now)
+        self.counters["new" if new else "duplicates"] += 1
+
+        return not new
+
+    def seen(self, activity_id: str) -> bool:
+        """
+        Record the id and tell if it was already recorded within ttl
+        :param activity_id: str - id of the activity
+        :return: bool - the activity is a duplicate
+        """
+        now = time.time()
+        if self._hit(activity_id, now):
+            return True
+
+        return self._accept(activity_id, now, self.conn is None or self._record(activity_id, now))
+
+    async def seen_async(self, activity_id: str) -> bool:
+        """
+        Awaitable seen, the database write runs on the writer thread
+        :param activity_id: str - id of the activity
+        :return: bool - the activity is a duplicate
+        """
+        now = time.time()
+        if self._hit(activity_id, now):
+            return True
+
+        if self.conn is None:
+            return self._accept(activity_id, now, True)
+
+        # the retries that arrive meanwhile are all checked by the database, only one of them is new
+        new = await asyncio.get_running_loop().run_in_executor(self.writer, self._record, activity_id, now)
+
+        return self._accept(activity_id, now, new)
+
+    def _remember(self, activity_id: str, now: float):
+        self.ids[activity_id] = now + self.ttl
+        self.ids.move_to_end(activity_id)
+
+        if len(self.ids) > self.max_size:
+            self.ids.popitem(last=False)
+            self.counters["evicted"] += 1
+
+    def forget(self, activity_id: str):
+        """
+        Remove the id, so a retry of an activity that failed is processed again
+        :param activity_id: str - id of the activity
+        :return: None
+        """
+        self.ids.pop(activity_id, None)
+
+        if self.conn is not None:
+            self._delete(activity_id)
+
+    async def forget_async(self, activity_id: str):
+        """
+        Awaitable forget, the database write runs on the writer thread
+        :param activity_id: str - id of the activity
+        :return: None
+        """
+        self.ids.pop(activity_id, None)
+
+        if self.conn is not None:
+            await asyncio.get_running_loop().run_in_executor(self.writer, self._delete, activity_id)
+
+    def _delete(self, activity_id: str):
+        self.conn.execute(DELETE_SEEN_ACTIVITY, (activity_id,))
+        self.conn.commit()
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Number of ids in memory and counters
+        :return: dict(size, max_size, ttl, persisted, new, duplicates, evicted)
+        """
+        return dict(
+            size=len(self.ids),
+            max_size=self.max_size,
+            ttl=self.ttl,
+            persisted=self.conn is not None,
+            **self.counters
+        )
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.shutdown(wait=True)
+            self.writer = None
+
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
@@ -0,0 +1,144 @@
+import asyncio
+import time
+import warnings
+from collections import deque
+from typing import Dict, List, Deque, Any, Callable, Awaitable, Optional
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    if not values:
+        return 0.0
+
+    values = sorted(values)
+
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+class IngestionQueue:
+    """
+    Queue of the inbound activities processed by background workers, so the webhook only validates and enqueues
+    the activity and acknowledges it at once. The workers take the activities in arrival order, and the turns of a
+    user stay in order because the handler puts them into the mailbox of the user before its first await
+    """
+    def __init__(self, handler: Callable[[Dict[str, Any]], Awaitable[Any]], workers: int = 8,
+                 max_size: int = 10000, latency_window: int = 1000):
+        """
+        Create ingestion queue
+        :param handler: async function(activity) - processes one activity
+        :param workers: int - number of background workers
+        :param max_size: int - maximum number of queued activities, the next ones are rejected
+        :param latency_window: int - number of latest activities the latency percentiles are computed on
+        """
+        if workers < 1:
+            raise ValueError(f"workers must be a positive number, not {workers}")
+
+        self.handler = handler
+        self.workers = workers
+        self.max_size = max_size
+
+        self.queue: Optional[asyncio.Queue] = None
+        # enqueue time of the queued activities, oldest first like the queue
+        self.enqueued: Deque[float] = deque()
+        self.wait_times: Deque[float] = deque(maxlen=latency_window)
+        self.processing_times: Deque[float] = deque(maxlen=latency_window)
+        self.counters = dict(accepted=0, rejected=0, processed=0, failed=0)
+        self.busy = 0
+
+        self._tasks: List[asyncio.Task] = []
+
+    async def start(self):
+        """
+        Start the background workers
+        :return: None
+        """
+        if self._tasks:
+            return
+
+        self.queue = asyncio.Queue(maxsize=self.max_size)
+        self._tasks = [asyncio.ensure_future(self._work()) for _ in range(self.workers)]
+
+    def put(self, activity: Dict[str, Any]) -> bool:
+        """
+        Enqueue an activity without waiting
+        :param activity: dict - the activity from the webhook
+        :return: bool - accepted, False when the queue is full or not started
+        """
+        if self.queue is None:
+            return False
+
+        try:
+            self.queue.put_nowait((activity, time.monotonic()))
+
+        except asyncio.QueueFull:
+            self.counters["rejected"] += 1
+            return False
+
+        self.enqueued.append(time.monotonic())
+        self.counters["accepted"] += 1
+
+        return True
+
+    async def _work(self):
+        while True:
+            activity, enqueued = await self.queue.get()
+            self.enqueued.popleft()
+
+            start = time.monotonic()
+            self.wait_times.append(start - enqueued)
+            self.busy += 1
+
+            try:
+                await self.handler(activity)
+                self.counters["processed"] += 1
+
+            except Exception as ex:
+                self.counters["failed"] += 1
+                warnings.warn(f"Cannot process activity by error {ex}")
+
+            finally:
+                self.busy -= 1
+                self.processing_times.append(time.monotonic() - start)
+                self.queue.task_done()
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Queue depth, age of the oldest queued activity and latency percentiles in milliseconds
+        :return: dict
+        """
+        wait_times, processing_times = list(self.wait_times), list(self.processing_times)
+
+        return dict(
+            depth=len(self.enqueued),
+            max_size=self.max_size,
+            oldest_age=time.monotonic() - self.enqueued[0] if self.enqueued else 0.0,
+            workers=self.workers,
+            busy=self.busy,
+            **self.counters,
+            wait_ms=dict(p50=percentile(wait_times, 0.5) * 1000, p95=percentile(wait_times, 0.95) * 1000),
+            processing_ms=dict(p50=percentile(processing_times, 0.5) * 1000,
+                               p95=percentile(processing_times, 0.95) * 1000,
+                               max=max(processing_times, default=0.0) * 1000)
+        )
+
+    async def close(self, timeout: float = 10.0):
+        """
+        Process the queued activities for at most timeout seconds, then stop the workers
+        :param timeout: float - seconds to wait for the queue
+        :return: None
+        """
+        if not self._tasks:
+            return
+
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout=timeout)
+
+        except asyncio.TimeoutError:
+            warnings.warn(f"{len(self.enqueued)} activities are dropped at shutdown")
+
+        for task in self._tasks:
+            task.cancel()
+
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self.queue = None
+        self.enqueued.clear()
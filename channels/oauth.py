@@ -0,0 +1,168 @@
+import asyncio
+import time
+import warnings
+from collections import deque
+from typing import Dict, Deque, Any, Tuple, Callable, Awaitable, Optional
+
+
+class TokenManager:
+    """
+    OAuth token holder that refreshes the token ahead of its expiry in a background task. Callers get the current
+    token without waiting while it is valid, and concurrent callers share one in-flight refresh, so the token
+    endpoint is called once per refresh instead of once per waiting message
+    """
+    def __init__(self, fetch: Callable[[], Awaitable[Tuple[str, float]]], refresh_margin: float = 300.0,
+                 retry_delay: float = 5.0, latency_window: int = 100):
+        """
+        Create token manager
+        :param fetch: async function() - requests a new token, returns (access token, seconds until expiry)
+        :param refresh_margin: float - seconds before the expiry the token is refreshed, at most half its lifetime
+        :param retry_delay: float - seconds between two attempts after a failed refresh
+        :param latency_window: int - number of latest refreshes the latency is reported on
+        """
+        self.fetch = fetch
+        self.refresh_margin = refresh_margin
+        self.retry_delay = retry_delay
+
+        self.token: Optional[str] = None
+        self.expires_at = 0.0
+        self.refresh_at = 0.0
+
+        self.latencies: Deque[float] = deque(maxlen=latency_window)
+        self.counters = dict(refreshes=0, failures=0, waits=0)
+        self.last_error: Optional[str] = None
+
+        self._in_flight: Optional[asyncio.Future] = None
+        self._wake_event: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._closing = False
+
+    def valid(self) -> bool:
+        return self.token is not None and time.monotonic() < self.expires_at
+
+    async def get_token(self) -> str:
+        """
+        Current token, only waits when there is no valid token
+        :return: str - access token
+        """
+        if self.valid():
+            # without the background task (or when it is late), start the refresh but keep using the current token
+            if time.monotonic() >= self.refresh_at:
+                self._refresh()
+
+            return self.token
+
+        self.counters["waits"] += 1
+
+        return await self.refresh()
+
+    def _refresh(self) -> asyncio.Future:
+        if self._in_flight is None:
+            self._in_flight = asyncio.ensure_future(self._fetch())
+            # a refresh nobody waits for still has its error counted, not reported as never retrieved
+            self._in_flight.add_done_callback(lambda future: future.cancelled() or future.exception())
+
+        return self._in_flight
+
+    async def refresh(self) -> str:
+        """
+        Refresh the token, or join the refresh in flight
+        :return: str - the new access token
+        """
+        # shield: a cancelled caller must not cancel the refresh the other callers are waiting for
+        return await asyncio.shield(self._refresh())
+
+    async def _fetch(self) -> str:
+        start = time.monotonic()
+
+        try:
+            token, expires_in = await self.fetch()
+
+        except Exception as ex:
+            self.counters["failures"] += 1
+            self.last_error = str(ex)
+            raise
+
+        finally:
+            self.latencies.append(time.monotonic() - start)
+            self._in_flight = None
+
+        now = time.monotonic()
+        self.token = token
+        self.expires_at = now + expires_in
+        self.refresh_at = now + expires_in - min(self.refresh_margin, expires_in / 2)
+        self.counters["refreshes"] += 1
+        self.last_error = None
+
+        return token
+
+    async def _refresh_loop(self):
+        """
+        Background task that refreshes the token refresh_margin seconds before its expiry
+        :return: None
+        """
+        while not self._closing:
+            delay = self.refresh_at - time.monotonic()
+
+            if delay <= 0:
+                try:
+                    await self.refresh()
+                    continue
+
+                except Exception as ex:
+                    warnings.warn(f"Cannot refresh token by error {ex}")
+                    delay = self.retry_delay
+
+            try:
+                await asyncio.wait_for(self._wake_event.wait(), timeout=delay)
+
+            except asyncio.TimeoutError:
+                pass
+
+    async def start(self):
+        """
+        Start the background refresh
+        :return: None
+        """
+        if self._task is not None:
+            return
+
+        self._closing = False
+        self._wake_event = asyncio.Event()
+        self._task = asyncio.ensure_future(self._refresh_loop())
+
+    async def close(self):
+        """
+        Stop the background refresh
+        :return: None
+        """
+        if self._task is None:
+            return
+
+        self._closing = True
+        self._wake_event.set()
+        await self._task
+
+        self._task = None
+        self._wake_event = None
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Token lifetime, refresh counters and latency in milliseconds
+        :return: dict
+        """
+        now = time.monotonic()
+        latencies = sorted(self.latencies)
+
+        return dict(
+            valid=self.valid(),
+            expires_in=max(self.expires_at - now, 0.0),
+            refresh_in=max(self.refresh_at - now, 0.0),
+            **self.counters,
+            last_error=self.last_error,
+            latency_ms=dict(
+                last=self.latencies[-1] * 1000 if self.latencies else 0.0,
+                p50=latencies[len(latencies) // 2] * 1000 if latencies else 0.0,
+                max=latencies[-1] * 1000 if latencies else 0.0
+            )
+        )
@@ -0,0 +1,239 @@
+import asyncio
+import json
+import os
+import random
+import warnings
+from collections import deque
+from datetime import datetime
+from typing import Dict, List, Deque, Any, Callable, Awaitable, Optional
+
+from channels.botframework import DeliveryError
+
+
+class OutboundMessage:
+    """
+    One message waiting for delivery
+    """
+    __slots__ = ("message", "conversation", "attempts", "created")
+
+    def __init__(self, message: Dict[str, Any], conversation: Dict[str, Any]):
+        self.message = message
+        self.conversation = conversation
+        self.attempts = 0
+        self.created = datetime.today().timestamp()
+
+
+class OutboundQueue:
+    """
+    Delivery queue of the outbound messages, one mailbox per conversation: the messages of a conversation are
+    delivered strictly in order, different conversations are delivered concurrently. Throttled (429) and failed
+    (5xx, timeout) deliveries are retried with exponential backoff and jitter, the messages that still fail go to
+    the dead-letter store
+    """
+    def __init__(self, deliver: Callable[[Dict[str, Any], Dict[str, Any]], Awaitable[None]], concurrency: int = 16,
+                 max_attempts: int = 5, base_delay: float = 0.5, max_delay: float = 30.0,
+                 dead_letter_path: str = None, dead_letter_size: int = 1000):
+        """
+        Create outbound queue
+        :param deliver: async function(message, conversation) - sends one message, raises DeliveryError
+        :param concurrency: int - maximum number of deliveries in flight
+        :param max_attempts: int - attempts before a message goes to the dead-letter store
+        :param base_delay: float - seconds before the first retry, doubled on every retry
+        :param max_delay: float - maximum seconds of the backoff, a longer Retry-After of the server is honoured
+        :param dead_letter_path: optional(str) - NDJSON file the dead letters are appended to
+        :param dead_letter_size: int - number of dead letters kept in memory
+        """
+        if concurrency < 1:
+            raise ValueError(f"concurrency must be a positive number, not {concurrency}")
+
+        if max_attempts < 1:
+            raise ValueError(f"max_attempts must be a positive number, not {max_attempts}")
+
+        self.deliver = deliver
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.dead_letter_path = dead_letter_path
+
+        self.mailboxes: Dict[str, Deque[OutboundMessage]] = dict()
+        self.dead_letters: Deque[Dict[str, Any]] = deque(maxlen=dead_letter_size)
+        self.counters = dict(enqueued=0, delivered=0, retried=0, dead_lettered=0)
+
+        self.concurrency = concurrency
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._tasks: Dict[str, asyncio.Task] = dict()
+        self._idle: Optional[asyncio.Event] = None
+
+    def enqueue(self, message: Dict[str, Any], conversation: Dict[str, Any]):
+        """
+        Put the message into the mailbox of its conversation, returns at once
+        :param message: dict - activity to send
+        :param conversation: dict(id) - conversation of the activity
+        :return: None
+        """
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+            self._idle = asyncio.Event()
+
+        self.counters["enqueued"] += 1
+        self._idle.clear()
+
+        conversation_id = conversation["id"]
+        mailbox = self.mailboxes.get(conversation_id, None)
+        if mailbox is None:
+            mailbox = deque()
+            self.mailboxes[conversation_id] = mailbox
+            mailbox.append(OutboundMessage(message, conversation))
+            self._tasks[conversation_id] = asyncio.ensure_future(self._drain(conversation_id, mailbox))
+
+        else:
+            mailbox.append(OutboundMessage(message, conversation))
+
+    async def _drain(self, conversation_id: str, mailbox: Deque[OutboundMessage]):
+        """
+        Deliver the mailbox of conversation one message at a time until it is empty
+        :param conversation_id: str - id of conversation
+        :param mailbox: deque - mailbox of conversation
+        :return: None
+        """
+        try:
+            while mailbox:
+                await self._deliver(mailbox[0])
+                mailbox.popleft()
+
+        finally:
+            del self.mailboxes[conversation_id]
+            del self._tasks[conversation_id]
+
+            if not self.mailboxes:
+                self._idle.set()
+
+    async def _deliver(self, item: OutboundMessage):
+        """
+        Send one message, retry it with backoff while the errors are retryable
+        :param item: OutboundMessage - the message
+        :return: None
+        """
+        while True:
+            item.attempts += 1
+
+            try:
+                # the slot is only held while sending, not while waiting for the next attempt
+                async with self._semaphore:
+                    await self.deliver(item.message, item.conversation)
+
+                self.counters["delivered"] += 1
+                return
+
+            except DeliveryError as ex:
+                if not ex.retryable or item.attempts >= self.max_attempts:
+                    self._dead_letter(item, ex)
+                    return
+
+                delay = self.backoff(item.attempts, ex.retry_after)
+
+            except Exception as ex:
+                self._dead_letter(item, ex)
+                return
+
+            self.counters["retried"] += 1
+            await asyncio.sleep(delay)
+
+    def backoff(self, attempts: int, retry_after: float = None) -> float:
+        """
+        Seconds to wait before the next attempt, exponential with full jitter, at least what the server asked for
+        even above max_delay
+        :param attempts: int - number of attempts made
+        :param retry_after: optional(float) - seconds of the Retry-After header
+        :return: float
+        """
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempts - 1)))
+
+        return max(delay, retry_after) if retry_after is not None else delay
+
+    def _dead_letter(self, item: OutboundMessage, error: Exception):
+        """
+        Keep a message that cannot be delivered, in memory and in the dead-letter file
+        """
+        self.counters["dead_lettered"] += 1
+
+        letter = dict(
+            conversation=item.conversation,
+            message=item.message,
+            attempts=item.attempts,
+            created=item.created,
+            failed=datetime.today().timestamp(),
+            status=getattr(error, "status", None),
+            error=str(error)
+        )
+        self.dead_letters.append(letter)
+        warnings.warn(f"Cannot deliver message to conversation {item.conversation['id']} after {item.attempts} "
+                      f"attempts by error {error}")
+
+        if self.dead_letter_path:
+            try:
+                os.makedirs(os.path.dirname(self.dead_letter_path) or ".", exist_ok=True)
+                with open(self.dead_letter_path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(letter) + "\n")
+
+            except Exception as ex:
+                warnings.warn(f"Cannot write dead letter to {self.dead_letter_path} by error {ex}")
+
+    def depth(self) -> int:
+        """
+        Number of messages waiting or being delivered
+        :return: int
+        """
+        return sum(len(mailbox) for mailbox in self.mailboxes.values())
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Queue depth, delivery counters and the latest dead letters
+        :return: dict(depth, conversations, oldest_age, enqueued, delivered, retried, dead_lettered, dead_letters)
+        """
+        now = datetime.today().timestamp()
+        oldest = min((mailbox[0].created for mailbox in self.mailboxes.values() if mailbox), default=None)
+
+        return dict(
+            depth=self.depth(),
+            conversations=len(self.mailboxes),
+            oldest_age=now - oldest if oldest is not None else 0.0,
+            **self.counters,
+            dead_letters=list(self.dead_letters)[-20:]
+        )
+
+    async def flush(self, timeout: float = None) -> bool:
+        """
+        Wait until every queued message is delivered or dead-lettered
+        :param timeout: optional(float) - seconds to wait
+        :return: bool - the queue is empty
+        """
+        if not self.mailboxes:
+            return True
+
+        try:
+            await asyncio.wait_for(asyncio.shield(self._idle.wait()), timeout=timeout)
+
+        except asyncio.TimeoutError:
+            return False
+
+        return True
+
+    async def close(self, timeout: float = 10.0):
+        """
+        Deliver the queued messages for at most timeout seconds, the rest goes to the dead-letter store
+        :param timeout: float - seconds to wait for the deliveries
+        :return: None
+        """
+        if await self.flush(timeout):
+            return
+
+        pending: List[OutboundMessage] = [item for mailbox in self.mailboxes.values() for item in mailbox]
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+        for item in pending:
+            self._dead_letter(item, RuntimeError("Not delivered before shutdown"))
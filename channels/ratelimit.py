@@ -0,0 +1,40 @@
+import asyncio
+import time
+
+
+class TokenBucket:
+    """
+    Token bucket rate limiter: rate requests per second on average, bursts of up to burst requests
+    """
+    def __init__(self, rate: float, burst: int = None):
+        """
+        Create bucket, full at start
+        :param rate: float - tokens added per second
+        :param burst: optional(int) - capacity of the bucket, default is one second of tokens
+        """
+        if rate <= 0:
+            raise ValueError(f"rate must be a positive number, not {rate}")
+
+        self.rate = rate
+        self.burst = max(1, int(burst if burst is not None else rate))
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        """
+        Take one token, waits until one is available
+        :return: None
+        """
+        while True:
+            self._refill()
+
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+
+            await asyncio.sleep((1 - self.tokens) / self.rate)
@@ -0,0 +1,110 @@
+from typing import Dict, List, Any
+
+
+class WebSocketChannel:
+    """
+    Channel that keeps one WebSocket connection per user, the replies are pushed on it as soon as the turn is done,
+    one frame per paragraph, so the web client needs neither a new request per message nor polling.
+    Frames sent to the client:
+    + {"type": "typing", "reply_to": id} - the message is received and being processed
+    + {"type": "message", "text": str, "button": list(str), "part": int, "last": bool, "reply_to": id}
+    + {"type": "error", "error": str, "reply_to": id}
+    """
+    def __init__(self):
+        # user_id: websocket, a new connection of a user replaces the previous one
+        self.connections: Dict[str, Any] = dict()
+
+    async def connect(self, user_id: str, websocket: Any):
+        """
+        Accept the connection of user and close the previous one
+        :param user_id: str - id of user
+        :param websocket: WebSocket - the new connection
+        :return: None
+        """
+        await websocket.accept()
+
+        previous = self.connections.get(user_id, None)
+        self.connections[user_id] = websocket
+
+        if previous is not None:
+            try:
+                await previous.close(code=4000)
+
+            except Exception:
+                pass
+
+    def disconnect(self, user_id: str, websocket: Any):
+        if self.connections.get(user_id, None) is websocket:
+            del self.connections[user_id]
+
+    @staticmethod
+    def translate_output(output: Dict[str, Any], reply_to: Any = None) -> List[Dict[str, Any]]:
+        """
+        Frames of a chatbot output, one per paragraph of text, the buttons go with the last one
+        :param output: dict(text, button) - exported MessageOutput
+        :param reply_to: any - id of the client message
+        :return: list(dict) - frames in sending order
+        """
+        text = output.get("text", None) or ""
+        parts = [part for part in text.strip().split("\n\n") if part] or [""]
+
+        return [dict(
+            type="message",
+            text=part,
+            button=output.get("button", None) if index == len(parts) - 1 else None,
+            part=index,
+            last=index == len(parts) - 1,
+            reply_to=reply_to
+        ) for index, part in enumerate(parts)]
+
+    async def send(self, user_id: str, frame: Dict[str, Any]) -> bool:
+        """
+        Send a frame on the current connection of user
+        :param user_id: str - id of user
+        :param frame: dict - the frame
+        :return: bool - sent, False if the user is not connected
+        """
+        websocket = self.connections.get(user_id, None)
+        if websocket is None:
+            return False
+
+        try:
+            await websocket.send_json(frame)
+
+        except Exception:
+            self.disconnect(user_id, websocket)
+            return False
+
+        return True
+
+    async def send_output(self, user_id: str, output: Dict[str, Any], reply_to: Any = None) -> bool:
+        """
+        Push a chatbot output to user, paragraph by paragraph
+        :param user_id: str - id of user
+        :param output: dict(text, button) - exported MessageOutput
+        :param reply_to: any - id of the client message
+        :return: bool - all the frames were sent
+        """
+        for frame in self.translate_output(output, reply_to):
+            if not await self.send(user_id, frame):
+                return False
+
+        return True
+
+    def stats(self) -> Dict[str, Any]:
+        return dict(connections=len(self.connections))
+
+    async def close(self, code: int = 1001):
+        """
+        Close every connection, 1001 tells the clients the server is going away
+        :param code: int - WebSocket close code
+        :return: None
+        """
+        connections, self.connections = list(self.connections.values()), dict()
+
+        for websocket in connections:
+            try:
+                await websocket.close(code=code)
+
+            except Exception:
+                pass
@@ -135,14 +135,14 @@ class UserChatState:
         user_input = input()
         self.translate_user_input(user_input)
 
-        events = self.handle_flow().__dict__
+        events = self.handle_flow().as_dict()
         while True:
             if self.loop_stack > 10:
                 break
 
             if events.get("action", None) is not None:
                 target_action = self.action_dict[events.get("action")]
-                events = target_action(self.intent, self.entities, self.slots).__dict__
+                events = target_action(self.intent, self.entities, self.slots).as_dict()
 
                 continue
 
@@ -168,13 +168,13 @@ class UserChatState:
 
                 event = events_map[inquirer.prompt(button).get("button")]
 
-                events = event(self.intent, self.entities, self.slots).__dict__
+                events = event(self.intent, self.entities, self.slots).as_dict()
                 continue
 
             if events.get("trigger_intent", None) is not None:
                 self.loop_stack += 1
                 trigger_intent = events.get("trigger_intent")
-                events = self.handle_flow(trigger_intent=trigger_intent).__dict__
+                events = self.handle_flow(trigger_intent=trigger_intent).as_dict()
                 continue
 
             if events.get("request_slot", None) is not None or self.slots.get("request_slot", None) is not None:
@@ -183,7 +183,7 @@ class UserChatState:
                     request_slot = self.slots.get("request_slot")
 
                 self.loop_stack += 1
-                events = self.handle_flow(request_slot=request_slot).__dict__
+                events = self.handle_flow(request_slot=request_slot).as_dict()
                 continue
 
-            events = self.handle_flow().__dict__
+            events = self.handle_flow().as_dict()
@@ -0,0 +1,154 @@
+import asyncio
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Dict, Deque, Tuple, Callable, Awaitable, Any, Optional
+
+
+class TurnScheduler:
+    """
+    Scheduler that keeps one mailbox per user, turns of the same user are processed strictly in order
+    while turns of different users run concurrently on the inference executor
+    """
+    def __init__(self, max_workers: int = 4):
+        """
+        Create scheduler
+        :param max_workers: int - number of threads of the inference executor
+        """
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="inference")
+        self.mailboxes: Dict[str, Deque[Tuple[Callable[[], Awaitable[Any]], asyncio.Future]]] = dict()
+
+        # set while paused, the new turns wait for it before entering their mailbox
+        self._resumed: Optional[asyncio.Event] = None
+        # set when the last mailbox is emptied, while pause waits for it
+        self._idle: Optional[asyncio.Event] = None
+
+    async def submit(self, user_id: str, turn: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        Put the turn into the mailbox of user and wait for its result
+        :param user_id: str - id of user
+        :param turn: async function without arguments - the work of the turn
+        :return: any - the result of turn
+        """
+        while self._resumed is not None:
+            await self._resumed.wait()
+
+        future = asyncio.get_running_loop().create_future()
+
+        mailbox = self.mailboxes.get(user_id, None)
+        if mailbox is None:
+            mailbox = deque()
+            self.mailboxes[user_id] = mailbox
+            mailbox.append((turn, future))
+            asyncio.ensure_future(self._drain(user_id, mailbox))
+
+        else:
+            mailbox.append((turn, future))
+
+        return await future
+
+    async def _drain(self, user_id: str, mailbox: Deque[Tuple[Callable[[], Awaitable[Any]], asyncio.Future]]):
+        """
+        Process the mailbox of user one turn at a time until it is empty
+        :param user_id: str - id of user
+        :param mailbox: deque - mailbox of user
+        :return: None
+        """
+        try:
+            while mailbox:
+                turn, future = mailbox[0]
+
+                try:
+                    # the caller stopped waiting before the turn started, e.g. its connection is closed
+                    if not future.cancelled():
+                        result = await turn()
+                        if not future.done():
+                            future.set_result(result)
+
+                except Exception as ex:
+                    if not future.done():
+                        future.set_exception(ex)
+
+                except BaseException:
+                    if not future.done():
+                        future.cancel()
+                    raise
+
+                finally:
+                    mailbox.popleft()
+
+        finally:
+            # the drain is stopped by a cancellation, nobody processes the turns left
+            for _, future in mailbox:
+                future.cancel()
+
+            del self.mailboxes[user_id]
+
+            if not self.mailboxes and self._idle is not None:
+                self._idle.set()
+
+    async def pause(self):
+        """
+        Hold the new turns and wait until the turns already in the mailboxes are done, so shared objects can be
+        swapped while no turn is using them
+        :return: None
+        """
+        if self._resumed is None:
+            self._resumed = asyncio.Event()
+
+        while self.mailboxes:
+            # shared by the pause calls waiting at the same time
+            if self._idle is None or self._idle.is_set():
+                self._idle = asyncio.Event()
+
+            await self._idle.wait()
+
+    def resume(self):
+        """
+        Let the held turns enter their mailboxes
+        :return: None
+        """
+        if self._resumed is not None:
+            resumed, self._resumed = self._resumed, None
+            resumed.set()
+
+    async def run_inference(self, func: Callable, *args, **kwargs) -> Any:
+        """
+        Run blocking work (NLU, dialogue engine) on the inference executor
+        :param func: callable - the blocking function
+        :return: any - result of func
+        """
+        loop = asyncio.get_running_loop()
+
+        return await loop.run_in_executor(self.executor, partial(func, *args, **kwargs))
+
+    def depth(self, user_id: str = None) -> int:
+        """
+        Number of turns waiting or running
+        :param user_id: optional(str) - id of user, default is all users
+        :return: int
+        """
+        if user_id is not None:
+            return len(self.mailboxes.get(user_id, ()))
+
+        return sum(len(mailbox) for mailbox in self.mailboxes.values())
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Mailbox depth per user and overall
+        :return: dict(total, users)
+        """
+        users = {user_id: len(mailbox) for user_id, mailbox in self.mailboxes.items()}
+
+        return dict(
+            total=sum(users.values()),
+            active_users=len(users),
+            users=users
+        )
+
+    def shutdown(self):
+        """
+        Stop the inference executor after the running work is done
+        :return: None
+        """
+        self.executor.shutdown(wait=True)
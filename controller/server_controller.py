@@ -1,19 +1,68 @@
+import asyncio
+import copy
+import json
+import sys
+import threading
 import warnings
-from typing import Optional
+from array import array
+from collections.abc import Mapping
+from datetime import datetime
+from typing import Optional, Tuple
 import logging
 from fastapi.logger import logger
 
 from actions.defined_actions import *
 from database.database import ChatStateDB
+from database.async_database import AsyncChatStateDB
+from database.rollup import turn_stat
 from nlu_pipelines.DIETClassifier.src.models.wrapper import DIETClassifierWrapper as Wrapper
 from parsers.event import EventOutput, ButtonTrigger
 from parsers.flow_map import FlowMap
+from controller.trace import Tracer, TurnTrace, NULL_TRACE
+
+
+class IntentRanking(Mapping):
+    """
+    Read-only intent ranking stored as an array of scores, the intent names and their index are shared between all
+    rankings with the same intents
+    """
+    __slots__ = ("names", "index", "scores")
+
+    _shared: Dict[Tuple[str, ...], Tuple[Tuple[str, ...], Dict[str, int]]] = dict()
+
+    def __init__(self, ranking: Mapping):
+        """
+        Create intent ranking
+        :param ranking: dict(intent_name: score)
+        """
+        key = tuple(ranking.keys())
+
+        shared = IntentRanking._shared.get(key, None)
+        if shared is None:
+            names = tuple(sys.intern(name) for name in key)
+            shared = (names, {name: index for index, name in enumerate(names)})
+            IntentRanking._shared[key] = shared
+
+        self.names, self.index = shared
+        self.scores = array("d", ranking.values())
+
+    def __getitem__(self, key: str) -> float:
+        return self.scores[self.index[key]]
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __len__(self) -> int:
+        return len(self.names)
 
 
 class ConversationState:
     """
     Object that storing and processing conversation
     """
+    __slots__ = ("user_id", "user_name", "version", "_intent", "entities", "slots", "button", "synonym_dict",
+                 "events", "loop_stack", "response", "fingerprint", "turn_stats")
+
     def __init__(self,
                  user_id: str,
                  user_name: str,
@@ -28,7 +77,10 @@ class ConversationState:
                  events: Dict[str, Any] = None,
                  loop_stack: int = 0,
                  response: Dict[str, Any] = None,
-                 synonym_dict: Dict[str, str] = None):
+                 synonym_dict: Dict[str, str] = None,
+                 fingerprint: str = None,
+                 trusted: bool = False,
+                 shared: Dict[Tuple[str, str], Any] = None):
         """
         Create ConversationState
 
@@ -46,35 +98,74 @@ class ConversationState:
         :param loop_stack: int - loop_stack to break the infinite loop
         :param response: MessageOutput - the output of chatbot
         :param synonym_dict: dict(str, str) - the synonym_dict for button
+        :param fingerprint: str - fingerprint of the domain and flow config the state is valid for
+        :param trusted: bool - the state was saved under the current fingerprint, skip the validation
+        :param shared: dict() - cache of button and synonym_dict structures shared between states, they are never
+                        modified after creation
         """
         self.user_id: str = user_id
         self.user_name: str = user_name
-        self.version: str = version
+        self.version: str = sys.intern(version)
 
-        self.intent: Dict[str, Any] = dict(name="default", intent_ranking={}, priority=0) if not intent else intent
+        self.intent = dict(name="default", intent_ranking={}, priority=0) if not intent else intent
         self.entities: List[Dict[str, Any]] = [] if not entities else entities
-        self.slots: Dict[str, Any] = dict() if not slots else slots
+        self.slots: Dict[str, Any] = dict() if not slots else {sys.intern(k): v for k, v in slots.items()}
 
-        self.button_dict: Dict[str, Any] = button
         self.button: Optional[Dict[str, ButtonTrigger]] = None
-        self.synonym_dict: Optional[Dict[str, str]] = synonym_dict
+        self.synonym_dict: Optional[Dict[str, str]] = None
 
         self.events: EventOutput = EventOutput(dict()) if not events else EventOutput(events)
 
         self.loop_stack: int = loop_stack
 
-        self.response_dict: Dict[str, Any] = response
         self.response: Optional[MessageOutput] = None
 
-        self._check(entities_list, intents_list, slots_list)
+        self.fingerprint: Optional[str] = fingerprint
+
+        # (timestamp, intent, fallback, top confidence) of the NLU predictions not saved yet, see database.rollup
+        self.turn_stats: List[Tuple[float, str, bool, float]] = []
 
-    def _check(self, entities_list: List[str], intents_list: List[str], slots_list: List[str]):
+        if trusted:
+            self._build(entities_list, intents_list, slots_list, button, response, synonym_dict, shared)
+
+        else:
+            self._check(entities_list, intents_list, slots_list, button, response, synonym_dict, shared)
+
+    @property
+    def intent(self) -> Dict[str, Any]:
+        return self._intent
+
+    @intent.setter
+    def intent(self, intent: Dict[str, Any]):
+        """
+        Store the intent with interned names and a compact intent_ranking
+        :param intent: dict(name, intent_ranking, priority)
+        :return: None
+        """
+        intent = {sys.intern(key): value for key, value in intent.items()}
+
+        if isinstance(intent.get("name", None), str):
+            intent["name"] = sys.intern(intent["name"])
+
+        ranking = intent.get("intent_ranking", None)
+        if ranking is not None and not isinstance(ranking, IntentRanking):
+            intent["intent_ranking"] = IntentRanking(ranking)
+
+        self._intent = intent
+
+    def _check(self, entities_list: List[str], intents_list: List[str], slots_list: List[str],
+               button: Optional[Dict[str, Any]], response: Optional[Dict[str, Any]],
+               synonym_dict: Optional[Dict[str, str]], shared: Optional[Dict[Tuple[str, str], Any]]):
         """
         Validate information and create needed attribute
 
         :param entities_list: list(str) - list of available entities
         :param intents_list: list(str) - list of available intents
         :param slots_list: list(str) - list of available slots
+        :param button: optional(dict) - dictionary to build button
+        :param response: optional(dict) - dictionary to build response
+        :param synonym_dict: optional(dict) - the synonym_dict for button
+        :param shared: optional(dict) - cache of shared structures
         :return:
         """
         if self.intent["name"] not in intents_list:
@@ -88,30 +179,62 @@ class ConversationState:
             if keys not in slots_list:
                 raise ValueError(f"Slot {keys} is not an available slot")
 
-        for key in self.events.__dict__.keys():
-            if key not in ["text", "action", "button", "set_slot", "trigger_intent", "request_slot"]:
-                raise ValueError(f"Event {key} is not an available event")
+        if response:
+            if response.get("text", None) is None and response.get("button", None) is None:
+                raise ValueError(f"response_dict must have text or button")
 
-        if self.button_dict is not None:
-            self.button = dict()
-            for key, value in self.button_dict.items():
-                self.button[key] = ButtonTrigger(value, entities_list, intents_list, slots_list)
+            if not isinstance(response.get('text', None), str):
+                raise ValueError(f"'text' must be a string, not {response.get('text')}")
+
+            if not isinstance(response.get('button', None), list) and response.get('button', None) is not None:
+                raise ValueError(f"'button' must be a list of string, not {response.get('button')}")
+
+        self._build(entities_list, intents_list, slots_list, button, response, synonym_dict, shared)
+
+    def _build(self, entities_list: List[str], intents_list: List[str], slots_list: List[str],
+               button: Optional[Dict[str, Any]], response: Optional[Dict[str, Any]],
+               synonym_dict: Optional[Dict[str, str]], shared: Optional[Dict[Tuple[str, str], Any]]):
+        """
+        Create the button and response objects from their dictionaries, reuse the shared ones if possible
+
+        :param entities_list: list(str) - list of available entities
+        :param intents_list: list(str) - list of available intents
+        :param slots_list: list(str) - list of available slots
+        :param button: optional(dict) - dictionary to build button
+        :param response: optional(dict) - dictionary to build response
+        :param synonym_dict: optional(dict) - the synonym_dict for button
+        :param shared: optional(dict) - cache of shared structures
+        :return:
+        """
+        if button is not None:
+            key = ("button", json.dumps(button, sort_keys=True))
+            self.button = None if shared is None else shared.get(key, None)
+
+            if self.button is None:
+                self.button = {sys.intern(k): ButtonTrigger(v, entities_list, intents_list, slots_list)
+                               for k, v in button.items()}
+
+                if shared is not None:
+                    shared[key] = self.button
 
         else:
             self.button = None
 
-        if self.response_dict:
-            if self.response_dict.get("text", None) is None and self.response_dict.get("button", None) is None:
-                raise ValueError(f"response_dict must have text or button")
+        if synonym_dict is not None:
+            key = ("synonym_dict", json.dumps(synonym_dict, sort_keys=True))
+            self.synonym_dict = None if shared is None else shared.get(key, None)
 
-            if not isinstance(self.response_dict.get('text', None), str):
-                raise ValueError(f"'text' must be a string, not {self.response_dict.get('text')}")
+            if self.synonym_dict is None:
+                self.synonym_dict = synonym_dict
 
-            if not isinstance(self.response_dict.get('button', None), list) and self.response_dict.get('button',
-                                                                                                       None) is not None:
-                raise ValueError(f"'button' must be a list of string, not {self.response_dict.get('button')}")
+                if shared is not None:
+                    shared[key] = synonym_dict
+
+        else:
+            self.synonym_dict = None
 
-            self.response = MessageOutput(text=self.response_dict.get('text'), button=self.response_dict.get("button"))
+        if response:
+            self.response = MessageOutput(text=response.get('text'), button=response.get("button"))
 
         else:
             self.response = None
@@ -122,18 +245,23 @@ class ConversationState:
 
         :return: dict(str, any)
         """
+        intent = self.intent
+        if isinstance(intent.get("intent_ranking", None), IntentRanking):
+            intent = dict(intent, intent_ranking=dict(intent["intent_ranking"]))
+
         return dict(
             user_id=self.user_id,
             user_name=self.user_name,
             version=self.version,
-            intent=self.intent,
+            intent=intent,
             slots=self.slots,
             entities=self.entities,
-            events=self.events.__dict__,
+            events=self.events.as_dict(),
             button=None if self.button is None else {k: v.export() for k, v in self.button.items()},
             loop_stack=self.loop_stack,
-            response=None if self.response is None else self.response.__dict__,
-            synonym_dict=self.synonym_dict
+            response=None if self.response is None else self.response.export(),
+            synonym_dict=self.synonym_dict,
+            fingerprint=self.fingerprint
         )
 
 
@@ -141,10 +269,22 @@ class MessageOutput:
     """
     Class that defines the output of chatbot
     """
+    __slots__ = ("text", "button")
+
     def __init__(self, text: str = None, button: List[str] = None):
         self.text = text
         self.button = button
 
+    def export(self) -> Dict[str, Any]:
+        """
+        Export to dictionary
+        :return: dict(text, button)
+        """
+        return dict(
+            text=self.text,
+            button=self.button
+        )
+
 
 class Controller:
     """
@@ -154,15 +294,20 @@ class Controller:
                  flow_map: FlowMap,
                  version: str,
                  base_action_class=BaseActionClass,
-                 debug: bool = False):
+                 debug: bool = False,
+                 tracer: Tracer = None):
         """
         Create controller
         :param nlu: DIETClassifierWrapper - the nlu pipeline for chatbot
         :param flow_map: FlowMap - the pre-defined flow_map for chatbot
         :param version: str - current version of system
         :param base_action_class: class name - Base action class for custom actions
+        :param debug: bool - trace every turn at debug level if no tracer is given
+        :param tracer: Tracer - decide which turns are traced
         """
         self.nlu = nlu
+        # the tokenizer and the model of nlu are not thread safe, the turns run on several threads
+        self.nlu_lock = threading.Lock()
         self.flow_map = flow_map
 
         self.version = version
@@ -171,6 +316,11 @@ class Controller:
 
         self.logger = logger
 
+        if tracer is None:
+            tracer = Tracer(level="debug" if debug else "off")
+
+        self.tracer = tracer
+
         if debug:
             self.logger.setLevel(logging.DEBUG)
 
@@ -194,15 +344,34 @@ class Controller:
             cls.name(): cls for cls in action_objects
         }
 
-    def translate_user_input(self, user_input: str, user_state: ConversationState):
+    def predict(self, user_inputs: List[str]) -> List[Dict[str, Any]]:
+        """
+        Predict intent and entities of many user messages in one pass of nlu pipeline
+        :param user_inputs: list(str) - user messages
+        :return: list(dict) - prediction of each message, in the same order
+        """
+        if not user_inputs:
+            return []
+
+        with self.nlu_lock:
+            return self.nlu.predict(list(user_inputs))
+
+    def translate_user_input(self, user_input: str, user_state: ConversationState,
+                             prediction: Dict[str, Any] = None):
         """
         Using nlu pipeline to predict user intent and entities
         :param user_input: str - user message
         :param user_state: ConversationState - the current state of conversation
+        :param prediction: optional(dict) - prediction of user_input made beforehand by predict
         :return:
         """
-        sentences = [user_input]
-        predicted_output = self.nlu.predict(sentences)[0]
+        if prediction is not None:
+            predicted_output = prediction
+
+        else:
+            sentences = [user_input]
+            with self.nlu_lock:
+                predicted_output = self.nlu.predict(sentences)[0]
 
         intent = dict(text=user_input,
                       name=predicted_output["intent"],
@@ -220,6 +389,11 @@ class Controller:
         user_state.intent = intent
         user_state.entities = entities
 
+        # counted now, the button and triggered turns reuse this intent without a new prediction
+        stat = turn_stat(intent)
+        if stat is not None:
+            user_state.turn_stats.append((datetime.today().timestamp(),) + stat)
+
     def handle_flow(self, user_state: ConversationState, trigger_intent: str = None, request_slot: str = None,
                     action: str = None) -> EventOutput:
         """
@@ -253,17 +427,39 @@ class Controller:
                                                                           user_state.slots)
             return events
 
-    def __call__(self, user_state: ConversationState, user_message: str = None) -> MessageOutput:
+    def __call__(self, user_state: ConversationState, user_message: str = None,
+                 trace_level: str = None, prediction: Dict[str, Any] = None) -> MessageOutput:
         """
-        Main loop that process the conversation, this process only change the attribute of given ConversationState
+        Process one turn of the conversation, this process only change the attribute of given ConversationState
         :param user_state: ConversationState - current state of conversation
         :param user_message: optional(str) - user message
+        :param trace_level: optional(str) - trace level for this turn, default is decided by the tracer
+        :param prediction: optional(dict) - nlu prediction of user_message made beforehand by predict
         :return: MessageOutput - output to user
         """
+        trace = self.tracer.start(user_state.user_id, trace_level)
+
+        output = self._step(user_state=user_state, user_message=user_message, trace=trace, prediction=prediction)
 
-        self.logger.debug(f"""
-        Main loop started!
-        """)
+        if trace.info:
+            trace.record("Turn finished", intent=user_state.intent.get("name", None), text=output.text,
+                         button=output.button)
+            trace.emit(self.logger)
+
+        return output
+
+    def _step(self, user_state: ConversationState, user_message: str = None,
+              trace: TurnTrace = NULL_TRACE, prediction: Dict[str, Any] = None) -> MessageOutput:
+        """
+        Main loop that process the conversation, this process only change the attribute of given ConversationState
+        :param user_state: ConversationState - current state of conversation
+        :param user_message: optional(str) - user message
+        :param trace: TurnTrace - trace of the current turn
+        :param prediction: optional(dict) - nlu prediction of user_message made beforehand by predict
+        :return: MessageOutput - output to user
+        """
+        if trace.debug:
+            trace.record("Main loop started", loop_stack=user_state.loop_stack)
 
         target_event = None
         # if loop_stack exceeds limit, return default action to user
@@ -273,10 +469,9 @@ class Controller:
             user_state.synonym_dict = None
             user_message = None
 
-            self.logger.debug(f"""
-            loop_stack exceeds limit: {user_state.loop_stack}
-            Events: {user_state.events.__dict__}
-            """)
+            if trace.debug:
+                trace.record("loop_stack exceeds limit", loop_stack=user_state.loop_stack,
+                             events=user_state.events.as_dict())
 
         # priority handle button in event
         elif user_state.button is not None and user_message is not None:
@@ -286,9 +481,8 @@ class Controller:
                 for key, value in user_state.synonym_dict.items():
                     if user_message.lower() == key.lower():
 
-                        self.logger.debug(f"""
-                        User message is replaced: {user_message} -> {value}
-                        """)
+                        if trace.debug:
+                            trace.record("User message is replaced", message=user_message, replaced=value)
 
                         translated_message = value
 
@@ -297,9 +491,8 @@ class Controller:
                 if translated_message.lower() == key.lower():
                     target_event = value
 
-                    self.logger.debug(f"""
-                    Button event triggered by synonym message: {target_event}
-                    """)
+                    if trace.debug:
+                        trace.record("Button event triggered", button=key)
 
             if target_event is not None:
                 if isinstance(target_event, dict):
@@ -313,61 +506,50 @@ class Controller:
                 user_state.synonym_dict = None
                 user_state.loop_stack += 1
 
-                self.logger.debug(f"""
-                User_state changed:
-                    Events: {user_state.events.__dict__}
-                    Button: None
-                    Synonym_dict: None
-                    Loop_stack: {user_state.loop_stack}
-                """)
+                if trace.debug:
+                    trace.record("User_state changed", events=user_state.events.as_dict(), button=None,
+                                 synonym_dict=None, loop_stack=user_state.loop_stack)
 
         if user_message is not None and target_event is None:
-            self.translate_user_input(user_input=user_message, user_state=user_state)
+            self.translate_user_input(user_input=user_message, user_state=user_state, prediction=prediction)
 
-            self.logger.debug(f"""
-            User message translated:
-                Intent: {user_state.intent}
-                Entities: {user_state.entities}
-            """)
+            if trace.info:
+                trace.record("User message translated", intent=user_state.intent.get("name", None),
+                             priority=user_state.intent.get("priority", None), entities=list(user_state.entities))
 
         # The most confusing thing
         # Each action that using recursive strategies will increase the loop stack
-        events = user_state.events.__dict__
+        events = user_state.events
 
-        self.logger.debug(f"""
-        Events confirm: {events}
-        """)
+        if trace.debug:
+            trace.record("Events confirm", events=events.as_dict())
 
         if events.get('action', None) is not None:
             user_state.events = self.handle_flow(action=events.get("action"), user_state=user_state)
             user_state.loop_stack += 1
 
-            self.logger.debug(f"""
-            Trigger action: {events.get("actions", None)}
-                Events: {user_state.events.__dict__}
-                Loop_stack: {user_state.loop_stack}
-            """)
+            if trace.debug:
+                trace.record("Trigger action", action=events.get("action", None),
+                             events=user_state.events.as_dict(), loop_stack=user_state.loop_stack)
 
-            return self.__call__(user_state=user_state)
+            return self._step(user_state=user_state, trace=trace)
 
         if events.get("set_slot", None) is not None:
             user_state.slots.update(events.get("set_slot"))
 
-            self.logger.debug(f"""
-            Set slot events: {events.get("set_slot", None)}
-            """)
+            if trace.debug:
+                trace.record("Set slot events", set_slot=dict(events.get("set_slot")))
 
         if events.get('text', None) is not None:
             user_state.loop_stack = 0
 
             output = MessageOutput(text=events.get("text"))
 
-            del user_state.events.__dict__["text"]
+            user_state.events.pop("text")
             user_state.response = output
 
-            self.logger.debug(f"""
-            Message output: {events.get("text")}
-            """)
+            if trace.debug:
+                trace.record("Message output", text=output.text)
 
             return output
 
@@ -386,7 +568,7 @@ class Controller:
 
             output = MessageOutput(text=text, button=option)
 
-            del user_state.events.__dict__["button"]
+            user_state.events.pop("button")
             user_state.response = output
 
             return output
@@ -395,13 +577,11 @@ class Controller:
             user_state.loop_stack += 1
             user_state.events = self.handle_flow(user_state=user_state, trigger_intent=events.get("trigger_intent"))
 
-            self.logger.debug(f"""
-            Trigger_intent event: {events.get("trigger_intent")}
-                Events: {user_state.events.__dict__}
-                Loop_stack: {user_state.loop_stack}
-            """)
+            if trace.debug:
+                trace.record("Trigger_intent event", trigger_intent=events.get("trigger_intent"),
+                             events=user_state.events.as_dict(), loop_stack=user_state.loop_stack)
 
-            return self.__call__(user_state=user_state)
+            return self._step(user_state=user_state, trace=trace)
 
         if events.get("request_slot", None) is not None or user_state.slots.get("request_slot", None) is not None:
             request_slot = events.get("request_slot", None)
@@ -411,30 +591,31 @@ class Controller:
             user_state.loop_stack += 1
             user_state.events = self.handle_flow(user_state=user_state, request_slot=request_slot)
 
-            self.logger.debug(f"""
-            Request_slot: {events.get("request_slot", None)}
-                Events: {user_state.events.__dict__}
-                Loop_stack: {user_state.loop_stack}
-            """)
+            if trace.debug:
+                trace.record("Request_slot", request_slot=request_slot, events=user_state.events.as_dict(),
+                             loop_stack=user_state.loop_stack)
 
-            return self.__call__(user_state=user_state)
+            return self._step(user_state=user_state, trace=trace)
 
         user_state.events = self.handle_flow(user_state=user_state)
 
-        self.logger.debug(f"""
-        Handle Flow at the end:
-            Events: {user_state.events}
-        """)
+        if trace.debug:
+            trace.record("Handle Flow at the end", events=user_state.events.as_dict())
 
-        return self.__call__(user_state=user_state)
+        return self._step(user_state=user_state, trace=trace)
 
 
 class UserConversations:
     """
     Object that store and handle all the thing that replace to ConversationState (saving, loading, finding, processing)
     """
+    PERSISTENCE_MODES = ["sync", "batched", "on_evict"]
+    SHARED_LIMIT = 4096
+
     def __init__(self, db: str, entities_list: List[str], intents_list: List[str], slots_list: List[str],
-                 user_limit: int = 100, version: str = "v0.0"):
+                 user_limit: int = 100, version: str = "v0.0", persistence: str = "sync", batch_size: int = 32,
+                 flush_interval: float = 1.0, fingerprint: str = None, storage: str = "full",
+                 snapshot_interval: int = 20, db_options: Dict[str, Any] = None):
         """
         Create UserConversations object.
         :param db: str - path to sqlite db
@@ -443,16 +624,62 @@ class UserConversations:
         :param slots_list: list(str) - list of available slots
         :param user_limit: int - number of maximum users store in memory
         :param version: str - version of system
+        :param persistence: str - durability of saving, one of
+                + sync - write every turn to db immediately
+                + batched - queue turn snapshots and write them in one transaction by size or time
+                + on_evict - only write the latest state when user is removed from memory or on close
+        :param batch_size: int - number of queued snapshots that triggers a flush
+        :param flush_interval: float - maximum seconds a snapshot waits in the queue
+        :param fingerprint: str - fingerprint of the current domain and flow config (FlowMap.fingerprint), states saved
+                            under the same fingerprint are loaded without validation
+        :param storage: str - history storage of ChatStateDB, "full" rows or "events" deltas with snapshots
+        :param snapshot_interval: int - number of turns between two snapshots in events storage
+        :param db_options: dict - storage engine settings of ChatStateDB (journal_mode, synchronous, cache_size,
+                           mmap_size, readers, timeout)
         """
-        self.db = ChatStateDB(db)
+        if persistence not in self.PERSISTENCE_MODES:
+            raise ValueError(f"persistence must be one of {self.PERSISTENCE_MODES}, not {persistence}")
+
+        self.db = ChatStateDB(db, storage=storage, snapshot_interval=snapshot_interval, **(db_options or dict()))
+        self.async_db = AsyncChatStateDB(self.db)
         self.entities_list = entities_list
         self.intents_list = intents_list
         self.slots_list = slots_list
+        self.fingerprint = fingerprint
+
+        # set based indexes for validating states saved under another fingerprint
+        self.entities_index = frozenset(entities_list)
+        self.intents_index = frozenset(intents_list)
+        self.slots_index = frozenset(slots_list)
+
+        # button and synonym_dict structures shared between the cached states
+        self.shared: Dict[Tuple[str, str], Any] = dict()
+
         self.user_limit = user_limit
         self.user_queue = dict()
+        # user_id: number of turns that got the state and did not save it yet, these states may be changed by an
+        # inference thread, so they are neither evicted nor copied
+        self.in_turn: Dict[str, int] = dict()
         self.frequency_queue = list()
         self.version = version
 
+        self.persistence = persistence
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.write_queue: List[Dict[str, Any]] = list()
+        self.dirty_users = set()
+        self._flush_event: Optional[asyncio.Event] = None
+        self._flush_task: Optional[asyncio.Task] = None
+        self._closing = False
+
+        # after close, the users are served by successor (the instance that replaced this one) if any
+        self.closed = False
+        self.successor: Optional["UserConversations"] = None
+
+        # async writes of the queue, and the batch being written so loads can wait for it
+        self._write_lock: Optional[asyncio.Lock] = None
+        self._in_flight: List[Dict[str, Any]] = list()
+
         self._load_from_db()
 
     def _load_from_db(self):
@@ -462,38 +689,316 @@ class UserConversations:
         """
         messages = self.db.fetch_users(limit=self.user_limit)
         for value in messages:
-            self.user_queue[value["user_id"]] = ConversationState(
-                user_id=value["user_id"],
-                user_name=value["user_name"],
-                version=value["version"],
-                entities_list=self.entities_list,
-                intents_list=self.intents_list,
-                slots_list=self.slots_list,
-                intent=value["intent"],
-                entities=value["entities"],
-                slots=value["slots"],
-                button=value["button"],
-                events=value["events"],
-                loop_stack=value["loop_stack"],
-                response=value["response"]
-            )
+            # a state saved under an older domain may not be valid anymore, skip it instead of failing the startup
+            try:
+                self.user_queue[value["user_id"]] = self._create_state(value)
+
+            except Exception as ex:
+                warnings.warn(f"Cannot load state of user {value['user_id']} by error {ex}")
+                continue
 
             self.frequency_queue.append(dict(user_id=value["user_id"], frequency=0))
 
-    def save_to_db(self, user_id: str):
+    def _create_state(self, user_data: Dict[str, Any]) -> ConversationState:
+        """
+        Create ConversationState from a saved state, the state is only validated if it was saved under
+        another domain fingerprint
+        :param user_data: dict() - state from ChatStateDB
+        :return: ConversationState
+        """
+        trusted = self.fingerprint is not None and user_data.get("fingerprint", None) == self.fingerprint
+
+        if len(self.shared) > self.SHARED_LIMIT:
+            self.shared = dict()
+
+        return ConversationState(
+            user_id=user_data["user_id"],
+            user_name=user_data["user_name"],
+            version=user_data["version"],
+            entities_list=self.entities_index,
+            intents_list=self.intents_index,
+            slots_list=self.slots_index,
+            intent=user_data["intent"],
+            entities=user_data["entities"],
+            slots=user_data["slots"],
+            button=user_data["button"],
+            events=user_data["events"],
+            loop_stack=user_data["loop_stack"],
+            response=user_data["response"],
+            synonym_dict=user_data["synonym_dict"],
+            fingerprint=self.fingerprint,
+            trusted=trusted,
+            shared=self.shared
+        )
+
+    def save_to_db(self, user_id: str, user_state: ConversationState = None):
         """
-        Save the specified user to db
+        Save the specified user to db, depending on the persistence mode the state is written now or queued
         :param user_id: str - id of user
+        :param user_state: optional(ConversationState) - state to save, needed when the user may be evicted from
+                            memory during its turn, default is the state in user_queue
         :return: None
         """
-        if self.user_queue.get(user_id, None) is not None:
-            save_dict = self.user_queue[user_id].export()
+        if self.closed:
+            return self._handover().save_to_db(user_id, user_state)
+
+        self.release(user_id)
+
+        if user_state is None:
+            user_state = self.user_queue.get(user_id, None)
+
+        if user_state is None:
+            warnings.warn(f"user {user_id} not in user_queue")
+            return
+
+        if self.persistence == "sync":
+            save_dict = self._export(user_state)
             self.db.insert_table(
                 **save_dict
             )
 
-        else:
+        elif self._enqueue(user_id, user_state):
+            self._request_flush()
+
+    async def save(self, user_id: str, user_state: ConversationState = None):
+        """
+        Awaitable save_to_db, the db write runs on the writer thread of async_db
+        :param user_id: str - id of user
+        :param user_state: optional(ConversationState) - state to save, default is the state in user_queue
+        :return: None
+        """
+        if self.closed:
+            return await self._handover().save(user_id, user_state)
+
+        self.release(user_id)
+
+        if user_state is None:
+            user_state = self.user_queue.get(user_id, None)
+
+        if user_state is None:
             warnings.warn(f"user {user_id} not in user_queue")
+            return
+
+        if self.persistence == "sync":
+            await self.async_db.insert_table(**self._export(user_state))
+
+        elif self._enqueue(user_id, user_state):
+            if self._flush_event is not None:
+                self._flush_event.set()
+
+            else:
+                await self._write_queue()
+
+    def release(self, user_id: str):
+        """
+        End the turn of user without saving, when the turn failed, save releases the user itself
+        :param user_id: str - id of user
+        :return: None
+        """
+        if self.closed:
+            return self._handover().release(user_id)
+
+        count = self.in_turn.get(user_id, 0)
+        if count > 1:
+            self.in_turn[user_id] = count - 1
+
+        else:
+            self.in_turn.pop(user_id, None)
+
+    def _enqueue(self, user_id: str, user_state: ConversationState) -> bool:
+        """
+        Mark the user dirty (on_evict) or queue a snapshot of its state
+        :param user_id: str - id of user
+        :param user_state: ConversationState - state to save
+        :return: bool - the queue reached batch_size and should be flushed
+        """
+        if self.persistence == "on_evict" and self.user_queue.get(user_id, None) is user_state:
+            self.dirty_users.add(user_id)
+            return False
+
+        self.write_queue.append(self._snapshot(user_state))
+
+        return len(self.write_queue) >= self.batch_size
+
+    @staticmethod
+    def _snapshot(user_state: ConversationState) -> Dict[str, Any]:
+        """
+        Copy the current state of user, so later turns do not change the queued data
+        :param user_state: ConversationState - state to copy
+        :return: dict(str, any) - arguments for ChatStateDB.insert_table
+        """
+        save_dict = copy.deepcopy(UserConversations._export(user_state))
+        save_dict["timestamp"] = datetime.today().timestamp()
+
+        return save_dict
+
+    @staticmethod
+    def _export(user_state: ConversationState) -> Dict[str, Any]:
+        """
+        Export the state for ChatStateDB.insert_table with the turn stats recorded since the last save, the stats are
+        taken from the state so every turn is counted once
+        :param user_state: ConversationState - state to save
+        :return: dict(str, any) - arguments for ChatStateDB.insert_table
+        """
+        save_dict = user_state.export()
+        save_dict["turn_stats"], user_state.turn_stats = user_state.turn_stats, []
+
+        return save_dict
+
+    def _request_flush(self):
+        """
+        Wake up the background flush task, or flush now if the task is not running
+        :return: None
+        """
+        if self._flush_event is not None:
+            self._flush_event.set()
+
+        else:
+            self._flush_queue()
+
+    def flush(self) -> int:
+        """
+        Write all queued snapshots and dirty users to db in one transaction
+        :return: int - number of written states
+        """
+        self._queue_dirty_users()
+
+        return self._flush_queue()
+
+    async def flush_async(self) -> int:
+        """
+        Awaitable flush, the db write runs on the writer thread of async_db
+        :return: int - number of written states
+        """
+        self._queue_dirty_users()
+
+        return await self._write_queue()
+
+    def _queue_dirty_users(self, all_users: bool = False):
+        """
+        Queue a snapshot of the dirty users, the users in a turn stay dirty until the turn is saved
+        :param all_users: bool - also queue the users in a turn, used on close when no turn is running
+        :return: None
+        """
+        dirty_users = set()
+        for user_id in self.dirty_users:
+            if not all_users and user_id in self.in_turn:
+                dirty_users.add(user_id)
+
+            elif self.user_queue.get(user_id, None) is not None:
+                self.write_queue.append(self._snapshot(self.user_queue[user_id]))
+
+        self.dirty_users = dirty_users
+
+    def _flush_queue(self) -> int:
+        """
+        Write the queued snapshots to db in one transaction, keep them queued if the write fails
+        :return: int - number of written states
+        """
+        batch, self.write_queue = self.write_queue, list()
+        if not batch:
+            return 0
+
+        try:
+            self.db.insert_many(batch)
+
+        except Exception as ex:
+            self.write_queue = batch + self.write_queue
+            warnings.warn(f"Cannot flush {len(batch)} states to db by error {ex}")
+            return 0
+
+        return len(batch)
+
+    async def _write_queue(self) -> int:
+        """
+        Awaitable _flush_queue, one batch is written at a time
+        :return: int - number of written states
+        """
+        if self._write_lock is None:
+            self._write_lock = asyncio.Lock()
+
+        async with self._write_lock:
+            batch, self.write_queue = self.write_queue, list()
+            if not batch:
+                return 0
+
+            self._in_flight = batch
+            try:
+                await self.async_db.insert_many(batch)
+
+            except Exception as ex:
+                self.write_queue = batch + self.write_queue
+                warnings.warn(f"Cannot flush {len(batch)} states to db by error {ex}")
+                return 0
+
+            finally:
+                self._in_flight = list()
+
+        return len(batch)
+
+    async def _flush_loop(self):
+        """
+        Background task that flushes the write queue by size or time trigger
+        :return: None
+        """
+        while not self._closing:
+            try:
+                await asyncio.wait_for(self._flush_event.wait(), timeout=self.flush_interval)
+
+            except asyncio.TimeoutError:
+                pass
+
+            self._flush_event.clear()
+            await self.flush_async()
+
+    async def start(self):
+        """
+        Start the background flush task, only used in batched mode
+        :return: None
+        """
+        if self.persistence != "batched" or self._flush_task is not None:
+            return
+
+        self._closing = False
+        self._flush_event = asyncio.Event()
+        self._flush_task = asyncio.ensure_future(self._flush_loop())
+
+    async def close(self, successor: "UserConversations" = None):
+        """
+        Stop the background flush task, write everything that is still pending and close the database, the later
+        calls are handed over to successor, or raise RuntimeError if there is none
+        :param successor: optional(UserConversations) - the instance that replaces this one
+        :return: None
+        """
+        if self.closed:
+            return
+
+        if self._flush_task is not None:
+            self._closing = True
+            self._flush_event.set()
+            await self._flush_task
+
+            self._flush_task = None
+            self._flush_event = None
+
+        self._queue_dirty_users(all_users=True)
+        await self.flush_async()
+
+        self.closed = True
+        self.successor = successor
+
+        # waits for the queued queries, off the event loop
+        await asyncio.get_running_loop().run_in_executor(None, self.async_db.close)
+
+    def _handover(self) -> "UserConversations":
+        """
+        The instance serving the users after close, a turn that started before a reload still saves its state
+        :return: UserConversations
+        """
+        if self.successor is None:
+            raise RuntimeError("UserConversations is closed, the state cannot be saved")
+
+        return self.successor
 
     def load_user(self, user_id: str, user_name: str):
         """
@@ -506,42 +1011,86 @@ class UserConversations:
             warnings.warn(f"user {user_id} already in user_queue")
 
         else:
-            if len(self.user_queue.keys()) >= self.user_limit:
-                self.frequency_queue = sorted(self.frequency_queue, key=lambda x: x["frequency"])
-
-                select_user_id = self.frequency_queue[0]["user_id"]
-                del self.frequency_queue[0]
-                del self.user_queue[select_user_id]
-
-            user_data = self.db.fetch_chat_state(user_id=user_id)
-            if user_data is not None:
-                self.user_queue[user_id] = ConversationState(
-                    user_id=user_data["user_id"],
-                    user_name=user_data["user_name"],
-                    version=user_data["version"],
-                    entities_list=self.entities_list,
-                    intents_list=self.intents_list,
-                    slots_list=self.slots_list,
-                    intent=user_data["intent"],
-                    entities=user_data["entities"],
-                    slots=user_data["slots"],
-                    button=user_data["button"],
-                    events=user_data["events"],
-                    loop_stack=user_data["loop_stack"],
-                    response=user_data["response"]
-                )
+            if self._evict():
+                self._flush_queue()
 
-            else:
-                self.user_queue[user_id] = ConversationState(
-                    user_id=user_id,
-                    user_name=user_name,
-                    version=self.version,
-                    entities_list=self.entities_list,
-                    intents_list=self.intents_list,
-                    slots_list=self.slots_list
-                )
+            # the user may be evicted and reloaded before its queued snapshots are written
+            if any(snapshot["user_id"] == user_id for snapshot in self.write_queue):
+                self._flush_queue()
+
+            self._add_user(user_id, user_name, self.db.fetch_chat_state(user_id=user_id))
+
+    async def load_user_async(self, user_id: str, user_name: str):
+        """
+        Awaitable load_user, the db reads and writes run on the threads of async_db
+        :param user_id: str - id of user
+        :param user_name: str - name of user
+        :return: None
+        """
+        if self._evict():
+            await self._write_queue()
+
+        if any(snapshot["user_id"] == user_id for snapshot in self.write_queue + self._in_flight):
+            await self._write_queue()
+
+        user_data = await self.async_db.fetch_chat_state(user_id=user_id)
+
+        # another coroutine may have loaded the user while waiting for db
+        if self.user_queue.get(user_id, None) is None:
+            self._add_user(user_id, user_name, user_data)
+
+    def _evict(self) -> bool:
+        """
+        Remove the least used user from memory when user_limit is reached, its state is queued if dirty.
+        The users in a turn are skipped, if all of them are in a turn user_limit is exceeded until they are done
+        :return: bool - a snapshot was queued and should be written before loading
+        """
+        if len(self.user_queue.keys()) < self.user_limit:
+            return False
+
+        self.frequency_queue = sorted(self.frequency_queue, key=lambda x: x["frequency"])
+
+        queued = False
+        index = 0
+        while len(self.user_queue.keys()) >= self.user_limit and index < len(self.frequency_queue):
+            select_user_id = self.frequency_queue[index]["user_id"]
+            if select_user_id in self.in_turn:
+                index += 1
+                continue
+
+            if select_user_id in self.dirty_users:
+                self.write_queue.append(self._snapshot(self.user_queue[select_user_id]))
+                self.dirty_users.discard(select_user_id)
+                queued = True
+
+            del self.frequency_queue[index]
+            del self.user_queue[select_user_id]
+
+        return queued
+
+    def _add_user(self, user_id: str, user_name: str, user_data: Optional[Dict[str, Any]]):
+        """
+        Put the loaded state of user into memory, or a new state if user has none
+        :param user_id: str - id of user
+        :param user_name: str - name of user
+        :param user_data: optional(dict) - state from ChatStateDB
+        :return: None
+        """
+        if user_data is not None:
+            self.user_queue[user_id] = self._create_state(user_data)
+
+        else:
+            self.user_queue[user_id] = ConversationState(
+                user_id=user_id,
+                user_name=user_name,
+                version=self.version,
+                entities_list=self.entities_index,
+                intents_list=self.intents_index,
+                slots_list=self.slots_index,
+                fingerprint=self.fingerprint
+            )
 
-            self.frequency_queue.append(dict(user_id=user_id, frequency=0))
+        self.frequency_queue.append(dict(user_id=user_id, frequency=0))
 
     def __call__(self, user_id: str, user_name: str = "anonymous"):
         """
@@ -550,6 +1099,9 @@ class UserConversations:
         :param user_name: str - name of user
         :return: ConversationState - conversation state of user
         """
+        if self.closed:
+            return self._handover()(user_id, user_name)
+
         user_state = self.user_queue.get(user_id, None)
 
         if not user_state:
@@ -557,9 +1109,35 @@ class UserConversations:
 
             user_state = self.user_queue.get(user_id, None)
 
+        self._count_use(user_id)
+        self.in_turn[user_id] = self.in_turn.get(user_id, 0) + 1
+
+        return user_state
+
+    async def get(self, user_id: str, user_name: str = "anonymous") -> ConversationState:
+        """
+        Awaitable __call__, loading the user does not block the event loop
+        :param user_id: str - id of user
+        :param user_name: str - name of user
+        :return: ConversationState - conversation state of user
+        """
+        if self.closed:
+            return await self._handover().get(user_id, user_name)
+
+        user_state = self.user_queue.get(user_id, None)
+
+        if not user_state:
+            await self.load_user_async(user_id=user_id, user_name=user_name)
+
+            user_state = self.user_queue.get(user_id, None)
+
+        self._count_use(user_id)
+        self.in_turn[user_id] = self.in_turn.get(user_id, 0) + 1
+
+        return user_state
+
+    def _count_use(self, user_id: str):
         for index, user in enumerate(self.frequency_queue):
             if user["user_id"] == user_id:
                 self.frequency_queue[index]["frequency"] += 1
                 break
-
-        return user_state
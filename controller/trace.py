@@ -0,0 +1,123 @@
+import logging
+import random
+import time
+from typing import Dict, List, Any, Tuple, Optional
+
+
+TRACE_LEVELS = {
+    "off": 0,
+    "info": 1,
+    "debug": 2
+}
+
+
+class TurnTrace:
+    """
+    Step events of one conversation turn, the events are only formatted when the trace is emitted
+    """
+    def __init__(self, user_id: str, level: str):
+        """
+        Create trace
+        :param user_id: str - id of user
+        :param level: str - trace level, one of TRACE_LEVELS
+        """
+        self.user_id = user_id
+        self.level = level
+        self.info: bool = TRACE_LEVELS[level] >= TRACE_LEVELS["info"]
+        self.debug: bool = TRACE_LEVELS[level] >= TRACE_LEVELS["debug"]
+        self.start = time.perf_counter()
+        self.steps: List[Tuple[float, str, Dict[str, Any]]] = []
+
+    def record(self, step: str, **fields):
+        """
+        Record a step, callers should check trace.info or trace.debug before building the fields
+        :param step: str - name of step
+        :param fields: values of step
+        :return: None
+        """
+        self.steps.append((time.perf_counter(), step, fields))
+
+    def format(self) -> str:
+        """
+        Format all recorded steps
+        :return: str
+        """
+        lines = [f"Trace of user {self.user_id} ({self.level}), "
+                 f"{(time.perf_counter() - self.start) * 1000:.2f} ms, {len(self.steps)} steps"]
+
+        for timestamp, step, fields in self.steps:
+            values = ", ".join(f"{key}={value}" for key, value in fields.items())
+            lines.append(f"    +{(timestamp - self.start) * 1000:.2f} ms {step}: {values}")
+
+        return "\n".join(lines)
+
+    def emit(self, logger: logging.Logger):
+        """
+        Write the trace to logger
+        :param logger: logging.Logger
+        :return: None
+        """
+        logger.info(self.format())
+
+
+class NullTrace:
+    """
+    Trace that records nothing, used when tracing is off for the turn
+    """
+    user_id = None
+    level = "off"
+    info = False
+    debug = False
+
+    def record(self, step: str, **fields):
+        pass
+
+    def emit(self, logger: logging.Logger):
+        pass
+
+
+NULL_TRACE = NullTrace()
+
+
+class Tracer:
+    """
+    Decide which turns are traced: a per-request level, the global level, or a sampled fraction of turns
+    """
+    def __init__(self, level: str = "off", sample_rate: float = 0.0, sample_level: str = "debug"):
+        """
+        Create tracer
+        :param level: str - global trace level for every turn
+        :param sample_rate: float - fraction of the other turns that are traced at sample_level
+        :param sample_level: str - trace level of the sampled turns
+        """
+        for name in [level, sample_level]:
+            if name not in TRACE_LEVELS:
+                raise ValueError(f"trace level must be one of {list(TRACE_LEVELS.keys())}, not {name}")
+
+        if not 0.0 <= sample_rate <= 1.0:
+            raise ValueError(f"sample_rate must be between 0 and 1, not {sample_rate}")
+
+        self.level = level
+        self.sample_rate = sample_rate
+        self.sample_level = sample_level
+
+    def start(self, user_id: str, level: Optional[str] = None):
+        """
+        Start the trace of a turn
+        :param user_id: str - id of user
+        :param level: optional(str) - trace level requested for this turn, overrides the global level and sampling
+        :return: TurnTrace or NULL_TRACE
+        """
+        if level is not None:
+            if level not in TRACE_LEVELS:
+                raise ValueError(f"trace level must be one of {list(TRACE_LEVELS.keys())}, not {level}")
+
+            return NULL_TRACE if level == "off" else TurnTrace(user_id, level)
+
+        if self.level != "off":
+            return TurnTrace(user_id, self.level)
+
+        if self.sample_rate and random.random() < self.sample_rate:
+            return TurnTrace(user_id, self.sample_level)
+
+        return NULL_TRACE
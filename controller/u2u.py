@@ -0,0 +1,204 @@
+import heapq
+import time
+from typing import Dict, List, Set, Tuple, Any, Optional
+
+from database.async_database import AsyncChatStateDB
+
+
+class U2USessions:
+    """
+    User to user (ARM) status of every user kept in memory, with the users in session indexed by floor.
+    A session ends ttl seconds after the last ARM event that opened it, the expiry times are kept in a heap so only
+    the sessions due are visited, and only the users whose status changed are written back to the database
+    """
+    def __init__(self, db: AsyncChatStateDB, ttl: float = 180.0):
+        """
+        Create session manager
+        :param db: AsyncChatStateDB - user status database
+        :param ttl: float - seconds a u2u session lasts after it was opened
+        """
+        if ttl <= 0:
+            raise ValueError(f"ttl must be a positive number, not {ttl}")
+
+        self.db = db
+        self.ttl = ttl
+
+        # user_id: dict(user_id, user_name, u2u, timestamp, floor)
+        self.users: Dict[str, Dict[str, Any]] = dict()
+        # floor: ids of the users in session on it
+        self.floors: Dict[str, Set[str]] = dict()
+        # (expiry time, user_id), an entry is stale when the session was opened again or ended since
+        self.expiries: List[Tuple[float, str]] = []
+        # ids of the users whose status is not written to the database yet
+        self.dirty: Set[str] = set()
+
+        self.counters = dict(opened=0, closed=0, expired=0, written=0)
+
+    async def start(self):
+        """
+        Load the status of all users, the users created later are loaded when they are first used
+        :return: None
+        """
+        for status in await self.db.fetch_arm_status():
+            self._add(status)
+
+    def _add(self, status: Dict[str, Any]) -> Dict[str, Any]:
+        status = dict(
+            user_id=status["user_id"],
+            user_name=status["user_name"],
+            u2u=bool(status["u2u"]),
+            timestamp=float(status["timestamp"] or 0),
+            floor=status["floor"]
+        )
+        self.users[status["user_id"]] = status
+
+        if status["u2u"]:
+            self.floors.setdefault(status["floor"], set()).add(status["user_id"])
+            heapq.heappush(self.expiries, (status["timestamp"] + self.ttl, status["user_id"]))
+
+        return status
+
+    def _set_u2u(self, status: Dict[str, Any], u2u: bool, floor: str = None, now: float = None):
+        user_id = status["user_id"]
+
+        if status["u2u"]:
+            users = self.floors.get(status["floor"], None)
+            if users is not None:
+                users.discard(user_id)
+                if not users:
+                    del self.floors[status["floor"]]
+
+        status["u2u"] = u2u
+        if floor is not None:
+            status["floor"] = floor
+
+        if u2u:
+            status["timestamp"] = now
+            self.floors.setdefault(status["floor"], set()).add(user_id)
+            heapq.heappush(self.expiries, (now + self.ttl, user_id))
+
+        self.dirty.add(user_id)
+
+    def expire(self, now: float = None) -> int:
+        """
+        End the sessions that are due
+        :param now: optional(float) - current time, default is time.time()
+        :return: int - number of ended sessions
+        """
+        now = time.time() if now is None else now
+
+        expired = 0
+        while self.expiries and self.expiries[0][0] < now:
+            expires, user_id = heapq.heappop(self.expiries)
+
+            status = self.users.get(user_id, None)
+            if status is None or not status["u2u"] or status["timestamp"] + self.ttl != expires:
+                continue
+
+            self._set_u2u(status, False)
+            expired += 1
+
+        self.counters["expired"] += expired
+
+        return expired
+
+    async def get(self, user_id: str) -> Optional[Dict[str, Any]]:
+        """
+        Get the current status of user, the returned dict follows the later changes
+        :param user_id: str - id of user
+        :return: optional(dict(user_id, user_name, u2u, timestamp, floor)) - None if the user is unknown
+        """
+        self.expire()
+
+        status = self.users.get(user_id, None)
+        if status is not None:
+            return status
+
+        status = await self.db.get_user_status(user_id=user_id)
+        if status is None:
+            return None
+
+        # loaded meanwhile by another call, keep the status that may already be changed
+        if user_id in self.users:
+            return self.users[user_id]
+
+        return self._add(status)
+
+    def open_session(self, user_id: str) -> bool:
+        """
+        Open a session for user on its current floor, if none is open
+        :param user_id: str - id of a loaded user
+        :return: bool - the session is opened, False if one is already open
+        """
+        status = self.users[user_id]
+        if status["u2u"]:
+            return False
+
+        self._set_u2u(status, True, now=time.time())
+        self.counters["opened"] += 1
+
+        return True
+
+    def end_session(self, user_id: str):
+        """
+        End the session of user
+        :param user_id: str - id of a loaded user
+        :return: None
+        """
+        status = self.users[user_id]
+        if status["u2u"]:
+            self._set_u2u(status, False)
+            self.counters["closed"] += 1
+
+    def take_floor(self, user_id: str, floor: str):
+        """
+        Open or renew a session for user on floor, ending the sessions of the other users on that floor
+        :param user_id: str - id of a loaded user
+        :param floor: str - name of the ARM floor
+        :return: None
+        """
+        for other_id in list(self.floors.get(floor, ())):
+            if other_id != user_id:
+                self._set_u2u(self.users[other_id], False)
+                self.counters["closed"] += 1
+
+        self._set_u2u(self.users[user_id], True, floor=floor, now=time.time())
+        self.counters["opened"] += 1
+
+    async def flush(self) -> int:
+        """
+        Write the changed statuses to the database
+        :return: int - number of written users
+        """
+        if not self.dirty:
+            return 0
+
+        user_ids, self.dirty = self.dirty, set()
+        statuses = [dict(self.users[user_id]) for user_id in user_ids]
+
+        try:
+            await self.db.change_user_statuses(statuses)
+
+        except Exception:
+            self.dirty |= user_ids
+            raise
+
+        self.counters["written"] += len(statuses)
+
+        return len(statuses)
+
+    async def close(self):
+        """
+        End the expired sessions and write the changed statuses, before the database is closed
+        :return: None
+        """
+        self.expire()
+        await self.flush()
+
+    def stats(self) -> Dict[str, Any]:
+        return dict(
+            users=len(self.users),
+            sessions={floor: len(users) for floor, users in self.floors.items()},
+            dirty=len(self.dirty),
+            **self.counters
+        )
@@ -0,0 +1,101 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Dict, List, Any, Callable, Optional, Tuple
+
+from database.database import ChatStateDB
+
+
+class AsyncChatStateDB:
+    """
+    Awaitable façade over ChatStateDB, writes run in order on a dedicated writer thread and reads run on
+    reader threads, so a long query never blocks the event loop that serves the chat turns
+    """
+    def __init__(self, db: ChatStateDB, read_workers: int = None):
+        """
+        Create façade
+        :param db: ChatStateDB - the synchronous database
+        :param read_workers: optional(int) - number of reader threads, default is the reader connections of db
+        """
+        if read_workers is None:
+            read_workers = max(db.pool.readers, 1)
+
+        self.db = db
+        self.writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-writer")
+        self.reader = ThreadPoolExecutor(max_workers=read_workers, thread_name_prefix="db-reader")
+
+    @staticmethod
+    async def _run(executor: ThreadPoolExecutor, func: Callable, *args, **kwargs) -> Any:
+        loop = asyncio.get_running_loop()
+
+        return await loop.run_in_executor(executor, partial(func, *args, **kwargs))
+
+    async def insert_table(self, **state):
+        """
+        Insert conversation state, the arguments are the ones of ChatStateDB.insert_table
+        :return: None
+        """
+        return await self._run(self.writer, self.db.insert_table, **state)
+
+    async def insert_many(self, states: List[Dict[str, Any]]):
+        """
+        Insert several conversation states in one transaction
+        :param states: list(dict) - keyword arguments of insert_table for each state
+        :return: None
+        """
+        return await self._run(self.writer, self.db.insert_many, states)
+
+    async def modify_chat_state(self, user_id: str, select_intent: str) -> bool:
+        return await self._run(self.writer, self.db.modify_chat_state, user_id, select_intent)
+
+    async def change_user_status(self, user_id: str, user_name: str, u2u: bool, floor: str):
+        return await self._run(self.writer, self.db.change_user_status, user_id=user_id, user_name=user_name,
+                               u2u=u2u, floor=floor)
+
+    async def change_user_statuses(self, statuses: List[Dict[str, Any]]):
+        return await self._run(self.writer, self.db.change_user_statuses, statuses)
+
+    async def fetch_chat_state(self, user_id: str) -> Optional[Dict[str, Any]]:
+        return await self._run(self.reader, self.db.fetch_chat_state, user_id=user_id)
+
+    async def fetch_user_messages(self, user_id: str, limit: int = 100) -> List[Dict[str, Any]]:
+        return await self._run(self.reader, self.db.fetch_user_messages, user_id=user_id, limit=limit)
+
+    async def fetch_all_messages(self, limit: int = 100) -> List[Dict[str, Any]]:
+        return await self._run(self.reader, self.db.fetch_all_messages, limit=limit)
+
+    async def fetch_history(self, user_id: str = None, before: int = None, since: float = None, limit: int = 100,
+                            fields: List[str] = None) -> Tuple[List[Dict[str, Any]], Optional[int]]:
+        return await self._run(self.reader, self.db.fetch_history, user_id=user_id, before=before, since=since,
+                               limit=limit, fields=fields)
+
+    async def fetch_state_at(self, user_id: str, state_id: int) -> Optional[Dict[str, Any]]:
+        return await self._run(self.reader, self.db.fetch_state_at, user_id=user_id, state_id=state_id)
+
+    async def fetch_intent_stats(self, start: str = None, end: str = None,
+                                 intent: str = None) -> List[Dict[str, Any]]:
+        return await self._run(self.reader, self.db.fetch_intent_stats, start=start, end=end, intent=intent)
+
+    async def search_messages(self, query: str, user_id: str = None, field: str = None, start: float = None,
+                              end: float = None, limit: int = 20,
+                              offset: int = 0) -> Tuple[List[Dict[str, Any]], Optional[int]]:
+        return await self._run(self.reader, self.db.search_messages, query=query, user_id=user_id, field=field,
+                               start=start, end=end, limit=limit, offset=offset)
+
+    async def fetch_users(self, limit: int = 100) -> List[Dict[str, Any]]:
+        return await self._run(self.reader, self.db.fetch_users, limit=limit)
+
+    async def get_user_status(self, user_id: str) -> Optional[Dict[str, Any]]:
+        return await self._run(self.reader, self.db.get_user_status, user_id=user_id)
+
+    async def fetch_arm_status(self) -> List[Dict[str, Any]]:
+        return await self._run(self.reader, self.db.fetch_arm_status)
+
+    def close(self):
+        """
+        Wait for the queued queries and close the database
+        :return: None
+        """
+        self.writer.shutdown(wait=True)
+        self.reader.shutdown(wait=True)
+        self.db.close()
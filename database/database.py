@@ -2,7 +2,105 @@ import json
 import sqlite3
 import warnings
 from datetime import datetime
-from typing import Dict, List, Any, Tuple
+from typing import Dict, List, Any, Tuple, Optional
+
+from database.migrations import migrate, CHAT_STATE_COLUMNS
+from database.pool import ConnectionPool
+from database.rollup import add_turns
+from database.search import index_turn, match_query, SEARCH_MESSAGES, SOURCES
+
+# all statements are constants with bound parameters, so sqlite3 reuses the prepared statements from its cache
+INSERT_CHAT_STATE = """INSERT INTO chat_state (user_id, user_name, version, intent, slots, entities, timestamp, events,
+                       button, loop_stack, response, synonym_dict, fingerprint)
+                       VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"""
+
+UPSERT_LATEST_STATE = f"""INSERT INTO latest_state ({CHAT_STATE_COLUMNS})
+                          VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                          ON CONFLICT (user_id) DO UPDATE SET id = excluded.id, user_name = excluded.user_name,
+                          version = excluded.version, intent = excluded.intent, slots = excluded.slots,
+                          entities = excluded.entities, timestamp = excluded.timestamp, events = excluded.events,
+                          button = excluded.button, loop_stack = excluded.loop_stack, response = excluded.response,
+                          synonym_dict = excluded.synonym_dict, fingerprint = excluded.fingerprint"""
+
+SELECT_CHAT_STATE = f"""SELECT {CHAT_STATE_COLUMNS} FROM latest_state WHERE user_id = ?"""
+
+SELECT_USER_MESSAGES = """SELECT * FROM chat_state WHERE user_id = ? ORDER BY id DESC LIMIT ?"""
+
+SELECT_ALL_MESSAGES = """SELECT * FROM chat_state ORDER BY id DESC LIMIT ?"""
+
+SELECT_USERS = f"""SELECT {CHAT_STATE_COLUMNS} FROM latest_state ORDER BY id DESC LIMIT ?"""
+
+UPDATE_INTENT = """UPDATE chat_state SET intent = ? WHERE id = ?"""
+
+UPDATE_LATEST_INTENT = """UPDATE latest_state SET intent = ? WHERE user_id = ? AND id = ?"""
+
+SELECT_USER_STATUS = """SELECT * FROM user_status WHERE user_id = ?"""
+
+SELECT_ALL_USER_STATUS = """SELECT * FROM user_status"""
+
+UPSERT_USER_STATUS = """INSERT INTO user_status (user_id, user_name, u2u, timestamp, floor) VALUES (?, ?, ?, ?, ?)
+                         ON CONFLICT (user_id) DO UPDATE SET user_name = excluded.user_name, u2u = excluded.u2u,
+                         timestamp = excluded.timestamp, floor = excluded.floor"""
+
+INSERT_NEW_USER_STATUS = """INSERT OR IGNORE INTO user_status (user_id, user_name, u2u, timestamp, floor)
+                            VALUES (?, ?, ?, ?, ?)"""
+
+SELECT_INTENT_STATS = """SELECT day, intent, count, fallback_count, confidence_sum FROM intent_stats
+                         WHERE day >= ? AND day <= ? AND (? IS NULL OR intent = ?) ORDER BY day, intent"""
+
+SELECT_CHAT_STATE_BY_ID = """SELECT * FROM chat_state WHERE user_id = ? AND id = ?"""
+
+INSERT_CHAT_EVENT = """INSERT INTO chat_event (user_id, timestamp, snapshot, data) VALUES (?, ?, ?, ?)"""
+
+SELECT_LAST_EVENT = """SELECT id, timestamp FROM chat_event WHERE user_id = ? ORDER BY id DESC LIMIT 1"""
+
+SELECT_LAST_SNAPSHOT = """SELECT MAX(id) FROM chat_event WHERE user_id = ? AND snapshot = 1"""
+
+COUNT_EVENTS_AFTER = """SELECT COUNT(*) FROM chat_event WHERE user_id = ? AND id > ?"""
+
+# events of user from the last snapshot at or before the first requested id up to the last requested id
+SELECT_USER_EVENTS = """SELECT id, user_id, timestamp, snapshot, data FROM chat_event
+                        WHERE user_id = ? AND id <= ? AND id >= IFNULL((SELECT MAX(id) FROM chat_event
+                                                                        WHERE user_id = ? AND snapshot = 1 AND id <= ?), 0)
+                        ORDER BY id"""
+
+SELECT_USER_EVENT_IDS = """SELECT id FROM chat_event WHERE user_id = ? ORDER BY id DESC LIMIT 1 OFFSET ?"""
+
+SELECT_ALL_EVENT_IDS = """SELECT id, user_id FROM chat_event ORDER BY id DESC LIMIT ?"""
+
+SELECT_EVENT_DATA = """SELECT data FROM chat_event WHERE id = ?"""
+
+UPDATE_EVENT_DATA = """UPDATE chat_event SET data = ? WHERE id = ?"""
+
+LATEST_STATE_COLUMNS = CHAT_STATE_COLUMNS.split(", ")
+
+MAX_ID = 2 ** 63 - 1
+
+MAX_PAGE_SIZE = 1000
+
+# fields of fetch_history and their column expression in chat_state, text is the user message inside intent
+HISTORY_FIELDS = {column: column for column in LATEST_STATE_COLUMNS}
+HISTORY_FIELDS["text"] = "json_extract(intent, '$.text')"
+
+# fields of fetch_history that are in every chat_event row, the others need the states to be replayed
+EVENT_HISTORY_FIELDS = {
+    "id": "id",
+    "user_id": "user_id",
+    "timestamp": "timestamp",
+    "intent": "json_extract(data, '$.intent')",
+    "entities": "json_extract(data, '$.entities')",
+    "response": "json_extract(data, '$.response')",
+    "text": "json_extract(data, '$.intent.text')"
+}
+
+JSON_FIELDS = {"intent", "slots", "entities", "events", "button", "response", "synonym_dict"}
+
+STORAGE_MODES = ["full", "events"]
+
+# fields of a conversation state kept in the event log, the first ones are written in every delta
+TURN_FIELDS = ["intent", "entities", "response"]
+STATE_FIELDS = TURN_FIELDS + ["user_name", "version", "slots", "events", "button", "loop_stack", "synonym_dict",
+                              "fingerprint"]
 
 
 class ChatStateDB:
@@ -10,18 +108,54 @@ class ChatStateDB:
     chat_state database for storing user chat information.
     """
 
-    def __init__(self, db: str):
+    def __init__(self, db: str, cached_statements: int = 128, storage: str = "full", snapshot_interval: int = 20,
+                 journal_mode: str = "wal", synchronous: str = "normal", cache_size: int = -16000, mmap_size: int = 0,
+                 readers: int = 4, timeout: float = 5.0):
         """
         Create database object, which creates database and table  if not exists.
         :param db: path to database file.
+        :param cached_statements: number of prepared statements kept by each connection
+        :param storage: str - how the history of states is stored, one of
+                + full - every turn is a full row of chat_state
+                + events - every turn appends a delta (user text, intent, entities, changed slots, response) to
+                           chat_event and a full snapshot is written every snapshot_interval turns
+                history written in one mode is not read in the other, the latest state of users is kept in both
+        :param snapshot_interval: int - number of turns between two snapshots in events mode
+        :param journal_mode: str - SQLite journal mode, with wal the reads do not block the writes of chat turns
+        :param synchronous: str - SQLite synchronous level (off, normal, full, extra)
+        :param cache_size: int - page cache of each connection, pages if positive or KiB if negative
+        :param mmap_size: int - bytes of the database file read through memory mapping, 0 is disabled
+        :param readers: int - number of reader connections for the fetch methods, 0 reads with the writer connection
+        :param timeout: float - seconds to wait for a lock or a free reader connection
         """
-        try:
-            conn = sqlite3.connect(db)
-        except Exception as ex:
-            raise RuntimeError(f"Cannot connect to database {db} by error {ex}")
+        if storage not in STORAGE_MODES:
+            raise ValueError(f"storage must be one of {STORAGE_MODES}, not {storage}")
+
+        if snapshot_interval < 1:
+            raise ValueError(f"snapshot_interval must be a positive number, not {snapshot_interval}")
 
-        self.conn = conn
+        self.storage = storage
+        self.snapshot_interval = snapshot_interval
+
+        # number of deltas written after the last snapshot of user, cached to skip the lookups on every turn
+        self.since_snapshot: Dict[str, int] = dict()
+
+        self.pool = ConnectionPool(db, readers=readers, journal_mode=journal_mode, synchronous=synchronous,
+                                   cache_size=cache_size, mmap_size=mmap_size, timeout=timeout,
+                                   cached_statements=cached_statements)
+
+        # the writer connection, reads go through self.pool.read()
+        self.conn = self.pool.writer
         self.create_table()
+        migrate(self.conn)
+
+        # the full-text index is missing when the database was migrated by an SQLite without FTS5
+        try:
+            self.conn.execute("SELECT rowid FROM message_search LIMIT 0")
+            self.search_enabled = True
+
+        except sqlite3.OperationalError:
+            self.search_enabled = False
 
     def create_table(self):
         """
@@ -41,7 +175,8 @@ class ChatStateDB:
                 button text,
                 loop_stack int(10),
                 response text,
-                synonym_dict text)
+                synonym_dict text,
+                fingerprint text)
                 """
 
         try:
@@ -70,51 +205,85 @@ class ChatStateDB:
             raise RuntimeError(f"Cannot create table 'user_status' by error {ex}")
 
     @staticmethod
-    def replace_dict():
-        return {
-            "'": "__single_quote__"
-        }
-
-    @staticmethod
-    def revert_replace_dict():
-        return {v: k for k, v in ChatStateDB.replace_dict().items()}
-
-    @staticmethod
-    def convert_dict(dict_as_string: str, dictionary: Dict[str, Any]) -> str:
-        for key, value in dictionary.items():
-            dict_as_string = dict_as_string.replace(key, value)
-
-        return dict_as_string
-
-    def dump_data(self, intent: Dict[str, Any], entities: List[Dict[str, Any]], slots: Dict[str, Any],
+    def dump_data(intent: Dict[str, Any], entities: List[Dict[str, Any]], slots: Dict[str, Any],
                   events: Dict[str, Any], button: Dict[str, Any], response: Dict[str, Any],
                   synonym_dict: Dict[str, Any]) -> Tuple:
         return (
-            self.convert_dict(json.dumps(intent), dictionary=self.replace_dict()),
-            self.convert_dict(json.dumps(entities), dictionary=self.replace_dict()),
-            self.convert_dict(json.dumps(slots), dictionary=self.replace_dict()),
-            self.convert_dict(json.dumps(events), dictionary=self.replace_dict()),
-            None if not button else self.convert_dict(json.dumps(button), dictionary=self.replace_dict()),
-            None if not response else self.convert_dict(json.dumps(response), dictionary=self.replace_dict()),
-            None if not synonym_dict else self.convert_dict(json.dumps(synonym_dict), dictionary=self.replace_dict())
+            json.dumps(intent),
+            json.dumps(entities),
+            json.dumps(slots),
+            json.dumps(events),
+            None if not button else json.dumps(button),
+            None if not response else json.dumps(response),
+            None if not synonym_dict else json.dumps(synonym_dict)
         )
 
-    def load_data(self, intent: str, entities: str, slots: str, events: str, button: str, response: str,
+    @staticmethod
+    def load_data(intent: str, entities: str, slots: str, events: str, button: str, response: str,
                   synonym_dict: str) -> Tuple:
         return (
-            json.loads(self.convert_dict(intent, dictionary=self.revert_replace_dict())),
-            json.loads(self.convert_dict(entities, dictionary=self.revert_replace_dict())),
-            json.loads(self.convert_dict(slots, dictionary=self.revert_replace_dict())),
-            json.loads(self.convert_dict(events, dictionary=self.revert_replace_dict())),
-            None if not button else json.loads(self.convert_dict(button, dictionary=self.revert_replace_dict())),
-            None if not response else json.loads(self.convert_dict(response, dictionary=self.revert_replace_dict())),
-            None if not synonym_dict else json.loads(
-                self.convert_dict(synonym_dict, dictionary=self.revert_replace_dict())),
+            json.loads(intent),
+            json.loads(entities),
+            json.loads(slots),
+            json.loads(events),
+            None if not button else json.loads(button),
+            None if not response else json.loads(response),
+            None if not synonym_dict else json.loads(synonym_dict)
+        )
+
+    def _to_chat_state(self, row: Tuple) -> Dict[str, Any]:
+        """
+        Convert a chat_state row to dictionary
+        :param row: tuple - row of chat_state
+        :return: dict(id, user_id, version, intent, slots, entities, timestamp, events, button, loop_stack, response, synonym_dict, fingerprint)
+        """
+        intent, entities, slots, events, button, response, synonym_dict = self.load_data(row[4], row[6], row[5],
+                                                                                         row[8], row[9],
+                                                                                         row[11], row[12])
+        return dict(
+            id=row[0],
+            user_id=row[1],
+            user_name=row[2],
+            version=row[3],
+            intent=intent,
+            slots=slots,
+            entities=entities,
+            timestamp=row[7],
+            events=events,
+            button=button,
+            loop_stack=row[10],
+            response=response,
+            synonym_dict=synonym_dict,
+            fingerprint=row[13]
+        )
+
+    def _to_chat_states(self, rows: List[Tuple]) -> List[Dict[str, Any]]:
+        messages = []
+        for row in rows:
+            try:
+                messages.append(self._to_chat_state(row))
+
+            except Exception as ex:
+                warnings.warn(f"Cannot convert intent/entities/slots from text format by error {ex}")
+
+        return messages
+
+    @staticmethod
+    def _to_user_status(row: Tuple) -> Dict[str, Any]:
+        return dict(
+            id=row[0],
+            user_id=row[1],
+            user_name=row[2],
+            u2u=row[3],
+            timestamp=row[4],
+            floor=row[5]
         )
 
     def insert_table(self, user_id: str, user_name: str, version: str, intent: Dict[str, Any], slots: Dict[str, Any],
                      entities: List[Dict[str, Any]], events: Dict[str, Any], button: Dict[str, Any],
-                     loop_stack: int = 0, response: Dict[str, Any] = None, synonym_dict: Dict[str, Any] = None):
+                     loop_stack: int = 0, response: Dict[str, Any] = None, synonym_dict: Dict[str, Any] = None,
+                     timestamp: float = None, fingerprint: str = None,
+                     turn_stats: List[Tuple[float, str, bool, float]] = None, commit: bool = True):
         """
         Insert conversation state into database
         :param user_id: str - unique user identifier
@@ -128,6 +297,11 @@ class ChatStateDB:
         :param loop_stack: int - chat state's loop stack
         :param response: dict(text, button) - response of chatbot
         :param synonym_dict: dict() - synonym dict for button
+        :param timestamp: float - time of the turn, default is now
+        :param fingerprint: str - fingerprint of the domain and flow config the state was validated with
+        :param turn_stats: list(tuple(timestamp, intent, fallback, top confidence)) - NLU predictions of the turns
+                           since the last save of the state, counted in intent_stats
+        :param commit: bool - commit the transaction after inserting
         :return: None
         """
         if not isinstance(user_id, str):
@@ -139,6 +313,10 @@ class ChatStateDB:
         if not isinstance(version, str):
             raise ValueError(f"version must be a string not {version}: {type(version)}")
 
+        state = dict(intent=intent, entities=entities, response=response, user_name=user_name, version=version,
+                     slots=slots, events=events, button=button, loop_stack=loop_stack, synonym_dict=synonym_dict,
+                     fingerprint=fingerprint)
+
         try:
             intent, entities, slots, events, button, response, synonym_dict = self.dump_data(intent, entities, slots,
                                                                                              events, button,
@@ -147,61 +325,221 @@ class ChatStateDB:
         except Exception as ex:
             raise RuntimeWarning(f"Cannot convert intent/slots/entities/events/button to text format by error {ex}")
 
-        sql_statement = f"""INSERT INTO chat_state (user_id, user_name, version, intent, slots, entities, timestamp, events, button, loop_stack, response, synonym_dict) 
-                            VALUES ('{user_id}', '{user_name}', '{version}', '{intent}', '{slots}', '{entities}', {datetime.today().timestamp()}, '{events}', {("'" + button + "'") if button else "NULL"}, {loop_stack}, {"'" + response + "'" if response else "NULL"}, {"'" + synonym_dict + "'" if synonym_dict else "NULL"})"""
+        if timestamp is None:
+            timestamp = datetime.today().timestamp()
+
+        row = (user_id, user_name, version, intent, slots, entities, timestamp, events, button, loop_stack, response,
+               synonym_dict, fingerprint)
+
+        with self.pool.write() as conn:
+            try:
+                c = conn.cursor()
+                if self.storage == "events":
+                    state_id = self._append_event(c, row, state)
+
+                else:
+                    c.execute(INSERT_CHAT_STATE, row)
+                    state_id = c.lastrowid
+
+                c.execute(UPSERT_LATEST_STATE, (state_id,) + row)
+                c.execute(INSERT_NEW_USER_STATUS, (user_id, user_name, False, timestamp, "not set"))
+                if turn_stats:
+                    add_turns(c, turn_stats)
+
+                if self.search_enabled:
+                    source = SOURCES["chat_event" if self.storage == "events" else "chat_state"]
+                    index_turn(c, source, state_id, user_id, timestamp, state["intent"], state["response"])
+
+                if commit:
+                    conn.commit()
+
+            except Exception as ex:
+                if commit:
+                    conn.rollback()
+                    self.since_snapshot.clear()
+
+                raise RuntimeWarning(f"Cannot insert data into table with error {ex}")
+
+    def _append_event(self, c: sqlite3.Cursor, row: Tuple, state: Dict[str, Any]) -> int:
+        """
+        Append the state to chat_event, as a delta from the latest state of user or as a full snapshot
+        :param c: sqlite3.Cursor - cursor of the current transaction
+        :param row: tuple - the state as a row of latest_state without id
+        :param state: dict(intent, entities, response, ...) - the state before converting to text
+        :return: int - id of the event
+        """
+        user_id, timestamp = row[0], row[6]
+        previous = c.execute(SELECT_CHAT_STATE, (user_id,)).fetchone()
+
+        since = self.since_snapshot.get(user_id, None)
+        if since is None and previous is not None:
+            # the delta chain is only valid when the latest state was written to the log (not in full mode)
+            snapshot_id = c.execute(SELECT_LAST_SNAPSHOT, (user_id,)).fetchone()[0]
+            last_event = c.execute(SELECT_LAST_EVENT, (user_id,)).fetchone()
+
+            if snapshot_id is not None and last_event == (previous[0], previous[7]):
+                since = c.execute(COUNT_EVENTS_AFTER, (user_id, snapshot_id)).fetchone()[0]
+
+        if since is None or since + 1 >= self.snapshot_interval:
+            snapshot, data = True, state
+            self.since_snapshot[user_id] = 0
+
+        else:
+            snapshot, data = False, self._delta(dict(zip(LATEST_STATE_COLUMNS[1:], previous[1:])),
+                                                dict(zip(LATEST_STATE_COLUMNS[1:], row)), state)
+            self.since_snapshot[user_id] = since + 1
+
+        c.execute(INSERT_CHAT_EVENT, (user_id, timestamp, snapshot, json.dumps(data)))
+
+        return c.lastrowid
+
+    @staticmethod
+    def _delta(previous: Dict[str, Any], current: Dict[str, Any], state: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Fields of state that changed since the previous state, the turn fields are always kept
+        :param previous: dict(column: value) - latest_state row of the previous state
+        :param current: dict(column: value) - latest_state row of the new state
+        :param state: dict(field: value) - the new state before converting to text
+        :return: dict(field: value), slots only has the changed slots and unset_slots the removed ones
+        """
+        delta = {field: state[field] for field in TURN_FIELDS}
+
+        for field in STATE_FIELDS[len(TURN_FIELDS):]:
+            if current[field] == previous[field]:
+                continue
+
+            if field == "slots":
+                slots = json.loads(previous["slots"])
+                delta["slots"] = {name: value for name, value in state["slots"].items()
+                                  if name not in slots or slots[name] != value}
+
+                unset_slots = [name for name in slots if name not in state["slots"]]
+                if unset_slots:
+                    delta["unset_slots"] = unset_slots
+
+            else:
+                delta[field] = state[field]
+
+        return delta
 
+    @staticmethod
+    def _replay(rows: List[Tuple], current: Dict[str, Dict[str, Any]] = None) -> List[Dict[str, Any]]:
+        """
+        Reconstruct the states from chat_event rows, every user must start with a snapshot
+        :param rows: list(tuple(id, user_id, timestamp, snapshot, data)) - rows ordered by id
+        :param current: optional(dict(user_id: state)) - latest replayed state of users, updated in place, used to
+                        replay the rows chunk by chunk
+        :return: list(dict(id, user_id, version, intent, slots, entities, timestamp, events, button, loop_stack, response, synonym_dict, fingerprint))
+        """
+        if current is None:
+            current = dict()
+
+        states = []
+
+        for state_id, user_id, timestamp, snapshot, data in rows:
+            try:
+                data = json.loads(data)
+
+            except Exception as ex:
+                warnings.warn(f"Cannot convert event {state_id} from text format by error {ex}")
+                current.pop(user_id, None)
+                continue
+
+            if snapshot:
+                state = data
+
+            elif user_id in current:
+                state = dict(current[user_id])
+                if "slots" in data or "unset_slots" in data:
+                    slots = dict(state["slots"])
+                    slots.update(data.pop("slots", {}))
+                    for name in data.pop("unset_slots", []):
+                        slots.pop(name, None)
+
+                    state["slots"] = slots
+
+                state.update(data)
+
+            else:
+                warnings.warn(f"Cannot reconstruct event {state_id} of user {user_id} without its snapshot")
+                continue
+
+            current[user_id] = state
+            states.append(dict(
+                id=state_id,
+                user_id=user_id,
+                user_name=state["user_name"],
+                version=state["version"],
+                intent=state["intent"],
+                slots=state["slots"],
+                entities=state["entities"],
+                timestamp=timestamp,
+                events=state["events"],
+                button=state["button"],
+                loop_stack=state["loop_stack"],
+                response=state["response"],
+                synonym_dict=state["synonym_dict"],
+                fingerprint=state["fingerprint"]
+            ))
+
+        return states
+
+    def _fetch_events(self, user_id: str, first_id: int, last_id: int = MAX_ID) -> List[Dict[str, Any]]:
+        """
+        Reconstruct the states of user with id between first_id and last_id from the event log
+        :param user_id: str - unique identifier of the user
+        :param first_id: int - id of the first state
+        :param last_id: int - id of the last state
+        :return: list(dict) - states ordered by id
+        """
         try:
-            c = self.conn.cursor()
-            c.execute(sql_statement)
-            self.conn.commit()
+            with self.pool.read() as conn:
+                rows = conn.execute(SELECT_USER_EVENTS, (user_id, last_id, user_id, first_id)).fetchall()
 
         except Exception as ex:
-            raise RuntimeWarning(f"Cannot insert data into table with error {ex}")
+            warnings.warn(f"Cannot fetch events of user {user_id} by error {ex}")
+            return []
 
-        user_status = self.get_user_status(user_id=user_id)
+        return [state for state in self._replay(rows) if state["id"] >= first_id]
+
+    def insert_many(self, states: List[Dict[str, Any]]):
+        """
+        Insert several conversation states in one transaction
+        :param states: list(dict) - keyword arguments of insert_table for each state
+        :return: None
+        """
+        with self.pool.write() as conn:
+            try:
+                for state in states:
+                    self.insert_table(**state, commit=False)
 
-        if not user_status:
-            self.change_user_status(user_id=user_id, user_name=user_name, u2u=False, floor="not set")
+                conn.commit()
 
-    def fetch_chat_state(self, user_id: str) -> Dict[str, Any]:
+            except Exception as ex:
+                conn.rollback()
+                self.since_snapshot.clear()
+                raise RuntimeWarning(f"Cannot insert {len(states)} states into table with error {ex}")
+
+    def fetch_chat_state(self, user_id: str) -> Optional[Dict[str, Any]]:
         """
         Get the conversation state of user
         :param user_id: str - unique identifier of the user
-        :return: dict(id, user_id, version, intent, slots, entities, timestamp, events, button, loop_stack, response, synonym_dict)
+        :return: dict(id, user_id, version, intent, slots, entities, timestamp, events, button, loop_stack, response, synonym_dict, fingerprint)
         """
-        sql_statement = f"""SELECT * FROM chat_state 
-                            WHERE user_id = '{user_id}'
-                            ORDER BY id DESC LIMIT 1"""
-
         try:
-            c = self.conn.cursor()
-            result = c.execute(sql_statement).fetchone()
+            with self.pool.read() as conn:
+                result = conn.execute(SELECT_CHAT_STATE, (user_id,)).fetchone()
 
         except Exception as ex:
             result = None
             warnings.warn(f"Cannot fetch chat state of user {user_id} by error {ex}")
 
+        if result is None:
+            return None
+
         chat_state = None
         try:
-            intent, entities, slots, events, button, response, synonym_dict = self.load_data(result[4], result[6],
-                                                                                             result[5],
-                                                                                             result[8], result[9],
-                                                                                             result[11], result[12])
-            chat_state = dict(
-                id=result[0],
-                user_id=result[1],
-                user_name=result[2],
-                version=result[3],
-                intent=intent,
-                slots=slots,
-                entities=entities,
-                timestamp=result[7],
-                events=events,
-                button=button,
-                loop_stack=result[10],
-                response=response,
-                synonym_dict=synonym_dict
-            )
+            chat_state = self._to_chat_state(result)
 
         except Exception as ex:
             warnings.warn(f"Cannot convert intent/entities/slots from text format by error {ex}")
@@ -209,38 +547,54 @@ class ChatStateDB:
         return chat_state
 
     def modify_chat_state(self, user_id, select_intent: str) -> bool:
+        """
+        Set the intent selected by CMS operator on the latest state of user
+        :param user_id: str - unique identifier of the user
+        :param select_intent: str - name of selected intent
+        :return: bool - modified or not
+        """
+        # the latest state must not change between reading and updating it
+        with self.pool.write() as conn:
+            chat_state = self.fetch_chat_state(user_id=user_id)
 
-        chat_state = self.fetch_chat_state(user_id=user_id)
+            if not chat_state:
+                return False
 
-        if not chat_state:
-            return False
+            intent = chat_state["intent"]
 
-        intent = chat_state["intent"]
+            if intent.get("intent_ranking", None):
+                del intent["intent_ranking"]
 
-        if intent.get("intent_ranking", None):
-            del intent["intent_ranking"]
+            intent["select_intent"] = select_intent
 
-        intent["select_intent"] = select_intent
+            try:
+                if self.storage == "events":
+                    event = json.loads(conn.execute(SELECT_EVENT_DATA, (chat_state["id"],)).fetchone()[0])
+                    event["intent"] = intent
+                    event = json.dumps(event)
 
-        try:
-            intent = self.convert_dict(json.dumps(intent), dictionary=self.replace_dict())
+                intent = json.dumps(intent)
 
-        except Exception as ex:
-            warnings.warn(f"Cannot convert intent {intent} to text format by error {ex}")
-            return False
+            except Exception as ex:
+                warnings.warn(f"Cannot convert intent {intent} to text format by error {ex}")
+                return False
 
-        sql_statement = f"""UPDATE chat_state SET intent = '{intent}' WHERE user_id = '{user_id}'"""
+            try:
+                c = conn.cursor()
+                if self.storage == "events":
+                    c.execute(UPDATE_EVENT_DATA, (event, chat_state["id"]))
 
-        try:
-            c = self.conn.cursor()
-            c.execute(sql_statement)
-            self.conn.commit()
+                else:
+                    c.execute(UPDATE_INTENT, (intent, chat_state["id"]))
 
-        except Exception as ex:
-            warnings.warn(f"Cannot update data into table with error {ex}")
-            return False
+                c.execute(UPDATE_LATEST_INTENT, (intent, user_id, chat_state["id"]))
+                conn.commit()
+
+            except Exception as ex:
+                warnings.warn(f"Cannot update data into table with error {ex}")
+                return False
 
-        return True
+            return True
 
     def fetch_user_messages(self, user_id: str, limit: int = 100) -> List[Dict[str, Any]]:
         """
@@ -249,44 +603,26 @@ class ChatStateDB:
         :param limit: number of query row
         :return: list(dict(id, user_id, version, intent, slots, entities, timestamp, events, button, loop_stack, response))
         """
-        sql_statement = f"""SELECT * FROM chat_state 
-                                    WHERE user_id = '{user_id}'
-                                    ORDER BY id DESC LIMIT {limit}"""
+        if self.storage == "events":
+            try:
+                with self.pool.read() as conn:
+                    first = conn.execute(SELECT_USER_EVENT_IDS, (user_id, limit - 1)).fetchone()
+
+            except Exception as ex:
+                warnings.warn(f"Cannot fetch chat state of user {user_id} by error {ex}")
+                return []
+
+            return self._fetch_events(user_id, 0 if first is None else first[0])[::-1][:limit]
 
         try:
-            c = self.conn.cursor()
-            result = c.execute(sql_statement).fetchall()
+            with self.pool.read() as conn:
+                result = conn.execute(SELECT_USER_MESSAGES, (user_id, limit)).fetchall()
 
         except Exception as ex:
-            result = None
+            result = []
             warnings.warn(f"Cannot fetch chat state of user {user_id} by error {ex}")
 
-        user_messages = []
-        for row in result:
-            try:
-                intent, entities, slots, events, button, response, synonym_dict = self.load_data(row[4], row[6], row[5],
-                                                                                                 row[8], row[9],
-                                                                                                 row[11], row[12])
-                user_messages.append(dict(
-                    id=row[0],
-                    user_id=row[1],
-                    user_name=row[2],
-                    version=row[3],
-                    intent=intent,
-                    slots=slots,
-                    entities=entities,
-                    timestamp=row[7],
-                    events=events,
-                    button=button,
-                    loop_stack=row[10],
-                    response=response,
-                    synonym_dict=synonym_dict
-                ))
-
-            except Exception as ex:
-                warnings.warn(f"Cannot convert intent/entities/slots from text format by error {ex}")
-
-        return user_messages
+        return self._to_chat_states(result)
 
     def fetch_all_messages(self, limit: int = 100) -> List[Dict[str, Any]]:
         """
@@ -294,42 +630,205 @@ class ChatStateDB:
         :param limit: number of query row
         :return: list(dict(id, user_id, version, intent, slots, entities, timestamp, events, button, loop_stack, response))
         """
-        sql_statement = f"""SELECT * FROM chat_state ORDER BY id DESC LIMIT {limit}"""
+        if self.storage == "events":
+            try:
+                with self.pool.read() as conn:
+                    rows = conn.execute(SELECT_ALL_EVENT_IDS, (limit,)).fetchall()
+
+            except Exception as ex:
+                warnings.warn(f"Cannot fetch chat state by error {ex}")
+                return []
+
+            return self._replay_rows(rows)
 
         try:
-            c = self.conn.cursor()
-            result = c.execute(sql_statement).fetchall()
+            with self.pool.read() as conn:
+                result = conn.execute(SELECT_ALL_MESSAGES, (limit,)).fetchall()
 
         except Exception as ex:
-            result = 0
+            result = []
             warnings.warn(f"Cannot fetch chat state by error {ex}")
 
+        return self._to_chat_states(result)
+
+    def _replay_rows(self, rows: List[Tuple[int, str]]) -> List[Dict[str, Any]]:
+        """
+        Reconstruct the states of the given chat_event ids
+        :param rows: list(tuple(id, user_id)) - ids of the states ordered by id descending
+        :return: list(dict) - states ordered by id descending
+        """
+        if not rows:
+            return []
+
+        ids = {state_id for state_id, _ in rows}
+        first_ids: Dict[str, int] = dict()
+        for state_id, user_id in rows:
+            first_ids[user_id] = state_id
+
+        messages = [state for user_id, first_id in first_ids.items()
+                    for state in self._fetch_events(user_id, first_id, rows[0][0]) if state["id"] in ids]
+
+        return sorted(messages, key=lambda state: state["id"], reverse=True)
+
+    def fetch_history(self, user_id: str = None, before: int = None, since: float = None, limit: int = 100,
+                      fields: List[str] = None) -> Tuple[List[Dict[str, Any]], Optional[int]]:
+        """
+        Get one page of states, newest first, paginated by id so every page is an index range scan
+        :param user_id: optional(str) - only the states of this user, default is all users
+        :param before: optional(int) - cursor, only the states with id lower than it (next of the previous page)
+        :param since: optional(float) - only the states with timestamp at or after it
+        :param limit: int - number of states of the page
+        :param fields: optional(list(str)) - fields of the states, only these columns are read and decoded,
+                       default is all fields, text is the user message
+        :return: tuple(list(dict), optional(int)) - states of the page and the cursor of the next page
+        """
+        if not 0 < limit <= MAX_PAGE_SIZE:
+            raise ValueError(f"limit must be between 1 and {MAX_PAGE_SIZE}, not {limit}")
+
+        if fields is None:
+            fields = LATEST_STATE_COLUMNS
+
+        for field in fields:
+            if field not in HISTORY_FIELDS:
+                raise ValueError(f"field must be one of {list(HISTORY_FIELDS.keys())}, not {field}")
+
+        replay = self.storage == "events" and not all(field in EVENT_HISTORY_FIELDS for field in fields)
+        if self.storage == "events":
+            table, expressions = "chat_event", [] if replay else [EVENT_HISTORY_FIELDS[field] for field in fields]
+
+        else:
+            table, expressions = "chat_state", [HISTORY_FIELDS[field] for field in fields]
+
+        conditions, parameters = ["id < ?"], [MAX_ID if before is None else before]
+        if user_id is not None:
+            conditions.append("user_id = ?")
+            parameters.append(user_id)
+
+        if since is not None:
+            # the lowest id in the timestamp index bounds the scan by id, even if timestamps are not in id order
+            conditions.append(f"id >= IFNULL((SELECT MIN(id) FROM {table} WHERE timestamp >= ?), ?) AND timestamp >= ?")
+            parameters.extend([since, MAX_ID, since])
+
+        # the expressions come from HISTORY_FIELDS, the values are bound
+        sql_statement = f"""SELECT {", ".join(["id", "user_id"] + expressions)} FROM {table}
+                            WHERE {" AND ".join(conditions)} ORDER BY id DESC LIMIT ?"""
+
+        try:
+            with self.pool.read() as conn:
+                rows = conn.execute(sql_statement, parameters + [limit]).fetchall()
+
+        except Exception as ex:
+            warnings.warn(f"Cannot fetch history by error {ex}")
+            return [], None
+
+        next_cursor = rows[-1][0] if len(rows) == limit else None
+
+        if replay:
+            # text is not a column of the replayed states, it is the user message kept in the intent
+            return [{field: (state["intent"] or dict()).get("text", None) if field == "text" else state[field]
+                     for field in fields} for state in self._replay_rows(rows)], next_cursor
+
         messages = []
-        for row in result:
+        for row in rows:
             try:
-                intent, entities, slots, events, button, response, synonym_dict = self.load_data(row[4], row[6], row[5],
-                                                                                                 row[8], row[9],
-                                                                                                 row[11], row[12])
-                messages.append(dict(
-                    id=row[0],
-                    user_id=row[1],
-                    user_name=row[2],
-                    version=row[3],
-                    intent=intent,
-                    slots=slots,
-                    entities=entities,
-                    timestamp=row[7],
-                    events=events,
-                    button=button,
-                    loop_stack=row[10],
-                    response=response,
-                    synonym_dict=synonym_dict
-                ))
+                messages.append({field: json.loads(value) if field in JSON_FIELDS and value is not None else value
+                                 for field, value in zip(fields, row[2:])})
 
             except Exception as ex:
-                warnings.warn(f"Cannot convert intent/entities/slots from text format by error {ex}")
+                warnings.warn(f"Cannot convert state {row[0]} from text format by error {ex}")
 
-        return messages
+        return messages, next_cursor
+
+    def fetch_state_at(self, user_id: str, state_id: int) -> Optional[Dict[str, Any]]:
+        """
+        Get a historical state of user
+        :param user_id: str - unique identifier of the user
+        :param state_id: int - id of the state, as returned by fetch_user_messages
+        :return: dict(id, user_id, version, intent, slots, entities, timestamp, events, button, loop_stack, response, synonym_dict, fingerprint)
+        """
+        if self.storage == "events":
+            states = self._fetch_events(user_id, state_id, state_id)
+
+            return states[0] if states else None
+
+        try:
+            with self.pool.read() as conn:
+                result = conn.execute(SELECT_CHAT_STATE_BY_ID, (user_id, state_id)).fetchall()
+
+        except Exception as ex:
+            result = []
+            warnings.warn(f"Cannot fetch chat state {state_id} of user {user_id} by error {ex}")
+
+        states = self._to_chat_states(result)
+
+        return states[0] if states else None
+
+    def fetch_intent_stats(self, start: str = None, end: str = None, intent: str = None) -> List[Dict[str, Any]]:
+        """
+        Get the rollup of turns per day and top ranked intent
+        :param start: optional(str) - first day, YYYY-MM-DD
+        :param end: optional(str) - last day, YYYY-MM-DD
+        :param intent: optional(str) - only this intent
+        :return: list(dict(day, intent, count, fallback_count, mean_confidence))
+        """
+        try:
+            with self.pool.read() as conn:
+                result = conn.execute(SELECT_INTENT_STATS, (start or "", end or "9999-12-31", intent,
+                                                            intent)).fetchall()
+
+        except Exception as ex:
+            result = []
+            warnings.warn(f"Cannot fetch intent stats by error {ex}")
+
+        return [dict(
+            day=day,
+            intent=intent_name,
+            count=count,
+            fallback_count=fallback_count,
+            mean_confidence=confidence_sum / count if count else 0.0
+        ) for day, intent_name, count, fallback_count, confidence_sum in result]
+
+    def search_messages(self, query: str, user_id: str = None, field: str = None, start: float = None,
+                        end: float = None, limit: int = 20,
+                        offset: int = 0) -> Tuple[List[Dict[str, Any]], Optional[int]]:
+        """
+        Full-text search of the user messages and responses, best match first
+        :param query: str - words that must all match, "quoted words" match as a phrase and word* as prefix
+        :param user_id: optional(str) - only the messages of this user
+        :param field: optional(str) - only search text (user message) or response, default is both
+        :param start: optional(float) - only the messages with timestamp at or after it
+        :param end: optional(float) - only the messages with timestamp before it
+        :param limit: int - number of messages of the page
+        :param offset: int - number of messages skipped (next of the previous page)
+        :return: tuple(list(dict(id, source, user_id, timestamp, text, response, snippet, rank)), optional(int)) -
+                 messages of the page and the offset of the next page, id is the id of the state in the table of source
+                 (state or event)
+        """
+        if not self.search_enabled:
+            raise RuntimeError("Full-text search is not available, SQLite is built without FTS5")
+
+        if not 0 < limit <= MAX_PAGE_SIZE:
+            raise ValueError(f"limit must be between 1 and {MAX_PAGE_SIZE}, not {limit}")
+
+        if offset < 0:
+            raise ValueError(f"offset must not be negative, not {offset}")
+
+        with self.pool.read() as conn:
+            rows = conn.execute(SEARCH_MESSAGES, (match_query(query, field), user_id, user_id, start, start, end, end,
+                                                  limit, offset)).fetchall()
+
+        messages = [dict(
+            id=state_id,
+            source=source,
+            user_id=row_user_id,
+            timestamp=timestamp,
+            text=text,
+            response=response,
+            snippet=snippet,
+            rank=rank
+        ) for source, state_id, row_user_id, timestamp, text, response, snippet, rank in rows]
+
+        return messages, offset + limit if len(rows) == limit else None
 
     def fetch_users(self, limit: int = 100) -> List[Dict[str, Any]]:
         """
@@ -338,122 +837,87 @@ class ChatStateDB:
         :param limit: number of user to fetch
         :return: list(dict(id, user_id, version, intent, slots, entities, timestamp, events, button, loop_stack, response))
         """
-        sql_statement = f"""SELECT MAX(id) AS [id], user_id, version, intent, slots, entities, timestamp, events, button
-                            FROM chat_state
-                            GROUP BY user_id
-                            LIMIT {limit}"""
-
         try:
-            c = self.conn.cursor()
-            result = c.execute(sql_statement).fetchall()
+            with self.pool.read() as conn:
+                result = conn.execute(SELECT_USERS, (limit,)).fetchall()
 
         except Exception as ex:
             warnings.warn(f"Cannot fetch users state by error {ex}")
             result = []
 
-        messages = []
-        for row in result:
-            try:
-                intent, entities, slots, events, button, response, synonym_dict = self.load_data(row[4], row[6], row[5],
-                                                                                                 row[8], row[9],
-                                                                                                 row[11], row[12])
-                messages.append(dict(
-                    id=row[0],
-                    user_id=row[1],
-                    user_name=row[2],
-                    version=row[3],
-                    intent=intent,
-                    slots=slots,
-                    entities=entities,
-                    timestamp=row[7],
-                    events=events,
-                    button=button,
-                    loop_stack=row[10],
-                    response=response,
-                    synonym_dict=synonym_dict
-                ))
-
-            except Exception as ex:
-                warnings.warn(f"Cannot convert intent/entities/slots/events/button from text format by error {ex}")
-
-        return messages
-
-    def get_user_status(self, user_id) -> Dict[str, Any]:
-        sql_statement = f"""SELECT * FROM user_status 
-                                    WHERE user_id = '{user_id}'
-                                    ORDER BY id DESC LIMIT 1"""
+        return self._to_chat_states(result)
 
+    def get_user_status(self, user_id) -> Optional[Dict[str, Any]]:
         try:
-            c = self.conn.cursor()
-            result = c.execute(sql_statement).fetchone()
+            with self.pool.read() as conn:
+                result = conn.execute(SELECT_USER_STATUS, (user_id,)).fetchone()
 
         except Exception as ex:
             result = None
             warnings.warn(f"Cannot fetch status of user {user_id} by error {ex}")
 
-        status = None
-        try:
-            status = dict(
-                id=result[0],
-                user_id=result[1],
-                user_name=result[2],
-                u2u=result[3],
-                timestamp=result[4],
-                floor=result[5]
-            )
+        if result is None:
+            return None
 
-        except Exception as ex:
-            warnings.warn(f"Cannot convert user status {ex}")
+        return self._to_user_status(result)
 
-        return status
+    def change_user_status(self, user_id: str, user_name: str, u2u: bool, floor: str, commit: bool = True):
+        with self.pool.write() as conn:
+            try:
+                c = conn.cursor()
+                c.execute(UPSERT_USER_STATUS, (user_id, user_name, bool(u2u), datetime.today().timestamp(), floor))
 
-    def change_user_status(self, user_id: str, user_name: str, u2u: bool, floor: str):
-        current_status = self.get_user_status(user_id=user_id)
+                if commit:
+                    conn.commit()
 
-        if not current_status:
-            sql_statement = f"""INSERT INTO user_status (user_id, user_name, u2u, timestamp, floor) VALUES ('{user_id}', '{user_name}', {"TRUE" if u2u else "FALSE"}, {datetime.today().timestamp()}, '{floor}')"""
+            except Exception as ex:
+                raise RuntimeWarning(f"Cannot insert data into table with error {ex}")
 
-        else:
-            sql_statement = f"""UPDATE user_status SET user_name = '{user_name}', u2u = {"TRUE" if u2u else "FALSE"}, timestamp = {datetime.today().timestamp()}, floor = '{floor}' WHERE user_id = '{user_id}'"""
+    def change_user_statuses(self, statuses: List[Dict[str, Any]]):
+        """
+        Write the status of several users in one transaction, keeping their own timestamps
+        :param statuses: list(dict(user_id, user_name, u2u, timestamp, floor)) - status of each user
+        :return: None
+        """
+        if not statuses:
+            return
 
-        try:
-            c = self.conn.cursor()
-            c.execute(sql_statement)
-            self.conn.commit()
+        with self.pool.write() as conn:
+            try:
+                conn.executemany(UPSERT_USER_STATUS, [(status["user_id"], status["user_name"], bool(status["u2u"]),
+                                                       status["timestamp"], status["floor"]) for status in statuses])
+                conn.commit()
 
-        except Exception as ex:
-            raise RuntimeWarning(f"Cannot insert data into table with error {ex}")
+            except Exception as ex:
+                conn.rollback()
+                raise RuntimeWarning(f"Cannot insert data into table with error {ex}")
 
     def fetch_arm_status(self) -> List[Dict[str, Any]]:
         """
-        Get the user states in database.
-        :param user_id: unique identifier of the user
-        :param limit: number of query row
-        :return: list(dict(id, user_id, version, intent, slots, entities, timestamp, events, button, loop_stack, response))
+        Get the status of all users.
+        :return: list(dict(id, user_id, user_name, u2u, timestamp, floor))
         """
-        sql_statement = f"""SELECT * FROM user_status"""
-
         try:
-            c = self.conn.cursor()
-            result = c.execute(sql_statement).fetchall()
+            with self.pool.read() as conn:
+                result = conn.execute(SELECT_ALL_USER_STATUS).fetchall()
 
         except Exception as ex:
-            result = None
-            warnings.warn(f"Cannot fetch arm status of user {user_id} by error {ex}")
+            result = []
+            warnings.warn(f"Cannot fetch arm status by error {ex}")
 
         arm_statuses = []
         for row in result:
             try:
-                arm_statuses.append(dict(
-                    id=row[0],
-                    user_id=row[1],
-                    user_name=row[2],
-                    u2u=row[3],
-                    timestamp=row[4],
-                    floor=row[5]
-            ))
+                arm_statuses.append(self._to_user_status(row))
 
             except Exception as ex:
                 warnings.warn(f"Cannot convert arm status format by error {ex}")
 
         return arm_statuses
+
+    def close(self):
+        """
+        Close the writer and reader connections
+        :return: None
+        """
+        self.pool.close()
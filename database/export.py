@@ -0,0 +1,287 @@
+import argparse
+import csv
+import io
+import json
+import os
+import sqlite3
+import sys
+import zlib
+from datetime import datetime
+from typing import Dict, List, Any, Tuple, Optional, Iterator
+
+sys.path.append(os.getcwd())
+
+from database.database import ChatStateDB, LATEST_STATE_COLUMNS, JSON_FIELDS, MAX_ID
+
+USER_STATUS_COLUMNS = ["id", "user_id", "user_name", "u2u", "timestamp", "floor"]
+
+EXPORT_TABLES = {
+    "chat_state": LATEST_STATE_COLUMNS,
+    "user_status": USER_STATUS_COLUMNS
+}
+
+EXPORT_FORMATS = ["ndjson", "csv"]
+
+CHUNK_SIZE = 1000
+
+# size of the text collected before it is (compressed and) yielded
+BUFFER_SIZE = 64 * 1024
+
+
+def _id_range(conn: sqlite3.Connection, table: str, start: Optional[float], end: Optional[float]) -> Tuple[int, int]:
+    """
+    Translate the date range to an id range with the timestamp index, so the chunks never scan outside it
+    :return: tuple(int, int) - exclusive lower id and inclusive upper id
+    """
+    low, high = 0, MAX_ID
+
+    if start is not None:
+        first = conn.execute(f"SELECT MIN(id) FROM {table} WHERE timestamp >= ?", (start,)).fetchone()[0]
+        low = MAX_ID if first is None else first - 1
+
+    if end is not None:
+        last = conn.execute(f"SELECT MAX(id) FROM {table} WHERE timestamp < ?", (end,)).fetchone()[0]
+        high = 0 if last is None else last
+
+    return low, high
+
+
+def _iter_chunks(conn: sqlite3.Connection, sql_statement: str, low: int, high: int, parameters: List[Any],
+                 chunk_size: int) -> Iterator[List[Tuple]]:
+    """
+    Run a keyset statement (id > ? AND id <= ? ... ORDER BY id LIMIT ?) chunk by chunk, each chunk is its own
+    query, so a long export does not hold a read transaction open
+    """
+    while low < high:
+        rows = conn.execute(sql_statement, [low, high] + parameters + [chunk_size]).fetchall()
+
+        if not rows:
+            return
+
+        yield rows
+
+        low = rows[-1][0]
+
+
+def iter_rows(db: ChatStateDB, table: str = "chat_state", start: float = None, end: float = None,
+              user_id: str = None, intent: str = None, chunk_size: int = CHUNK_SIZE) -> Iterator[Tuple]:
+    """
+    Rows of table in id order, the JSON columns are kept as text
+    :param db: ChatStateDB - database to export
+    :param table: str - one of EXPORT_TABLES
+    :param start: optional(float) - only rows with timestamp at or after it
+    :param end: optional(float) - only rows with timestamp before it
+    :param user_id: optional(str) - only rows of this user
+    :param intent: optional(str) - only chat_state rows with this predicted intent name
+    :param chunk_size: int - number of rows read per query
+    :return: iterator(tuple) - values in the order of EXPORT_TABLES[table]
+    """
+    # the connection is the export's own, a reload that closes the pool does not stop the stream
+    with db.pool.dedicated() as conn:
+        if table == "chat_state" and db.storage == "events":
+            yield from _iter_events(db, conn, start, end, user_id, intent, chunk_size)
+
+        else:
+            yield from _iter_table(conn, table, start, end, user_id, intent, chunk_size)
+
+
+def _iter_table(conn: sqlite3.Connection, table: str, start: Optional[float], end: Optional[float],
+                user_id: Optional[str], intent: Optional[str], chunk_size: int) -> Iterator[Tuple]:
+    """
+    Rows of a table stored as is, read by id ranges
+    """
+    conditions, parameters = ["id > ?", "id <= ?"], []
+    if start is not None:
+        conditions.append("timestamp >= ?")
+        parameters.append(start)
+
+    if end is not None:
+        conditions.append("timestamp < ?")
+        parameters.append(end)
+
+    if user_id is not None:
+        conditions.append("user_id = ?")
+        parameters.append(user_id)
+
+    if intent is not None:
+        conditions.append("json_extract(intent, '$.name') = ?")
+        parameters.append(intent)
+
+    sql_statement = f"""SELECT {", ".join(EXPORT_TABLES[table])} FROM {table}
+                        WHERE {" AND ".join(conditions)} ORDER BY id LIMIT ?"""
+
+    low, high = _id_range(conn, table, start, end)
+    for rows in _iter_chunks(conn, sql_statement, low, high, parameters, chunk_size):
+        yield from rows
+
+
+def _iter_events(db: ChatStateDB, conn: sqlite3.Connection, start: Optional[float], end: Optional[float],
+                 user_id: Optional[str], intent: Optional[str], chunk_size: int) -> Iterator[Tuple]:
+    """
+    chat_state rows of the events storage, replayed from the snapshots before the range, memory is bounded by
+    the number of users instead of the number of rows
+    """
+    low, high = _id_range(conn, "chat_event", start, end)
+    if low >= high:
+        return
+
+    user_condition, parameters = ("AND user_id = ?", [user_id]) if user_id is not None else ("", [])
+
+    # the replay starts from the oldest snapshot any user needs for the first row in range
+    first_snapshot = conn.execute(f"""SELECT MIN(snapshot_id) FROM (SELECT MAX(id) AS snapshot_id FROM chat_event
+                                      WHERE snapshot = 1 AND id <= ? {user_condition} GROUP BY user_id)""",
+                                  [low + 1] + parameters).fetchone()[0]
+
+    sql_statement = f"""SELECT id, user_id, timestamp, snapshot, data FROM chat_event
+                        WHERE id > ? AND id <= ? {user_condition} ORDER BY id LIMIT ?"""
+
+    current: Dict[str, Dict[str, Any]] = dict()
+    replay_from = low if first_snapshot is None else min(low, first_snapshot - 1)
+    for rows in _iter_chunks(conn, sql_statement, replay_from, high, parameters, chunk_size):
+        for state in db._replay(rows, current):
+            if state["id"] <= low or (start is not None and state["timestamp"] < start) or \
+                    (end is not None and state["timestamp"] >= end):
+                continue
+
+            if intent is not None and state["intent"].get("name", None) != intent:
+                continue
+
+            yield state_to_row(state)
+
+
+def state_to_row(state: Dict[str, Any]) -> Tuple:
+    """
+    Convert a replayed state to a chat_state row, the JSON columns as text
+    :param state: dict - state from ChatStateDB
+    :return: tuple - values in the order of LATEST_STATE_COLUMNS
+    """
+    return tuple(json.dumps(state[column]) if column in JSON_FIELDS and state[column] is not None
+                 else state[column] for column in LATEST_STATE_COLUMNS)
+
+
+def ndjson_lines(columns: List[str], rows: Iterator[Tuple]) -> Iterator[str]:
+    # JSON columns are already JSON text and are written as is, without decoding them
+    for row in rows:
+        yield "{" + ", ".join(f"{json.dumps(column)}: " +
+                              (value if column in JSON_FIELDS and value is not None else json.dumps(value))
+                              for column, value in zip(columns, row)) + "}\n"
+
+
+def csv_lines(columns: List[str], rows: Iterator[Tuple]) -> Iterator[str]:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    writer.writerow(columns)
+    for row in rows:
+        writer.writerow(row)
+
+        if buffer.tell() >= BUFFER_SIZE:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+
+    yield buffer.getvalue()
+
+
+def export(db: ChatStateDB, table: str = "chat_state", export_format: str = "ndjson", compress: bool = False,
+           start: float = None, end: float = None, user_id: str = None, intent: str = None,
+           chunk_size: int = CHUNK_SIZE) -> Iterator[bytes]:
+    """
+    Stream a table as NDJSON or CSV, the arguments are validated before the first chunk is produced
+    :param db: ChatStateDB - database to export
+    :param table: str - one of EXPORT_TABLES
+    :param export_format: str - one of EXPORT_FORMATS
+    :param compress: bool - gzip the output
+    :param start: optional(float) - only rows with timestamp at or after it
+    :param end: optional(float) - only rows with timestamp before it
+    :param user_id: optional(str) - only rows of this user
+    :param intent: optional(str) - only chat_state rows with this predicted intent name
+    :param chunk_size: int - number of rows read per query
+    :return: iterator(bytes) - chunks of the output
+    """
+    if table not in EXPORT_TABLES:
+        raise ValueError(f"table must be one of {list(EXPORT_TABLES.keys())}, not {table}")
+
+    if export_format not in EXPORT_FORMATS:
+        raise ValueError(f"format must be one of {EXPORT_FORMATS}, not {export_format}")
+
+    if intent is not None and table != "chat_state":
+        raise ValueError(f"intent filter is only available for chat_state, not {table}")
+
+    if chunk_size < 1:
+        raise ValueError(f"chunk_size must be a positive number, not {chunk_size}")
+
+    columns = EXPORT_TABLES[table]
+    rows = iter_rows(db, table=table, start=start, end=end, user_id=user_id, intent=intent, chunk_size=chunk_size)
+    lines = ndjson_lines(columns, rows) if export_format == "ndjson" else csv_lines(columns, rows)
+
+    return _encode(lines, compress)
+
+
+def _encode(lines: Iterator[str], compress: bool) -> Iterator[bytes]:
+    # wbits 31 writes the gzip header and trailer around the deflate stream
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None
+
+    parts, size = [], 0
+    for line in lines:
+        parts.append(line)
+        size += len(line)
+
+        if size >= BUFFER_SIZE:
+            data = "".join(parts).encode("utf-8")
+            parts, size = [], 0
+
+            data = compressor.compress(data) if compressor else data
+            if data:
+                yield data
+
+    data = "".join(parts).encode("utf-8")
+    if compressor:
+        data = compressor.compress(data) + compressor.flush()
+
+    if data:
+        yield data
+
+
+def parse_time(value: Optional[str]) -> Optional[float]:
+    """
+    Parse a timestamp or an ISO date (2021-06-01, 2021-06-01T08:00:00)
+    :param value: optional(str)
+    :return: optional(float) - timestamp
+    """
+    if value is None:
+        return None
+
+    try:
+        return float(value)
+
+    except ValueError:
+        return datetime.fromisoformat(value).timestamp()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export chat_state or user_status as NDJSON or CSV")
+    parser.add_argument("--db", default="database/test_db.db", help="path to SQLite database file")
+    parser.add_argument("--table", default="chat_state", choices=list(EXPORT_TABLES.keys()))
+    parser.add_argument("--format", default="ndjson", choices=EXPORT_FORMATS)
+    parser.add_argument("--gzip", action="store_true", help="gzip the output")
+    parser.add_argument("--storage", default="full", help="storage mode of the database (full or events)")
+    parser.add_argument("--start", default=None, help="timestamp or ISO date, rows at or after it")
+    parser.add_argument("--end", default=None, help="timestamp or ISO date, rows before it")
+    parser.add_argument("--user-id", default=None)
+    parser.add_argument("--intent", default=None, help="predicted intent name")
+    parser.add_argument("--output", default=None, help="output file, default is stdout")
+    args = parser.parse_args()
+
+    chunks = export(ChatStateDB(args.db, storage=args.storage), table=args.table, export_format=args.format,
+                    compress=args.gzip, start=parse_time(args.start), end=parse_time(args.end),
+                    user_id=args.user_id, intent=args.intent)
+
+    output = open(args.output, "wb") if args.output else sys.stdout.buffer
+    try:
+        for chunk in chunks:
+            output.write(chunk)
+
+    finally:
+        if args.output:
+            output.close()
@@ -0,0 +1,212 @@
+import json
+import sqlite3
+import warnings
+from typing import Callable, Dict, List, Tuple
+
+from database.rollup import day_of, turn_stat, UPSERT_INTENT_STATS
+from database.search import CREATE_MESSAGE_SEARCH, SOURCES
+
+# rows written before version 1 escaped single quotes in JSON columns with this placeholder
+LEGACY_SINGLE_QUOTE = "__single_quote__"
+
+CHAT_STATE_COLUMNS = ("id, user_id, user_name, version, intent, slots, entities, timestamp, events, button, "
+                      "loop_stack, response, synonym_dict, fingerprint")
+
+
+def _unescape_quotes(c: sqlite3.Cursor):
+    """
+    Version 1: store the domain fingerprint and keep JSON as is, instead of escaping single quotes
+    """
+    columns = [row[1] for row in c.execute("PRAGMA table_info(chat_state)").fetchall()]
+
+    if "fingerprint" not in columns:
+        c.execute("ALTER TABLE chat_state ADD COLUMN fingerprint text")
+
+    json_columns = ["intent", "slots", "entities", "events", "button", "response", "synonym_dict"]
+    c.execute(f"""UPDATE chat_state SET {", ".join(f"{column} = REPLACE({column}, ?, ?)" for column in json_columns)}""",
+              [value for _ in json_columns for value in (LEGACY_SINGLE_QUOTE, "'")])
+
+
+def _latest_state(c: sqlite3.Cursor):
+    """
+    Version 2: index the lookups by user and keep the latest state of every user in its own table
+    """
+    c.execute("CREATE INDEX IF NOT EXISTS chat_state_user_id ON chat_state (user_id, id)")
+
+    # user_status should have one row per user, keep the newest one of duplicated users
+    c.execute("DELETE FROM user_status WHERE id NOT IN (SELECT MAX(id) FROM user_status GROUP BY user_id)")
+    c.execute("CREATE UNIQUE INDEX IF NOT EXISTS user_status_user_id ON user_status (user_id)")
+
+    c.execute("""CREATE TABLE IF NOT EXISTS latest_state (
+                user_id text PRIMARY KEY,
+                id integer NOT NULL,
+                user_name text NOT NULL,
+                version text NOT NULL,
+                intent text,
+                slots text,
+                entities text,
+                timestamp float,
+                events text,
+                button text,
+                loop_stack int(10),
+                response text,
+                synonym_dict text,
+                fingerprint text
+                ) WITHOUT ROWID""")
+
+    c.execute(f"""INSERT OR REPLACE INTO latest_state ({CHAT_STATE_COLUMNS})
+                  SELECT {CHAT_STATE_COLUMNS} FROM chat_state
+                  WHERE id IN (SELECT MAX(id) FROM chat_state GROUP BY user_id)""")
+
+
+def _chat_event(c: sqlite3.Cursor):
+    """
+    Version 3: event log of the "events" storage mode, a full snapshot followed by the deltas of the next turns
+    """
+    c.execute("""CREATE TABLE IF NOT EXISTS chat_event (
+                id integer PRIMARY KEY AUTOINCREMENT,
+                user_id text NOT NULL,
+                timestamp float,
+                snapshot boolean NOT NULL,
+                data text NOT NULL
+                )""")
+
+    c.execute("CREATE INDEX IF NOT EXISTS chat_event_user_id ON chat_event (user_id, id)")
+    c.execute("CREATE INDEX IF NOT EXISTS chat_event_snapshot ON chat_event (user_id, snapshot, id)")
+
+
+def _timestamp_index(c: sqlite3.Cursor):
+    """
+    Version 4: index the time of the turns for the history filtered by date
+    """
+    c.execute("CREATE INDEX IF NOT EXISTS chat_state_timestamp ON chat_state (timestamp)")
+    c.execute("CREATE INDEX IF NOT EXISTS chat_event_timestamp ON chat_event (timestamp)")
+
+
+def _intent_stats(c: sqlite3.Cursor):
+    """
+    Version 5: rollup of the turns per day and top ranked intent, backfilled from the stored history
+    """
+    c.execute("""CREATE TABLE IF NOT EXISTS intent_stats (
+                day text NOT NULL,
+                intent text NOT NULL,
+                count integer NOT NULL,
+                fallback_count integer NOT NULL,
+                confidence_sum float NOT NULL,
+                PRIMARY KEY (day, intent)
+                ) WITHOUT ROWID""")
+
+    stats: Dict[Tuple[str, str], List[float]] = dict()
+    for sql_statement in ["SELECT id, timestamp, intent FROM chat_state WHERE id > ? ORDER BY id LIMIT 1000",
+                          "SELECT id, timestamp, json_extract(data, '$.intent') FROM chat_event WHERE id > ? "
+                          "ORDER BY id LIMIT 1000"]:
+        last_id = 0
+        while True:
+            rows = c.execute(sql_statement, (last_id,)).fetchall()
+            if not rows:
+                break
+
+            for _, timestamp, intent in rows:
+                try:
+                    stat = turn_stat(json.loads(intent)) if intent and timestamp is not None else None
+
+                except ValueError:
+                    stat = None
+
+                if stat is not None:
+                    values = stats.setdefault((day_of(timestamp), stat[0]), [0, 0, 0.0])
+                    values[0] += 1
+                    values[1] += int(stat[1])
+                    values[2] += stat[2]
+
+            last_id = rows[-1][0]
+
+    c.executemany(UPSERT_INTENT_STATS, [key + tuple(values) for key, values in stats.items()])
+
+
+def _message_search(c: sqlite3.Cursor):
+    """
+    Version 6: full-text index of the user messages and responses, backfilled from the stored history
+    """
+    try:
+        c.execute(CREATE_MESSAGE_SEARCH)
+
+    except sqlite3.OperationalError as ex:
+        # the version is still bumped, search stays disabled on this database
+        warnings.warn(f"Cannot create full-text index, SQLite is built without FTS5: {ex}")
+        return
+
+    for table, text, response, condition in [
+        ("chat_state", "json_extract(intent, '$.text')", "json_extract(response, '$.text')",
+         "json_valid(intent) AND (response IS NULL OR json_valid(response))"),
+        ("chat_event", "json_extract(data, '$.intent.text')", "json_extract(data, '$.response.text')",
+         "json_valid(data)")
+    ]:
+        c.execute(f"""INSERT INTO message_search (text, response, user_id, timestamp, source, state_id)
+                      SELECT text, response, user_id, timestamp, ?, id FROM (
+                          SELECT id, {text} AS text, {response} AS response, user_id, timestamp
+                          FROM {table} WHERE {condition})
+                      WHERE text IS NOT NULL OR response IS NOT NULL""", (SOURCES[table],))
+
+
+def _message_search_source(c: sqlite3.Cursor):
+    """
+    Version 7: the version 6 index used the state id as rowid, so a state and an event with the same id replaced each
+    other, rebuild it keyed by (source, state_id)
+    """
+    try:
+        c.execute("SELECT state_id FROM message_search LIMIT 0")
+        return
+
+    except sqlite3.OperationalError:
+        # no index (SQLite without FTS5) or the index of version 6
+        pass
+
+    if c.execute("SELECT 1 FROM sqlite_master WHERE name = 'message_search'").fetchone() is None:
+        return
+
+    c.execute("DROP TABLE message_search")
+    _message_search(c)
+
+
+# (version, description, upgrade), applied in order to databases with a lower PRAGMA user_version
+MIGRATIONS: List[Tuple[int, str, Callable[[sqlite3.Cursor], None]]] = [
+    (1, "store JSON without escaping single quotes", _unescape_quotes),
+    (2, "index user lookups and add latest_state", _latest_state),
+    (3, "add chat_event log", _chat_event),
+    (4, "index timestamp of turns", _timestamp_index),
+    (5, "add intent_stats rollup", _intent_stats),
+    (6, "add message_search full-text index", _message_search),
+    (7, "key message_search by source and state id", _message_search_source),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def migrate(conn: sqlite3.Connection) -> List[int]:
+    """
+    Apply the pending migrations, each one in its own transaction
+    :param conn: sqlite3.Connection - connection to the database
+    :return: list(int) - applied versions
+    """
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+
+    applied = []
+    for number, description, upgrade in MIGRATIONS:
+        if number <= version:
+            continue
+
+        try:
+            c = conn.cursor()
+            c.execute("BEGIN")
+            upgrade(c)
+            c.execute(f"PRAGMA user_version = {number}")
+            conn.commit()
+
+        except Exception as ex:
+            conn.rollback()
+            raise RuntimeError(f"Cannot upgrade database to version {number} ({description}) by error {ex}")
+
+        applied.append(number)
+
+    return applied
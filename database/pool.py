@@ -0,0 +1,172 @@
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+from typing import Dict, Any, List, Iterator
+
+JOURNAL_MODES = ["delete", "truncate", "persist", "memory", "wal", "off"]
+
+SYNCHRONOUS_LEVELS = ["off", "normal", "full", "extra"]
+
+
+def connect(db: str, journal_mode: str = "wal", synchronous: str = "normal", cache_size: int = -16000,
+            mmap_size: int = 0, timeout: float = 5.0, cached_statements: int = 128,
+            read_only: bool = False) -> sqlite3.Connection:
+    """
+    Open a connection that can be used from any thread and apply the storage engine settings
+    :param db: str - path to database file
+    :param journal_mode: str - one of JOURNAL_MODES, WAL lets readers run while a turn is written
+    :param synchronous: str - one of SYNCHRONOUS_LEVELS, normal only syncs the WAL at checkpoints
+    :param cache_size: int - page cache, pages if positive or KiB if negative
+    :param mmap_size: int - bytes of the database file read through memory mapping, 0 is disabled
+    :param timeout: float - seconds to wait for a lock held by another connection
+    :param cached_statements: int - number of prepared statements kept by the connection
+    :param read_only: bool - reject writes on this connection
+    :return: sqlite3.Connection
+    """
+    if journal_mode not in JOURNAL_MODES:
+        raise ValueError(f"journal_mode must be one of {JOURNAL_MODES}, not {journal_mode}")
+
+    if synchronous not in SYNCHRONOUS_LEVELS:
+        raise ValueError(f"synchronous must be one of {SYNCHRONOUS_LEVELS}, not {synchronous}")
+
+    try:
+        conn = sqlite3.connect(db, timeout=timeout, cached_statements=cached_statements, check_same_thread=False)
+
+    except Exception as ex:
+        raise RuntimeError(f"Cannot connect to database {db} by error {ex}")
+
+    # PRAGMA values cannot be bound, they are validated above and converted to int here
+    conn.execute(f"PRAGMA cache_size = {int(cache_size)}")
+    conn.execute(f"PRAGMA mmap_size = {int(mmap_size)}")
+
+    if read_only:
+        conn.execute("PRAGMA query_only = ON")
+
+    else:
+        conn.execute(f"PRAGMA journal_mode = {journal_mode}")
+        conn.execute(f"PRAGMA synchronous = {synchronous}")
+
+    return conn
+
+
+class ConnectionPool:
+    """
+    One writer connection shared behind a lock and a bounded set of reader connections, reads can run in worker
+    threads while a turn is being written (with WAL journal mode)
+    """
+    def __init__(self, db: str, readers: int = 4, **settings):
+        """
+        Create pool, the reader connections are opened on first use
+        :param db: str - path to database file
+        :param readers: int - maximum number of reader connections, 0 reads with the writer connection
+        :param settings: arguments of connect (journal_mode, synchronous, cache_size, mmap_size, timeout, ...)
+        """
+        if readers < 0:
+            raise ValueError(f"readers must not be negative, not {readers}")
+
+        # every connection to an in-memory database is a different database
+        self.in_memory = db == ":memory:" or db.startswith("file::memory:")
+        if self.in_memory:
+            readers = 0
+
+        self.db = db
+        self.settings = settings
+        self.writer = connect(db, **settings)
+        self.write_lock = threading.RLock()
+
+        self.readers = readers
+        self.idle: "queue.LifoQueue[sqlite3.Connection]" = queue.LifoQueue()
+        self.opened: List[sqlite3.Connection] = []
+        self.open_lock = threading.Lock()
+
+    @contextmanager
+    def write(self) -> Iterator[sqlite3.Connection]:
+        """
+        Use the writer connection, one thread at a time
+        :return: sqlite3.Connection
+        """
+        with self.write_lock:
+            yield self.writer
+
+    @contextmanager
+    def read(self) -> Iterator[sqlite3.Connection]:
+        """
+        Borrow a reader connection, waits for one when all of them are in use
+        :return: sqlite3.Connection
+        """
+        if not self.readers:
+            with self.write() as conn:
+                yield conn
+
+            return
+
+        try:
+            conn = self.idle.get_nowait()
+
+        except queue.Empty:
+            conn = None
+            with self.open_lock:
+                if len(self.opened) < self.readers:
+                    conn = connect(self.db, read_only=True, **self.settings)
+                    self.opened.append(conn)
+
+            if conn is None:
+                try:
+                    conn = self.idle.get(timeout=self.settings.get("timeout", 5.0))
+
+                except queue.Empty:
+                    raise RuntimeError(f"No reader connection of {self.db} is free")
+
+        try:
+            yield conn
+
+        finally:
+            self.idle.put(conn)
+
+    @contextmanager
+    def dedicated(self) -> Iterator[sqlite3.Connection]:
+        """
+        Open a reader connection outside the pool for a long reader (e.g. a streamed export), close() of the pool
+        does not cut it, so it can finish after the pool is replaced
+        :return: sqlite3.Connection
+        """
+        # the reads of the stream run in different threads, so they cannot hold the write lock between them,
+        # an in-memory database has no other connection and is only used by tests
+        if self.in_memory:
+            yield self.writer
+            return
+
+        conn = connect(self.db, read_only=True, **self.settings)
+
+        try:
+            yield conn
+
+        finally:
+            conn.close()
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Number of reader connections opened and idle
+        :return: dict(readers, opened, idle)
+        """
+        return dict(
+            readers=self.readers,
+            opened=len(self.opened),
+            idle=self.idle.qsize()
+        )
+
+    def close(self):
+        """
+        Close all connections
+        :return: None
+        """
+        with self.open_lock:
+            for conn in self.opened:
+                conn.close()
+
+            self.opened = []
+            self.idle = queue.LifoQueue()
+
+        with self.write_lock:
+            self.writer.close()
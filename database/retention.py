@@ -0,0 +1,333 @@
+import argparse
+import asyncio
+import gzip
+import json
+import os
+import sys
+import threading
+import warnings
+from datetime import datetime
+from typing import Dict, List, Any, Tuple, Optional, Iterator
+
+sys.path.append(os.getcwd())
+
+from database.database import ChatStateDB, CHAT_STATE_COLUMNS, LATEST_STATE_COLUMNS
+from database.export import ndjson_lines, state_to_row
+from database.search import DELETE_MESSAGE_SEARCH, SOURCES
+
+CHUNK_SIZE = 1000
+
+# VACUUM only when at least this fraction of the pages is free
+VACUUM_THRESHOLD = 0.2
+
+# chat_state rows older than the cutoff, except the latest state of every user
+SELECT_OLD_STATES = f"""SELECT {CHAT_STATE_COLUMNS} FROM chat_state
+                        WHERE id > ? AND id <= ? AND timestamp < ? AND id NOT IN (SELECT id FROM latest_state)
+                        ORDER BY id LIMIT ?"""
+
+REPORT_OLD_STATES = """SELECT strftime('%Y-%m', timestamp, 'unixepoch', 'localtime') AS month, COUNT(*),
+                       SUM(IFNULL(length(intent), 0) + IFNULL(length(slots), 0) + IFNULL(length(entities), 0) +
+                           IFNULL(length(events), 0) + IFNULL(length(button), 0) + IFNULL(length(response), 0) +
+                           IFNULL(length(synonym_dict), 0) + length(user_id) + length(user_name))
+                       FROM chat_state WHERE timestamp < ? AND id NOT IN (SELECT id FROM latest_state)
+                       GROUP BY month ORDER BY month"""
+
+COUNT_KEPT_STATES = """SELECT COUNT(*) FROM latest_state WHERE timestamp < ?"""
+
+# the log of a user can only be cut at a snapshot: keep everything from the last snapshot before the first turn that
+# is newer than the cutoff, or before the latest turn when all turns are older
+SELECT_EVENT_BOUNDARIES = """SELECT needed.user_id, (SELECT MAX(id) FROM chat_event
+                                                     WHERE user_id = needed.user_id AND snapshot = 1
+                                                     AND id <= needed.first_id)
+                             FROM (SELECT user_id, IFNULL(MIN(CASE WHEN timestamp >= ? THEN id END), MAX(id))
+                                   AS first_id FROM chat_event GROUP BY user_id) AS needed"""
+
+SELECT_EVENTS = """SELECT id, user_id, timestamp, snapshot, data FROM chat_event
+                   WHERE id > ? AND id < ? ORDER BY id LIMIT ?"""
+
+DELETE_STATE = """DELETE FROM chat_state WHERE id = ?"""
+
+DELETE_EVENT = """DELETE FROM chat_event WHERE id = ?"""
+
+
+class RetentionJob:
+    """
+    Move the turns older than max_age_days from the live database to gzip NDJSON archives, one file per month,
+    the latest state of every user stays in the live table
+    """
+    def __init__(self, db: ChatStateDB, archive_path: str, max_age_days: float = 180, interval: float = 86400,
+                 vacuum_threshold: float = VACUUM_THRESHOLD):
+        """
+        Create retention job
+        :param db: ChatStateDB - live database
+        :param archive_path: str - folder of the archive files chat_state-YYYY-MM.ndjson.gz
+        :param max_age_days: float - age of the turns that are archived
+        :param interval: float - seconds between two runs of the background task
+        :param vacuum_threshold: float - fraction of free pages that triggers VACUUM after archiving
+        """
+        if max_age_days <= 0:
+            raise ValueError(f"max_age_days must be a positive number, not {max_age_days}")
+
+        self.db = db
+        self.archive_path = archive_path
+        self.max_age_days = max_age_days
+        self.interval = interval
+        self.vacuum_threshold = vacuum_threshold
+
+        # held by a run, and by a reload while it replaces db, so a run never uses a closed database
+        self.lock = threading.Lock()
+
+        self._wake_event: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._closing = False
+
+    def cutoff(self, now: float = None) -> float:
+        if now is None:
+            now = datetime.today().timestamp()
+
+        return now - self.max_age_days * 86400
+
+    def _storage_size(self) -> Dict[str, int]:
+        with self.db.pool.read() as conn:
+            page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+            page_count = conn.execute("PRAGMA page_count").fetchone()[0]
+            free_pages = conn.execute("PRAGMA freelist_count").fetchone()[0]
+
+        return dict(db_bytes=page_size * page_count, free_bytes=page_size * free_pages)
+
+    def report(self, now: float = None) -> Dict[str, Any]:
+        """
+        Dry run: what would be archived and how much would be reclaimed, nothing is changed
+        :param now: optional(float) - current timestamp
+        :return: dict(cutoff, storage, rows, bytes, months, kept_latest, db_bytes, free_bytes)
+        """
+        cutoff = self.cutoff(now)
+
+        months: Dict[str, Dict[str, int]] = dict()
+        with self.db.pool.read() as conn:
+            if self.db.storage == "events":
+                boundaries = dict(conn.execute(SELECT_EVENT_BOUNDARIES, (cutoff,)).fetchall())
+                rows = conn.execute("""SELECT user_id, id, strftime('%Y-%m', timestamp, 'unixepoch', 'localtime'),
+                                       length(data) + length(user_id) FROM chat_event WHERE timestamp < ?""",
+                                    (cutoff,)).fetchall()
+
+                for user_id, state_id, month, size in rows:
+                    if boundaries.get(user_id, None) is not None and state_id < boundaries[user_id]:
+                        values = months.setdefault(month, dict(rows=0, bytes=0))
+                        values["rows"] += 1
+                        values["bytes"] += size
+
+            else:
+                for month, count, size in conn.execute(REPORT_OLD_STATES, (cutoff,)).fetchall():
+                    months[month] = dict(rows=count, bytes=size or 0)
+
+            kept_latest = conn.execute(COUNT_KEPT_STATES, (cutoff,)).fetchone()[0]
+
+        return dict(
+            cutoff=datetime.fromtimestamp(cutoff).isoformat(),
+            storage=self.db.storage,
+            rows=sum(values["rows"] for values in months.values()),
+            bytes=sum(values["bytes"] for values in months.values()),
+            months=months,
+            kept_latest=kept_latest,
+            **self._storage_size()
+        )
+
+    def _old_states(self, cutoff: float) -> Iterator[List[Tuple]]:
+        """
+        Chunks of (id, row) to archive from chat_state, rows in the column order of LATEST_STATE_COLUMNS
+        """
+        with self.db.pool.read() as conn:
+            high = conn.execute("SELECT MAX(id) FROM chat_state WHERE timestamp < ?", (cutoff,)).fetchone()[0]
+
+        low = 0
+        while high is not None and low < high:
+            with self.db.pool.read() as conn:
+                rows = conn.execute(SELECT_OLD_STATES, (low, high, cutoff, CHUNK_SIZE)).fetchall()
+
+            if not rows:
+                return
+
+            yield [(row[0], row) for row in rows]
+
+            low = rows[-1][0]
+
+    def _old_events(self, cutoff: float) -> Iterator[List[Tuple]]:
+        """
+        Chunks of (id, row) to archive from chat_event, the states are replayed to full chat_state rows
+        """
+        with self.db.pool.read() as conn:
+            boundaries = {user_id: boundary for user_id, boundary in
+                          conn.execute(SELECT_EVENT_BOUNDARIES, (cutoff,)).fetchall() if boundary is not None}
+
+        if not boundaries:
+            return
+
+        high = max(boundaries.values())
+        current: Dict[str, Dict[str, Any]] = dict()
+
+        low = 0
+        while low < high:
+            with self.db.pool.read() as conn:
+                rows = conn.execute(SELECT_EVENTS, (low, high, CHUNK_SIZE)).fetchall()
+
+            if not rows:
+                return
+
+            # the removed part of a log starts at its first event, so the replay always starts from a snapshot
+            old_rows = [row for row in rows if row[0] < boundaries.get(row[1], 0)]
+            yield [(state["id"], state_to_row(state)) for state in self.db._replay(old_rows, current)]
+
+            low = rows[-1][0]
+
+    def _write_archive(self, rows: List[Tuple]) -> List[str]:
+        """
+        Append rows to the archive files of their month, each call adds a gzip member to the files
+        :return: list(str) - paths of the written files
+        """
+        months: Dict[str, List[Tuple]] = dict()
+        timestamp_index = LATEST_STATE_COLUMNS.index("timestamp")
+        for row in rows:
+            months.setdefault(datetime.fromtimestamp(row[timestamp_index]).strftime("%Y-%m"), []).append(row)
+
+        os.makedirs(self.archive_path, exist_ok=True)
+
+        paths = []
+        for month, month_rows in months.items():
+            path = os.path.join(self.archive_path, f"chat_state-{month}.ndjson.gz")
+            with gzip.open(path, "at", encoding="utf-8") as f:
+                f.writelines(ndjson_lines(LATEST_STATE_COLUMNS, iter(month_rows)))
+                f.flush()
+                os.fsync(f.fileno())
+
+            paths.append(path)
+
+        return paths
+
+    def run(self, now: float = None, dry_run: bool = False) -> Dict[str, Any]:
+        """
+        Archive and delete the old turns chunk by chunk, then ANALYZE and VACUUM if enough pages are free
+        :param now: optional(float) - current timestamp
+        :param dry_run: bool - only return the report
+        :return: dict - the report before running, with archived, files and vacuumed
+        """
+        with self.lock:
+            return self._run(now, dry_run)
+
+    def _run(self, now: Optional[float], dry_run: bool) -> Dict[str, Any]:
+        report = self.report(now)
+        if dry_run:
+            return report
+
+        cutoff = self.cutoff(now)
+        chunks = self._old_events(cutoff) if self.db.storage == "events" else self._old_states(cutoff)
+        delete_statement = DELETE_EVENT if self.db.storage == "events" else DELETE_STATE
+        table = "chat_event" if self.db.storage == "events" else "chat_state"
+
+        archived, files = 0, set()
+        for chunk in chunks:
+            if not chunk:
+                continue
+
+            # the rows are only deleted after they are safely in the archive
+            files.update(self._write_archive([row for _, row in chunk]))
+
+            with self.db.pool.write() as conn:
+                try:
+                    conn.executemany(delete_statement, [(state_id,) for state_id, _ in chunk])
+                    if self.db.search_enabled:
+                        conn.execute(DELETE_MESSAGE_SEARCH,
+                                     (SOURCES[table], json.dumps([state_id for state_id, _ in chunk])))
+
+                    conn.commit()
+
+                except Exception as ex:
+                    conn.rollback()
+                    raise RuntimeError(f"Cannot delete archived rows by error {ex}")
+
+            archived += len(chunk)
+
+        report.update(archived=archived, files=sorted(files), vacuumed=self.compact())
+
+        return report
+
+    def compact(self) -> bool:
+        """
+        Refresh the planner statistics, and VACUUM when the free pages are above vacuum_threshold
+        :return: bool - vacuumed or not
+        """
+        storage = self._storage_size()
+
+        with self.db.pool.write() as conn:
+            conn.execute("ANALYZE")
+            conn.commit()
+
+            if not storage["db_bytes"] or storage["free_bytes"] / storage["db_bytes"] < self.vacuum_threshold:
+                return False
+
+            conn.execute("VACUUM")
+
+        return True
+
+    async def _run_loop(self):
+        """
+        Background task that runs the job every interval seconds in a worker thread
+        :return: None
+        """
+        loop = asyncio.get_running_loop()
+
+        while not self._closing:
+            try:
+                await loop.run_in_executor(None, self.run)
+
+            except Exception as ex:
+                warnings.warn(f"Retention job failed by error {ex}")
+
+            try:
+                await asyncio.wait_for(self._wake_event.wait(), timeout=self.interval)
+
+            except asyncio.TimeoutError:
+                pass
+
+    async def start(self):
+        """
+        Start the background task
+        :return: None
+        """
+        if self._task is not None:
+            return
+
+        self._closing = False
+        self._wake_event = asyncio.Event()
+        self._task = asyncio.ensure_future(self._run_loop())
+
+    async def close(self):
+        """
+        Stop the background task after the current run
+        :return: None
+        """
+        if self._task is None:
+            return
+
+        self._closing = True
+        self._wake_event.set()
+        await self._task
+
+        self._task = None
+        self._wake_event = None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Archive old turns of chat_state and compact the database")
+    parser.add_argument("--db", default="database/test_db.db", help="path to SQLite database file")
+    parser.add_argument("--storage", default="full", help="storage mode of the database (full or events)")
+    parser.add_argument("--archive", default="database/archive/", help="folder of the archive files")
+    parser.add_argument("--days", type=float, default=180, help="age of the turns that are archived")
+    parser.add_argument("--dry-run", action="store_true", help="only report what would be archived")
+    args = parser.parse_args()
+
+    job = RetentionJob(ChatStateDB(args.db, storage=args.storage), archive_path=args.archive, max_age_days=args.days)
+    result = job.run(dry_run=args.dry_run)
+
+    for key, value in result.items():
+        print(f"{key}: {value}")
@@ -0,0 +1,59 @@
+import sqlite3
+from datetime import datetime
+from typing import Dict, List, Any, Tuple, Optional
+
+# intent name of the turns the controller could not map to an action
+FALLBACK_INTENT = "default"
+
+UPSERT_INTENT_STATS = """INSERT INTO intent_stats (day, intent, count, fallback_count, confidence_sum)
+                         VALUES (?, ?, ?, ?, ?)
+                         ON CONFLICT (day, intent) DO UPDATE SET count = count + excluded.count,
+                         fallback_count = fallback_count + excluded.fallback_count,
+                         confidence_sum = confidence_sum + excluded.confidence_sum"""
+
+
+def day_of(timestamp: float) -> str:
+    """
+    Day of a turn in server local time
+    :param timestamp: float - time of the turn
+    :return: str - YYYY-MM-DD
+    """
+    return datetime.fromtimestamp(timestamp).strftime("%Y-%m-%d")
+
+
+def turn_stat(intent: Optional[Dict[str, Any]]) -> Optional[Tuple[str, bool, float]]:
+    """
+    Rollup values of one turn, the turn is counted under the top ranked intent of NLU, so the fallback count of an
+    intent is the number of turns where it was the best guess but not confident enough
+    :param intent: dict(text, name, intent_ranking, priority) - intent of the state
+    :return: optional(tuple(intent, fallback, top confidence)) - None if the state has no NLU prediction
+    """
+    if not intent or not intent.get("name", None):
+        return None
+
+    # the intents triggered by the flow have no ranking, they were not predicted
+    ranking = intent.get("intent_ranking", None)
+    if not ranking:
+        return None
+
+    top_intent = max(ranking, key=ranking.get)
+
+    return top_intent, intent["name"] == FALLBACK_INTENT, float(ranking[top_intent])
+
+
+def add_turns(c: sqlite3.Cursor, turn_stats: List[Tuple[float, str, bool, float]]):
+    """
+    Count turns in intent_stats
+    :param c: sqlite3.Cursor - cursor of the transaction that writes the state of the turns
+    :param turn_stats: list(tuple(timestamp, intent, fallback, top confidence)) - values of each turn, as recorded by
+                       the controller when the user message was predicted
+    :return: None
+    """
+    stats: Dict[Tuple[str, str], List[float]] = dict()
+    for timestamp, intent, fallback, confidence in turn_stats:
+        values = stats.setdefault((day_of(timestamp), intent), [0, 0, 0.0])
+        values[0] += 1
+        values[1] += int(fallback)
+        values[2] += confidence
+
+    c.executemany(UPSERT_INTENT_STATS, [key + tuple(values) for key, values in stats.items()])
@@ -0,0 +1,101 @@
+import re
+import sqlite3
+from typing import Dict, Any, List, Optional
+
+# weights of the text and response columns in the ranking, a match in the user message counts more
+TEXT_WEIGHT = 2.0
+RESPONSE_WEIGHT = 1.0
+
+SEARCH_FIELDS = ["text", "response"]
+
+# source of a message is the table of its state, the ids of chat_state and chat_event overlap
+SOURCES = {"chat_state": "state", "chat_event": "event"}
+
+# a message is identified by (source, state_id), the rowid is its own
+CREATE_MESSAGE_SEARCH = """CREATE VIRTUAL TABLE IF NOT EXISTS message_search USING fts5 (
+                           text,
+                           response,
+                           user_id UNINDEXED,
+                           timestamp UNINDEXED,
+                           source UNINDEXED,
+                           state_id UNINDEXED,
+                           tokenize = 'unicode61 remove_diacritics 2'
+                           )"""
+
+INSERT_MESSAGE_SEARCH = """INSERT INTO message_search (text, response, user_id, timestamp, source, state_id)
+                           VALUES (?, ?, ?, ?, ?, ?)"""
+
+# the UNINDEXED columns are scanned, so the messages of a chunk of states are deleted in one pass: the ids are a
+# JSON array
+DELETE_MESSAGE_SEARCH = """DELETE FROM message_search
+                           WHERE source = ? AND state_id IN (SELECT value FROM json_each(?))"""
+
+SEARCH_MESSAGES = f"""SELECT source, state_id, user_id, timestamp, text, response,
+                      snippet(message_search, -1, '<b>', '</b>', '...', 12),
+                      bm25(message_search, {TEXT_WEIGHT}, {RESPONSE_WEIGHT}) AS rank
+                      FROM message_search
+                      WHERE message_search MATCH ? AND (? IS NULL OR user_id = ?)
+                      AND (? IS NULL OR timestamp >= ?) AND (? IS NULL OR timestamp < ?)
+                      ORDER BY rank LIMIT ? OFFSET ?"""
+
+
+def message_text(intent: Optional[Dict[str, Any]], response: Optional[Dict[str, Any]]) -> List[Optional[str]]:
+    """
+    Indexed text of one turn
+    :param intent: dict(text, name, ...) - intent of the state, text is the user message
+    :param response: dict(text, button) - response of the chatbot
+    :return: list(optional(str)) - user message and response text
+    """
+    values = []
+    for value in [(intent or dict()).get("text", None), (response or dict()).get("text", None)]:
+        if isinstance(value, list):
+            value = "\n".join(str(part) for part in value)
+
+        values.append(None if value is None else str(value))
+
+    return values
+
+
+def index_turn(c: sqlite3.Cursor, source: str, state_id: int, user_id: str, timestamp: float,
+               intent: Optional[Dict[str, Any]], response: Optional[Dict[str, Any]]):
+    """
+    Add one persisted turn to message_search
+    :param c: sqlite3.Cursor - cursor of the transaction that writes the turn
+    :param source: str - state or event, the table of the state
+    :param state_id: int - id of the state in chat_state or chat_event
+    :param user_id: str - unique identifier of the user
+    :param timestamp: float - time of the turn
+    :param intent: dict - intent of the state
+    :param response: dict - response of the chatbot
+    :return: None
+    """
+    text, response_text = message_text(intent, response)
+    if not text and not response_text:
+        return
+
+    c.execute(INSERT_MESSAGE_SEARCH, (text, response_text, user_id, timestamp, source, state_id))
+
+
+def match_query(query: str, field: str = None) -> str:
+    """
+    Convert a search box query to an FTS5 query, so user input never hits the FTS5 syntax:
+    every word must match, "quoted words" must match as a phrase and a word ending with * matches as prefix
+    :param query: str - e.g. sick leave, "sick leave", leav*
+    :param field: optional(str) - one of SEARCH_FIELDS, default is both
+    :return: str - FTS5 query
+    """
+    if field is not None and field not in SEARCH_FIELDS:
+        raise ValueError(f"field must be one of {SEARCH_FIELDS}, not {field}")
+
+    phrases = []
+    for phrase, word in re.findall(r'"([^"]*)"|(\S+)', query):
+        words = re.findall(r"\w+", phrase or word)
+        if words:
+            phrases.append('"' + " ".join(words) + '"' + ("*" if word.endswith("*") else ""))
+
+    if not phrases:
+        raise ValueError(f"query must contain at least one word, not {query!r}")
+
+    expression = " ".join(phrases)
+
+    return expression if field is None else f"{field} : ({expression})"
@@ -5,10 +5,53 @@ import re
 
 class EventOutput:
     """
-    output of event type
+    output of event type, each available event is a slot and None means the event is not set
     """
+    __slots__ = ("text", "action", "button", "set_slot", "trigger_intent", "request_slot")
+
     def __init__(self, data: Dict[str, Any]):
-        self.__dict__.update(data)
+        for key in self.__slots__:
+            setattr(self, key, None)
+
+        self.update(data)
+
+    def _set(self, key: str, value: Any):
+        if key not in self.__slots__:
+            raise ValueError(f"Event {key} is not an available event")
+
+        setattr(self, key, value)
+
+    def get(self, key: str, default: Any = None) -> Any:
+        """
+        Get the value of event
+        :param key: name of event
+        :param default: value if the event is not set
+        :return: value of event
+        """
+        value = getattr(self, key, None) if key in self.__slots__ else None
+
+        return default if value is None else value
+
+    def pop(self, key: str, default: Any = None) -> Any:
+        """
+        Get the value of event and unset it
+        :param key: name of event
+        :param default: value if the event is not set
+        :return: value of event
+        """
+        value = self.get(key, default)
+
+        if key in self.__slots__:
+            setattr(self, key, None)
+
+        return value
+
+    def as_dict(self) -> Dict[str, Any]:
+        """
+        Convert to dictionary with the set events only
+        :return: dict(event: value)
+        """
+        return {key: getattr(self, key) for key in self.__slots__ if getattr(self, key) is not None}
 
     def update(self, data: Dict[str, Any]):
         """
@@ -16,7 +59,8 @@ class EventOutput:
         :param data: dictionary data
         :return: None
         """
-        self.__dict__.update(data)
+        for key, value in data.items():
+            self._set(key, value)
 
     def append(self, data: Any):
         """
@@ -26,25 +70,23 @@ class EventOutput:
         """
         if not isinstance(data, dict):
             if isinstance(data, EventOutput):
-                data = data.__dict__
+                data = data.as_dict()
 
             else:
                 raise ValueError(f"data must be dict or EventOutput, not {data}: {type(data)}")
 
-        dict_data = self.__dict__
-
         for key, value in data.items():
-            if dict_data.get(key, None) is not None:
-                if isinstance(value, list) and isinstance(dict_data.get(key, None), list):
-                    dict_data[key] += value
+            current = self.get(key)
 
-                elif isinstance(value, dict) and isinstance(dict_data.get(key, None), dict):
-                    dict_data[key].update(value)
+            if current is not None:
+                if isinstance(value, list) and isinstance(current, list):
+                    self._set(key, current + value)
 
-            else:
-                dict_data[key] = value
+                elif isinstance(value, dict) and isinstance(current, dict):
+                    current.update(value)
 
-        self.__dict__ = dict_data
+            else:
+                self._set(key, value)
 
 
 class Event:
@@ -1,3 +1,5 @@
+import hashlib
+import json
 from typing import Union, Dict, Any, List
 import yaml
 from parsers.mapping import ActionMap, RequestMap
@@ -34,6 +36,8 @@ class FlowMap:
             except Exception as ex:
                 raise RuntimeError(f"Cannot import domain from file {domain} by error: {ex}")
 
+        self.fingerprint: str = self.create_fingerprint(flow_config, domain)
+
         self.entities_list: List[str] = domain["entities"]
         for entity in self.entities_list:
             if not isinstance(entity, str):
@@ -59,6 +63,18 @@ class FlowMap:
             request_map = RequestMap(slot, self.entities_list, self.intents_list, self.slots_list)
             self.requests_map[request_map.slot] = request_map
 
+    @staticmethod
+    def create_fingerprint(flow_config: Dict[str, Any], domain: Dict[str, Any]) -> str:
+        """
+        Hash of the flow config and domain, conversation states saved under the same fingerprint are still valid
+        :param flow_config: dict() - the flow config
+        :param domain: dict() - the domain
+        :return: str - hex digest
+        """
+        content = json.dumps(dict(flow_config=flow_config, domain=domain), sort_keys=True, default=str)
+
+        return hashlib.sha1(content.encode("utf-8")).hexdigest()
+
     def export(self):
         """
         Export to the convertible dictionaries for config and domain
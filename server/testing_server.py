@@ -68,7 +68,7 @@ async def send(message: Message):
 
     user_state = user_conversations(user_id)
 
-    output = controller(user_state, user_input).__dict__
+    output = controller(user_state, user_input).export()
 
     user_conversations.save_to_db(user_id=user_id)
 
@@ -89,7 +89,7 @@ async def test(user_input: Dict[str, Any] = Body(...)):
 
     user_state = user_conversations(user_id)
 
-    output = controller(user_state, user_message).__dict__
+    output = controller(user_state, user_message).export()
 
     user_conversations.save_to_db(user_id=user_id)
 
@@ -0,0 +1,84 @@
+import asyncio
+import os
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.append(os.getcwd())
+
+from channels.dedup import SeenCache
+
+
+class SeenCacheTest(unittest.TestCase):
+    """
+    Activity ids are remembered for ttl seconds, the least recently seen ones are evicted past max_size
+    """
+    def test_duplicate_within_ttl(self):
+        cache = SeenCache(max_size=10, ttl=0.05)
+
+        self.assertFalse(cache.seen("a"))
+        self.assertTrue(cache.seen("a"))
+
+        time.sleep(0.06)
+        self.assertFalse(cache.seen("a"))
+        self.assertEqual(cache.stats()["duplicates"], 1)
+
+    def test_evicts_least_recently_seen(self):
+        cache = SeenCache(max_size=2, ttl=60)
+        cache.seen("a")
+        cache.seen("b")
+
+        # a retry keeps a away from the eviction end
+        self.assertTrue(cache.seen("a"))
+        cache.seen("c")
+
+        self.assertEqual(list(cache.ids.keys()), ["a", "c"])
+        self.assertEqual(cache.stats()["evicted"], 1)
+
+    def test_forget(self):
+        cache = SeenCache(max_size=10, ttl=60)
+        cache.seen("a")
+        cache.forget("a")
+
+        self.assertFalse(cache.seen("a"))
+
+
+class PersistedSeenCacheTest(unittest.TestCase):
+    """
+    The ids recorded in the database are seen by the other caches of the same file
+    """
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.db = os.path.join(self.folder.name, "seen.db")
+        self.caches = [SeenCache(max_size=10, ttl=60, db=self.db) for _ in range(2)]
+
+    def tearDown(self):
+        for cache in self.caches:
+            cache.close()
+
+        self.folder.cleanup()
+
+    def test_shared_between_caches(self):
+        first, second = self.caches
+
+        self.assertFalse(first.seen("a"))
+        self.assertTrue(second.seen("a"))
+
+        first.forget("a")
+        self.assertFalse(first.seen("a"))
+
+    def test_concurrent_retries_async(self):
+        first = self.caches[0]
+
+        async def retries():
+            return await asyncio.gather(*(cache.seen_async("a") for cache in self.caches for _ in range(3)))
+
+        self.assertEqual(sorted(asyncio.run(retries())), [False] + [True] * 5)
+
+        asyncio.run(first.forget_async("a"))
+        self.assertFalse(first.seen("a"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,56 @@
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.append(os.getcwd())
+
+from database.database import ChatStateDB
+
+
+class FetchHistoryTest(unittest.TestCase):
+    """
+    History pages of the events storage, the fields that need a replay of the events are mixed with text
+    """
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.db = ChatStateDB(os.path.join(self.folder.name, "history.db"), storage="events", snapshot_interval=3)
+
+        for index in range(5):
+            self.db.insert_table(user_id="user", user_name="name", version="v0.0",
+                                 intent=dict(name="greet", text=f"hello {index}", intent_ranking={}),
+                                 slots=dict(turn=index), entities=[], events=dict(), button=None)
+
+    def tearDown(self):
+        self.db.close()
+        self.folder.cleanup()
+
+    def test_text_with_replayed_fields(self):
+        messages, next_cursor = self.db.fetch_history(user_id="user", fields=["text", "slots"])
+
+        self.assertIsNone(next_cursor)
+        self.assertEqual([message["text"] for message in messages], [f"hello {index}" for index in range(4, -1, -1)])
+        self.assertEqual([message["slots"] for message in messages], [dict(turn=index) for index in range(4, -1, -1)])
+
+    def test_text_matches_full_storage(self):
+        full = ChatStateDB(os.path.join(self.folder.name, "full.db"))
+        full.insert_table(user_id="user", user_name="name", version="v0.0",
+                          intent=dict(name="greet", text="hello", intent_ranking={}), slots=dict(), entities=[],
+                          events=dict(), button=None)
+
+        try:
+            expected, _ = full.fetch_history(fields=["text", "intent"])
+
+        finally:
+            full.close()
+
+        self.db.insert_table(user_id="other", user_name="name", version="v0.0",
+                             intent=dict(name="greet", text="hello", intent_ranking={}), slots=dict(), entities=[],
+                             events=dict(), button=None)
+        messages, _ = self.db.fetch_history(user_id="other", fields=["text", "intent"])
+
+        self.assertEqual(messages, expected)
+
+
+if __name__ == "__main__":
+    unittest.main()
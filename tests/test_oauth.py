@@ -0,0 +1,89 @@
+import asyncio
+import os
+import sys
+import unittest
+
+sys.path.append(os.getcwd())
+
+from channels.oauth import TokenManager
+
+
+class TokenManagerTest(unittest.IsolatedAsyncioTestCase):
+    """
+    Concurrent callers share one refresh, a valid token is returned without waiting
+    """
+    def setUp(self):
+        self.fetches = 0
+        self.expires_in = 3600.0
+        self.error = None
+
+    async def fetch(self):
+        self.fetches += 1
+        await asyncio.sleep(0.01)
+
+        if self.error is not None:
+            raise self.error
+
+        return f"token{self.fetches}", self.expires_in
+
+    async def test_single_flight_refresh(self):
+        manager = TokenManager(self.fetch)
+
+        tokens = await asyncio.gather(*(manager.get_token() for _ in range(10)))
+
+        self.assertEqual(tokens, ["token1"] * 10)
+        self.assertEqual(self.fetches, 1)
+        self.assertEqual(await manager.get_token(), "token1")
+        self.assertEqual(self.fetches, 1)
+
+    async def test_refresh_ahead_of_expiry(self):
+        # the refresh is due after half of the lifetime, the current token is used meanwhile
+        self.expires_in = 0.1
+        manager = TokenManager(self.fetch, refresh_margin=300.0)
+        self.assertEqual(await manager.get_token(), "token1")
+
+        await asyncio.sleep(0.06)
+        self.assertEqual(await manager.get_token(), "token1")
+        await asyncio.sleep(0.03)
+
+        self.assertEqual(self.fetches, 2)
+        self.assertEqual(await manager.get_token(), "token2")
+
+    async def test_failed_refresh_is_shared(self):
+        manager = TokenManager(self.fetch)
+        self.error = RuntimeError("token service down")
+
+        results = await asyncio.gather(*(manager.get_token() for _ in range(3)), return_exceptions=True)
+
+        self.assertEqual(self.fetches, 1)
+        self.assertTrue(all(isinstance(result, RuntimeError) for result in results))
+        self.assertEqual(manager.stats()["failures"], 1)
+
+        self.error = None
+        self.assertEqual(await manager.get_token(), "token2")
+
+    async def test_cancelled_caller_does_not_cancel_refresh(self):
+        manager = TokenManager(self.fetch)
+
+        cancelled = asyncio.ensure_future(manager.get_token())
+        waiting = asyncio.ensure_future(manager.get_token())
+        await asyncio.sleep(0)
+        cancelled.cancel()
+
+        self.assertEqual(await waiting, "token1")
+        self.assertEqual(self.fetches, 1)
+
+    async def test_background_refresh(self):
+        self.expires_in = 0.1
+        manager = TokenManager(self.fetch, refresh_margin=0.05)
+        await manager.start()
+
+        await asyncio.sleep(0.17)
+        await manager.close()
+
+        self.assertGreaterEqual(self.fetches, 2)
+        self.assertTrue(manager.valid())
+
+
+if __name__ == "__main__":
+    unittest.main()
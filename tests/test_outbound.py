@@ -0,0 +1,93 @@
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import unittest
+import warnings
+
+sys.path.append(os.getcwd())
+
+from channels.botframework import DeliveryError
+from channels.outbound import OutboundQueue
+
+
+class OutboundQueueTest(unittest.IsolatedAsyncioTestCase):
+    """
+    Messages are delivered in order per conversation, the retryable errors are retried and the rest is dead-lettered
+    """
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.dead_letter_path = os.path.join(self.folder.name, "dead_letter.ndjson")
+        self.delivered = []
+        self.failures = dict()
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    async def deliver(self, message, conversation):
+        # a message fails with the queued errors of its text before it is delivered
+        errors = self.failures.get(message["text"], [])
+        if errors:
+            raise errors.pop(0)
+
+        await asyncio.sleep(0.001 * (len(message["text"]) % 3))
+        self.delivered.append((conversation["id"], message["text"]))
+
+    def queue(self, **options) -> OutboundQueue:
+        return OutboundQueue(self.deliver, base_delay=0.001, max_delay=0.01, dead_letter_path=self.dead_letter_path,
+                             **options)
+
+    async def test_in_order_per_conversation(self):
+        queue = self.queue(concurrency=4)
+        for index in range(5):
+            for conversation_id in ["a", "b"]:
+                queue.enqueue(dict(text=f"{conversation_id}{'x' * index}"), dict(id=conversation_id))
+
+        self.assertTrue(await queue.flush(timeout=1))
+        for conversation_id in ["a", "b"]:
+            self.assertEqual([text for delivered_id, text in self.delivered if delivered_id == conversation_id],
+                             [f"{conversation_id}{'x' * index}" for index in range(5)])
+
+        self.assertEqual(queue.stats()["delivered"], 10)
+
+    async def test_retry_then_deliver(self):
+        queue = self.queue()
+        self.failures["hi"] = [DeliveryError("throttled", status=429), DeliveryError("down", status=503)]
+        queue.enqueue(dict(text="hi"), dict(id="a"))
+        queue.enqueue(dict(text="next"), dict(id="a"))
+
+        self.assertTrue(await queue.flush(timeout=1))
+        self.assertEqual(self.delivered, [("a", "hi"), ("a", "next")])
+        self.assertEqual(queue.stats()["retried"], 2)
+
+    async def test_dead_letters(self):
+        queue = self.queue(max_attempts=2)
+        self.failures["bad"] = [DeliveryError("bad request", status=400)]
+        self.failures["down"] = [DeliveryError("down", status=503) for _ in range(2)]
+        queue.enqueue(dict(text="bad"), dict(id="a"))
+        queue.enqueue(dict(text="down"), dict(id="b"))
+
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            self.assertTrue(await queue.flush(timeout=1))
+
+        stats = queue.stats()
+        self.assertEqual(self.delivered, [])
+        self.assertEqual(stats["dead_lettered"], 2)
+        self.assertEqual(sorted((letter["status"], letter["attempts"]) for letter in stats["dead_letters"]),
+                         [(400, 1), (503, 2)])
+
+        with open(self.dead_letter_path, encoding="utf-8") as f:
+            self.assertEqual(sorted(json.loads(line)["message"]["text"] for line in f), ["bad", "down"])
+
+    def test_backoff(self):
+        queue = self.queue()
+
+        self.assertLessEqual(queue.backoff(10), 0.01)
+        # the Retry-After of the server is honoured above max_delay
+        self.assertGreaterEqual(queue.backoff(1, retry_after=60), 60)
+
+
+if __name__ == "__main__":
+    unittest.main()
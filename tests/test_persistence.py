@@ -0,0 +1,143 @@
+import asyncio
+import os
+import sys
+import tempfile
+import unittest
+import warnings
+
+sys.path.append(os.getcwd())
+
+from controller.server_controller import UserConversations
+from database.database import ChatStateDB
+
+INTENTS = ["default", "greet"]
+
+
+class PersistenceTest(unittest.IsolatedAsyncioTestCase):
+    """
+    The states are written every turn (sync), in batches (batched) or when the user leaves memory (on_evict),
+    every mode has written all the turns after close
+    """
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.folder.name, "users.db")
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def conversations(self, persistence: str, **options) -> UserConversations:
+        return UserConversations(self.path, entities_list=[], intents_list=INTENTS, slots_list=["turn"],
+                                 persistence=persistence, **options)
+
+    async def turn(self, conversations: UserConversations, user_id: str, turn: int):
+        user_state = await conversations.get(user_id)
+        user_state.slots["turn"] = turn
+        await conversations.save(user_id=user_id, user_state=user_state)
+
+    def written(self, user_id: str = None) -> list:
+        db = ChatStateDB(self.path)
+        try:
+            with db.pool.read() as conn:
+                return [row[0] for row in conn.execute("SELECT json_extract(slots, '$.turn') FROM chat_state "
+                                                       "WHERE ? IS NULL OR user_id = ? ORDER BY id",
+                                                       (user_id, user_id)).fetchall()]
+
+        finally:
+            db.close()
+
+    async def test_sync_writes_every_turn(self):
+        conversations = self.conversations("sync")
+        for turn in range(3):
+            await self.turn(conversations, "user", turn)
+            self.assertEqual(self.written(), list(range(turn + 1)))
+
+        await conversations.close()
+
+    async def test_batched_writes_by_size(self):
+        conversations = self.conversations("batched", batch_size=3, flush_interval=60)
+        await conversations.start()
+
+        for turn in range(2):
+            await self.turn(conversations, "user", turn)
+
+        self.assertEqual(self.written(), [])
+
+        # the third state fills the batch, the background task writes it without waiting for flush_interval
+        await self.turn(conversations, "user", 2)
+        await asyncio.sleep(0.2)
+        self.assertEqual(self.written(), [0, 1, 2])
+
+        await self.turn(conversations, "user", 3)
+        await conversations.close()
+        self.assertEqual(self.written(), [0, 1, 2, 3])
+
+    async def test_on_evict_writes_latest_state(self):
+        conversations = self.conversations("on_evict", user_limit=2)
+        for turn in range(3):
+            await self.turn(conversations, "first", turn)
+
+        await self.turn(conversations, "second", 0)
+        self.assertEqual(self.written(), [])
+
+        # a third user evicts the least used one, its latest state is written
+        await self.turn(conversations, "third", 0)
+        self.assertEqual(self.written("second"), [0])
+        self.assertEqual(self.written("first"), [])
+
+        await conversations.close()
+        self.assertEqual(self.written("first"), [2])
+        self.assertEqual(self.written("third"), [0])
+
+    async def test_user_in_turn_is_not_evicted(self):
+        conversations = self.conversations("on_evict", user_limit=1)
+        user_state = await conversations.get("first")
+
+        await self.turn(conversations, "second", 0)
+        self.assertIs(conversations.user_queue["first"], user_state)
+
+        user_state.slots["turn"] = 1
+        await conversations.save(user_id="first", user_state=user_state)
+        await conversations.close()
+        self.assertEqual(self.written("first"), [1])
+
+    async def test_close_hands_over_to_successor(self):
+        conversations = self.conversations("batched", flush_interval=60)
+        await conversations.start()
+
+        # a turn that started before the reload is saved after it
+        user_state = await conversations.get("user")
+        user_state.slots["turn"] = 0
+
+        successor = self.conversations("batched", flush_interval=60)
+        await successor.start()
+        await conversations.close(successor=successor)
+
+        await conversations.save(user_id="user", user_state=user_state)
+        self.assertIs((await conversations.get("user")), successor.user_queue["user"])
+
+        await successor.close()
+        self.assertEqual(self.written(), [0])
+
+    async def test_closed_without_successor(self):
+        conversations = self.conversations("sync")
+        await conversations.close()
+
+        with self.assertRaises(RuntimeError):
+            await conversations.get("user")
+
+    async def test_skips_invalid_saved_state(self):
+        conversations = self.conversations("sync")
+        await self.turn(conversations, "user", 0)
+        await conversations.close()
+
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter("always")
+            reloaded = UserConversations(self.path, entities_list=[], intents_list=INTENTS, slots_list=["other"])
+
+        self.assertNotIn("user", reloaded.user_queue)
+        self.assertTrue(any("Cannot load state of user user" in str(warning.message) for warning in caught))
+        await reloaded.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
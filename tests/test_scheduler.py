@@ -0,0 +1,120 @@
+import asyncio
+import os
+import sys
+import time
+import unittest
+
+sys.path.append(os.getcwd())
+
+from controller.scheduler import TurnScheduler
+
+
+class TurnSchedulerTest(unittest.IsolatedAsyncioTestCase):
+    """
+    Turns of one user run in order, the turns of different users run at the same time
+    """
+    def setUp(self):
+        self.scheduler = TurnScheduler(max_workers=2)
+        self.done = []
+
+    def tearDown(self):
+        self.scheduler.shutdown()
+
+    def turn(self, name: str, delay: float = 0.0, wait: asyncio.Event = None):
+        async def run():
+            if wait is not None:
+                await wait.wait()
+
+            await asyncio.sleep(delay)
+            self.done.append(name)
+
+            return name
+
+        return run
+
+    async def test_turns_of_user_in_order(self):
+        results = await asyncio.gather(*(self.scheduler.submit("user", self.turn(index, delay=0.01 * (5 - index)))
+                                         for index in range(5)))
+
+        self.assertEqual(results, list(range(5)))
+        self.assertEqual(self.done, list(range(5)))
+        self.assertEqual(self.scheduler.mailboxes, dict())
+
+    async def test_users_run_concurrently(self):
+        blocked = asyncio.Event()
+        first = asyncio.ensure_future(self.scheduler.submit("first", self.turn("first", wait=blocked)))
+
+        self.assertEqual(await self.scheduler.submit("second", self.turn("second")), "second")
+        self.assertFalse(first.done())
+
+        blocked.set()
+        self.assertEqual(await first, "first")
+
+    async def test_failed_turn_does_not_stop_mailbox(self):
+        async def fail():
+            raise ValueError("bad turn")
+
+        failed = asyncio.ensure_future(self.scheduler.submit("user", fail))
+        after = asyncio.ensure_future(self.scheduler.submit("user", self.turn("after")))
+
+        with self.assertRaises(ValueError):
+            await failed
+
+        self.assertEqual(await after, "after")
+
+    async def test_cancelled_waiter_skips_its_turn(self):
+        blocked = asyncio.Event()
+        running = asyncio.ensure_future(self.scheduler.submit("user", self.turn("running", wait=blocked)))
+        waiting = asyncio.ensure_future(self.scheduler.submit("user", self.turn("waiting")))
+        await asyncio.sleep(0)
+
+        waiting.cancel()
+        blocked.set()
+        await running
+        await asyncio.sleep(0)
+
+        self.assertEqual(self.done, ["running"])
+        self.assertEqual(self.scheduler.mailboxes, dict())
+
+    async def test_cancelled_turn_does_not_leak_mailbox(self):
+        async def cancelled():
+            raise asyncio.CancelledError()
+
+        with self.assertRaises(asyncio.CancelledError):
+            await asyncio.wait_for(self.scheduler.submit("user", cancelled), timeout=1)
+
+        await asyncio.sleep(0)
+        self.assertEqual(self.scheduler.mailboxes, dict())
+        self.assertEqual(await asyncio.wait_for(self.scheduler.submit("user", self.turn("next")), timeout=1), "next")
+
+    async def test_pause_waits_for_running_turns(self):
+        blocked = asyncio.Event()
+        running = asyncio.ensure_future(self.scheduler.submit("user", self.turn("running", wait=blocked)))
+        await asyncio.sleep(0.01)
+
+        # the caller stopped waiting, the turn itself still runs
+        running.cancel()
+
+        pause = asyncio.ensure_future(self.scheduler.pause())
+        held = asyncio.ensure_future(self.scheduler.submit("other", self.turn("held")))
+
+        # pause waits without spinning the event loop
+        cpu_time = time.process_time()
+        await asyncio.sleep(0.2)
+        self.assertLess(time.process_time() - cpu_time, 0.1)
+        self.assertFalse(pause.done())
+
+        blocked.set()
+        await asyncio.wait_for(pause, timeout=1)
+        self.assertEqual(self.done, ["running"])
+        self.assertFalse(held.done())
+
+        self.scheduler.resume()
+        self.assertEqual(await held, "held")
+
+    async def test_run_inference_uses_executor(self):
+        self.assertEqual(await self.scheduler.run_inference(sum, [1, 2, 3]), 6)
+
+
+if __name__ == "__main__":
+    unittest.main()